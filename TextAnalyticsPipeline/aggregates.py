@@ -0,0 +1,158 @@
+'''
+Summary tables maintained while a run extracts, with summary_tables: True, so that frequency queries do not have to
+GROUP BY the detailed tables.
+
+Every chunk of named entity or part-of-speech rows is counted by key: (type, text) for entities and (upos, lemma) for
+words, with the language as part of the key with language: 'auto'. For each key the summary holds the number of
+occurrences and the number of documents they occur in. A chunk holds whole documents, so document counts add up
+across chunks.
+
+Counts are exact. They are held in a dict until it reaches summary_max_keys keys (or memory is above the max_memory_mb
+high water mark), when the dict is written to a sorted spill file in the temp directory and cleared. At the end of the
+run the spill files and the dict are merged in key order, summing the counts of equal keys, and the result is pushed to
+the _summary tables in chunks of SUMMARY_CHUNK rows.
+'''
+
+import os
+import json
+import heapq
+from itertools import groupby
+
+import pandas as pd
+
+from .memory_budget import under_pressure
+
+
+# Summary table and key columns for each processor that has a summary
+SUMMARIES = {
+    'ner': ('ner_summary', ['type', 'text']),
+    'pos': ('pos_summary', ['upos', 'lemma'])
+}
+
+# Rows per pushed summary chunk
+SUMMARY_CHUNK = 100000
+
+# Fewest keys spilled because of memory pressure, so that a run near its budget does not write a file per chunk
+MIN_PRESSURE_SPILL = 10000
+
+
+def read_spill(path):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            key, count, doc_count = json.loads(line)
+            yield tuple(key), count, doc_count
+
+
+class SpillingCounter:
+    '''
+    Exact (occurrences, documents) counts per key, spilled to sorted files when max_keys keys are held.
+    '''
+
+    def __init__(self, columns, spill_prefix, max_keys, logging):
+        self.columns = columns
+        self.spill_prefix = spill_prefix
+        self.max_keys = max_keys
+        self.logging = logging
+        self.counts = {}
+        self.spills = []
+
+    def add(self, keys, counts, doc_counts):
+        for key, count, doc_count in zip(keys, counts, doc_counts):
+            totals = self.counts.get(key)
+            if totals is None:
+                self.counts[key] = [count, doc_count]
+            else:
+                totals[0] += count
+                totals[1] += doc_count
+
+        if len(self.counts) >= self.max_keys or (len(self.counts) >= MIN_PRESSURE_SPILL and under_pressure()):
+            self.spill()
+
+    def spill(self):
+        path = f'{self.spill_prefix}_{len(self.spills)}.jsonl'
+        with open(path, 'w', encoding='utf-8') as f:
+            for key in sorted(self.counts):
+                f.write(json.dumps([list(key)] + self.counts[key], ensure_ascii=False))
+                f.write('\n')
+
+        self.logging.info(f'Spilled {len(self.counts)} summary keys to {path}')
+        self.spills.append(path)
+        self.counts = {}
+
+    def items(self):
+        '''
+        Yields (key, count, doc_count) once per key, in key order. The spill files are removed afterwards.
+        '''
+        runs = [read_spill(path) for path in self.spills]
+        runs.append((key, *self.counts[key]) for key in sorted(self.counts))
+
+        try:
+            merged = heapq.merge(*runs, key=lambda item: item[0])
+            for key, group in groupby(merged, key=lambda item: item[0]):
+                count = doc_count = 0
+                for _, key_count, key_doc_count in group:
+                    count = count + key_count
+                    doc_count = doc_count + key_doc_count
+                yield key, count, doc_count
+        finally:
+            for path in self.spills:
+                if os.path.isfile(path):
+                    os.remove(path)
+            self.spills = []
+            self.counts = {}
+
+
+class SummaryAggregates:
+
+    def __init__(self, run_id, max_keys, logging):
+        self.run_id = run_id
+        self.max_keys = max_keys
+        self.logging = logging
+        self.counters = {}
+
+    def observe(self, proc, df):
+        '''
+        Counts the rows of a chunk of the processor's output (with its language column, if any).
+        '''
+        if proc not in SUMMARIES or len(df) == 0:
+            return
+
+        summary_proc, key_columns = SUMMARIES[proc]
+        if 'language' in df.columns:
+            key_columns = key_columns + ['language']
+
+        if proc not in self.counters:
+            spill_prefix = f'TextAnalyticsPipeline/temp/temp_{summary_proc}_{self.run_id}'
+            self.counters[proc] = SpillingCounter(key_columns, spill_prefix, self.max_keys, self.logging)
+
+        # Keys are strings, so that spilled and in-memory keys sort together; missing values count as ''
+        keys = df[key_columns].fillna('').astype(str)
+        keys['identifier'] = df['identifier']
+        grouped = keys.groupby(key_columns, sort=False)['identifier'].agg(['size', 'nunique'])
+
+        self.counters[proc].add(grouped.index, grouped['size'].tolist(), grouped['nunique'].tolist())
+
+    def summaries(self):
+        '''
+        Yields (summary processor, dataframe) chunks of the summary tables, with count and doc_count columns.
+        '''
+        for proc, counter in self.counters.items():
+            summary_proc, _ = SUMMARIES[proc]
+            columns = counter.columns + ['count', 'doc_count']
+
+            n_rows = 0
+            rows = []
+            for key, count, doc_count in counter.items():
+                rows.append(key + (count, doc_count))
+                if len(rows) >= SUMMARY_CHUNK:
+                    n_rows = n_rows + len(rows)
+                    yield summary_proc, pd.DataFrame(rows, columns=columns)
+                    rows = []
+
+            if rows:
+                n_rows = n_rows + len(rows)
+                yield summary_proc, pd.DataFrame(rows, columns=columns)
+
+            self.logging.info(f'{summary_proc}: {n_rows} keys')
+
+        self.counters = {}
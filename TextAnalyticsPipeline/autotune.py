@@ -0,0 +1,157 @@
+'''
+Finds the batch_size, n_process and torch_threads that process the input fastest on this machine for the library and
+processor in config.yml, and writes them to the tuned profile (tuned_profile in config.yml). Later runs of the same
+library and processor use them in place of the values in config.yml.
+
+Each trial runs the pipeline over the same stratified sample of the actual input (see estimate.py), writing to an
+in-memory fake BigQuery client. The search first tries the combinations of worker processes and torch threads that
+fit the machine's CPUs, at a middle batch size, then tries each batch size with the fastest combination. Workers are
+only tried for the libraries that use them (spaCy and NLTK), and threads only for Stanza, so that workers and torch
+threads do not compete for the same CPUs. spaCy runs in one process when max_memory_mb is set, so no workers are tried
+then.
+
+Usage (from the repository root):
+    python -m TextAnalyticsPipeline.autotune --sample-size 200
+'''
+
+import os
+import logging
+import argparse
+from datetime import datetime
+
+import yaml
+
+from .config import SinkConf, SpacyConf, Performance
+from .fake_bigquery import FakeBigQueryClient
+from .set_up_logging import set_up_logging
+from .perform_analysis import get_processor_params, get_input_params
+from .estimate import draw_sample, run_sample
+
+
+BATCH_SIZES = [8, 16, 32, 64, 128, 256, 512]
+
+# Batch size used while searching workers and threads
+MIDDLE_BATCH_SIZE = 64
+
+
+def powers_of_two(limit):
+    '''
+    1, 2, 4, ... up to limit, and limit itself.
+    '''
+    values = [1]
+    while values[-1] * 2 <= limit:
+        values.append(values[-1] * 2)
+    if values[-1] != limit:
+        values.append(limit)
+    return values
+
+
+def worker_thread_pairs(library, cpus):
+    '''
+    Returns the (n_process, torch_threads) combinations to try.
+    '''
+    if library == 'stanza':
+        return [(1, threads) for threads in powers_of_two(cpus)]
+    if library == 'spacy' and Performance.max_memory_mb:
+        return [(1, 0)]
+    return [(workers, 0) for workers in powers_of_two(cpus)]
+
+
+def run_trial(params, bq, identifiers, documents, batch_size, n_process, torch_threads):
+    Performance.batch_size = batch_size
+    Performance.n_process = n_process
+    Performance.torch_threads = torch_threads
+
+    seconds, _ = run_sample(params, bq, identifiers, documents)
+    docs_per_second = len(documents) / seconds
+    logging.info(f'Trial: batch_size {batch_size:>4}, n_process {n_process:>3}, torch_threads {torch_threads:>3}: '
+                 f'{docs_per_second:.1f} docs/s')
+    return docs_per_second
+
+
+def write_profile(path, library, processor_name, settings):
+    '''
+    Stores the settings for the library and processor in the profile at path, keeping those of others.
+    '''
+    profile = {}
+    if os.path.isfile(path):
+        with open(path, encoding='utf-8') as f:
+            profile = yaml.safe_load(f) or {}
+
+    profile.setdefault(library, {})[processor_name] = settings
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        yaml.safe_dump(profile, f, sort_keys=False)
+
+
+def autotune(sample_size):
+    processor_class, processor_name, lang, library = get_processor_params()
+    project, dataset, table, id_column, text_column, database_import = get_input_params()
+    set_up_logging('TextAnalyticsPipeline/logs', library, f'{processor_name}_autotune')
+
+    if library == 'corenlp':
+        logging.info('CoreNLP runs on its server; tune corenlp_docs_per_request and corenlp_max_in_flight instead. Exiting.')
+        return
+    if library == 'spacy' and SpacyConf.derive_from_docbin:
+        logging.info('Nothing to tune: with derive_from_docbin no model is run. Exiting.')
+        return
+    if not Performance.tuned_profile:
+        logging.info('No tuned_profile set in config.yml to write the settings to. Exiting.')
+        return
+
+    # Trials write through load jobs to the fake client, whatever the configured sink
+    SinkConf.sink = 'load_job'
+
+    project, dataset, table, _, samples = draw_sample(sample_size, project, dataset, table, id_column, text_column,
+                                                      database_import)
+    identifiers = [id for ids, _ in samples.values() for id in ids]
+    documents = [document for _, docs in samples.values() for document in docs]
+    if len(documents) == 0:
+        logging.info('The input has no documents. Exiting.')
+        return
+
+    params = (library, processor_class, processor_name, lang, database_import, project, dataset, table)
+    bq = FakeBigQueryClient(':memory:', project)
+    cpus = os.cpu_count()
+    pairs = worker_thread_pairs(library, cpus)
+    logging.info(f'Tuning {library} {processor_name} on {len(documents)} documents with {cpus} CPUs')
+
+    # Warm-up: load the models, so no trial includes loading time
+    run_sample(params, bq, identifiers[:5], documents[:5])
+
+    results = {}
+    for n_process, torch_threads in pairs:
+        settings = (MIDDLE_BATCH_SIZE, n_process, torch_threads)
+        results[settings] = run_trial(params, bq, identifiers, documents, *settings)
+
+    _, best_workers, best_threads = max(results, key=results.get)
+    for batch_size in BATCH_SIZES:
+        settings = (batch_size, best_workers, best_threads)
+        if settings not in results and batch_size <= len(documents):
+            results[settings] = run_trial(params, bq, identifiers, documents, *settings)
+
+    (batch_size, n_process, torch_threads), docs_per_second = max(results.items(), key=lambda result: result[1])
+    write_profile(Performance.tuned_profile, library, processor_name, {
+        'batch_size': batch_size,
+        'n_process': n_process,
+        'torch_threads': torch_threads,
+        'docs_per_second': round(docs_per_second, 1),
+        'cpus': cpus,
+        'sample_size': len(documents),
+        'tuned_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    })
+    logging.info(f'Best: batch_size {batch_size}, n_process {n_process}, torch_threads {torch_threads} '
+                 f'({docs_per_second:.1f} docs/s). Written to {Performance.tuned_profile}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tune batch size, workers and torch threads for the configured run.')
+    parser.add_argument('--sample-size', type=int, default=200, help='Number of documents in each trial (default 200)')
+    args = parser.parse_args()
+
+    autotune(args.sample_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+'''
+Throughput benchmarks for the pipeline backends. Nothing is pushed to BigQuery; only the NLP and extraction steps are
+timed.
+
+Usage (from the repository root):
+    python -m TextAnalyticsPipeline.benchmark nltk --csv path/to/documents.csv --text-column message
+    python -m TextAnalyticsPipeline.benchmark stanza --csv path/to/documents.csv --text-column message
+    python -m TextAnalyticsPipeline.benchmark storage_write --csv path/to/documents.csv --text-column message
+    python -m TextAnalyticsPipeline.benchmark quantization --csv path/to/documents.csv --text-column message
+'''
+
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from .config import Performance
+
+
+def report(name, n_docs, n_tokens, seconds):
+    print(f'{name:<24} {n_docs / seconds:>10.1f} docs/s {n_tokens / seconds:>12.1f} tokens/s {seconds:>9.2f} s')
+
+
+def benchmark_nltk_vs_spacy(documents, lang='en'):
+    '''
+    Compares NLTK part-of-speech extraction (single process and process pool) against the spaCy sm model, and reports
+    how often the two agree on UPOS for tokens with identical character spans.
+    '''
+    import spacy
+    from . import nltk_pipe
+
+    perf = Performance()
+    batch_size = perf.batch_size
+    batches = [[(i, doc) for i, doc in enumerate(documents[j:j + batch_size], start=j)]
+               for j in range(0, len(documents), batch_size)]
+
+    # NLTK, single process
+    nltk_pipe.extract_pos(documents[0])  # load models outside the timed section
+    start = time.perf_counter()
+    nltk_rows = [nltk_pipe.extract_pos(doc) for doc in documents]
+    n_tokens = sum(len(rows) for rows in nltk_rows)
+    report('nltk (1 process)', len(documents), n_tokens, time.perf_counter() - start)
+
+    # NLTK, process pool as used by run_nltk_pipeline
+    with ProcessPoolExecutor(max_workers=perf.processes()) as executor:
+        start = time.perf_counter()
+        dfs = [df for batch_dfs in executor.map(nltk_pipe.process_batch, batches, ['pos'] * len(batches)) for df in batch_dfs]
+        report('nltk (process pool)', len(documents), sum(len(df) for df in dfs), time.perf_counter() - start)
+
+    # spaCy small model, with the components NLTK does not produce disabled
+    nlp = spacy.load(f'{lang}_core_web_sm', disable=['parser', 'ner'])
+    nlp.add_pipe('sentencizer')
+    start = time.perf_counter()
+    spacy_docs = list(nlp.pipe(documents, batch_size=batch_size))
+    report('spacy sm', len(documents), sum(len(doc) for doc in spacy_docs), time.perf_counter() - start)
+
+    # UPOS agreement on tokens that both libraries segmented identically
+    matched = agreed = 0
+    for rows, doc in zip(nltk_rows, spacy_docs):
+        spacy_upos = {(token.idx, token.idx + len(token)): token.pos_ for token in doc}
+        for row in rows:
+            upos = spacy_upos.get((row['start_char'], row['end_char']))
+            if upos is not None:
+                matched += 1
+                agreed += upos == row['upos']
+    if matched:
+        print(f'Tokens with identical spans: {matched}, UPOS agreement with spaCy sm: {agreed / matched:.1%}')
+
+
+def legacy_stanza_extract(processor_name, id, doc):
+    '''
+    The per-document extraction used before stanza_extract.py, kept as the baseline for benchmark_stanza_extraction.
+    '''
+    from .data_processor import ProcessResults
+    result_processor = ProcessResults()
+
+    if processor_name == 'ner':
+        if len(doc.entities) == 0:
+            return None
+        df = pd.DataFrame(doc.entities)
+        df[0] = df[0].apply(lambda x: x.to_dict())
+        df = pd.json_normalize(df[0])
+        return result_processor.process_ner(id, df[['text', 'type', 'start_char', 'end_char']])
+
+    rows = []
+    for sentence in doc.sentences:
+        sent_num = sentence.index + 1
+        for word in sentence.words:
+            if processor_name == 'pos':
+                rows.append([sent_num, word.id, f'{id}_{sent_num}_{word.id}', word.text, word.lemma, word.upos,
+                             word.xpos, word.start_char, word.end_char])
+            elif processor_name == 'depparse':
+                head_word = word if word.deprel == 'root' else sentence.words[int(word.head) - 1]
+                rows.append({
+                    'sentence_num': sent_num, 'word_num': word.id, 'word_id': f'{id}_{sent_num}_{word.id}',
+                    'word_text': word.text, 'word_lemma': word.lemma, 'word_start_char': word.start_char,
+                    'word_end_char': word.end_char,
+                    'relation': 'ROOT' if word.deprel == 'root' else word.deprel,
+                    'head_num': head_word.id, 'head_id': f'{id}_{sent_num}_{head_word.id}',
+                    'head_text': head_word.text, 'head_lemma': head_word.lemma,
+                    'head_start_char': head_word.start_char, 'head_end_char': head_word.end_char
+                })
+            elif processor_name == 'morphology':
+                feats_dict = {}
+                if word.feats is not None:
+                    for feat in word.feats.split('|'):
+                        key, value = feat.split('=')
+                        feats_dict[key] = value
+                row = {'sentence_num': sent_num, 'word_num': word.id, 'word_id': f'{id}_{sent_num}_{word.id}',
+                       'word': word.text, 'lemma': word.lemma}
+                for feature in ['Number', 'Mood', 'Person', 'Tense', 'VerbForm', 'Case', 'Gender', 'PronType',
+                                'Degree', 'Definite', 'NumForm', 'NumType', 'Voice']:
+                    row[f'features_{feature}'] = feats_dict.get(feature) if feats_dict else None
+                row['start_char'] = word.start_char
+                row['end_char'] = word.end_char
+                rows.append(row)
+
+    df = pd.DataFrame(rows)
+    if processor_name == 'pos':
+        return result_processor.process_pos(id, df)
+    elif processor_name == 'depparse':
+        return result_processor.process_depparse(id, df)
+    else:
+        return result_processor.process_morphology(id, df)
+
+
+def benchmark_stanza_extraction(documents, lang='en', processors=('ner', 'pos', 'depparse', 'morphology'), repeat=3):
+    '''
+    Runs each Stanza processor once over the documents, then times only the extraction of the output table: the
+    legacy per-document path against the batch extraction in stanza_extract.py.
+    '''
+    import stanza
+    from .stanza_extract import EXTRACTORS
+    from .stanza_pipe import no_offset_change
+
+    processor_classes = {'ner': 'ner', 'pos': 'lemma,pos', 'depparse': 'lemma,pos,depparse', 'morphology': 'lemma,pos'}
+
+    for processor_name in processors:
+        nlp = stanza.Pipeline(lang, processors=f'tokenize,mwt,{processor_classes[processor_name]}',
+                              download_method=None, logging_level='WARN')
+        docs = nlp([stanza.Document([], text=document) for document in documents])
+        n_words = sum(len(sentence.words) for doc in docs for sentence in doc.sentences)
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            [legacy_stanza_extract(processor_name, id, doc) for id, doc in enumerate(docs)]
+        legacy = (time.perf_counter() - start) / repeat
+
+        extract = EXTRACTORS[processor_name][0]
+        start = time.perf_counter()
+        for _ in range(repeat):
+            extract([(id, doc, no_offset_change) for id, doc in enumerate(docs)])
+        batch = (time.perf_counter() - start) / repeat
+
+        report(f'{processor_name} legacy', len(docs), n_words, legacy)
+        report(f'{processor_name} batch', len(docs), n_words, batch)
+        print(f'{processor_name} extraction speedup: {legacy / batch:.1f}x')
+
+
+def stanza_annotations(docs):
+    '''
+    Returns the words of Stanza docs keyed by (document, token span, word in token), and the set of entities as
+    (document, start_char, end_char, type).
+    '''
+    words = {}
+    entities = set()
+    for doc_num, doc in enumerate(docs):
+        for sentence in doc.sentences:
+            keys = {}
+            for token in sentence.tokens:
+                for word_num, word in enumerate(token.words):
+                    keys[word.id] = (doc_num, token.start_char, token.end_char, word_num)
+            for word in sentence.words:
+                head = keys.get(word.head) if word.head else None
+                words[keys[word.id]] = (word.upos, word.xpos, word.feats, head, word.deprel)
+        for entity in doc.ents:
+            entities.add((doc_num, entity.start_char, entity.end_char, entity.type))
+    return words, entities
+
+
+def benchmark_stanza_quantization(documents, lang='en', processors=('pos', 'depparse', 'ner')):
+    '''
+    Times the Stanza pipeline with fp32 weights against the same pipeline with the processors quantised to int8
+    (as with stanza_quantize), and reports the int8 output's agreement with the fp32 output: UPOS, XPOS and feats on
+    words with identical spans, UAS and LAS, and entity precision, recall and F1.
+    '''
+    import stanza
+    from .stanza_pipe import load_pipeline
+
+    names = ['tokenize', 'mwt']
+    if 'pos' in processors or 'depparse' in processors:
+        names += ['pos', 'lemma']
+    names += [name for name in ('depparse', 'ner') if name in processors]
+    pipeline_processors = ','.join(names)
+
+    results = {}
+    for quantize in [(), tuple(processors)]:
+        nlp = load_pipeline(lang, pipeline_processors, {'logging_level': 'WARN'}, quantize)
+        nlp([stanza.Document([], text=document) for document in documents[:5]])  # warm up outside the timed section
+
+        start = time.perf_counter()
+        docs = nlp([stanza.Document([], text=document) for document in documents])
+        seconds = time.perf_counter() - start
+
+        n_words = sum(len(sentence.words) for doc in docs for sentence in doc.sentences)
+        report('stanza int8' if quantize else 'stanza fp32', len(docs), n_words, seconds)
+        results[quantize] = (seconds, stanza_annotations(docs))
+
+    (fp32_seconds, (fp32_words, fp32_entities)), (int8_seconds, (int8_words, int8_entities)) = results.values()
+    print(f'int8 speedup: {fp32_seconds / int8_seconds:.2f}x')
+
+    # Agreement on words both pipelines segmented identically, with the fp32 output as reference
+    matched = [key for key in fp32_words if key in int8_words]
+    print(f'{len(matched)} of {len(fp32_words)} words segmented identically')
+    if matched and ('pos' in processors or 'depparse' in processors):
+        for name, i in [('UPOS', 0), ('XPOS', 1), ('feats', 2)]:
+            agreed = sum(fp32_words[key][i] == int8_words[key][i] for key in matched)
+            print(f'{name} agreement: {agreed / len(matched):.2%}')
+    if matched and 'depparse' in processors:
+        uas = sum(fp32_words[key][3] == int8_words[key][3] for key in matched)
+        las = sum(fp32_words[key][3:] == int8_words[key][3:] for key in matched)
+        print(f'UAS: {uas / len(matched):.2%}  LAS: {las / len(matched):.2%}')
+    if 'ner' in processors:
+        true_positives = len(fp32_entities & int8_entities)
+        precision = true_positives / len(int8_entities) if int8_entities else 1.0
+        recall = true_positives / len(fp32_entities) if fp32_entities else 1.0
+        f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+        print(f'Entities: precision {precision:.2%}, recall {recall:.2%}, F1 {f1:.2%} '
+              f'({len(int8_entities)} int8, {len(fp32_entities)} fp32)')
+
+
+def benchmark_storage_write(documents, chunk=20, latency=0.05, failure_rate=0.1):
+    '''
+    Appends whitespace-tokenised part-of-speech style rows through StorageWriteSink to the in-memory LocalWriteClient,
+    one append per chunk of documents, with latency seconds added to each append and failure_rate of the responses
+    lost. Reports throughput for committed and pending streams and checks that every row was written exactly once.
+    '''
+    import logging
+    from .bigquery_tools import Schema
+    from .storage_write import LocalWriteClient, StorageWriteSink, table_path
+
+    chunks = [
+        [
+            {'identifier': str(id), 'sentence_num': 1, 'word_num': word_num, 'word': word, 'lemma': word.lower(),
+             'upos': 'X', 'xpos': 'X', 'start_char': 0, 'end_char': len(word)}
+            for id, document in enumerate(documents[chunk_start:chunk_start + chunk], start=chunk_start)
+            for word_num, word in enumerate(document.split(), start=1)
+        ]
+        for chunk_start in range(0, len(documents), chunk)
+    ]
+    n_rows = sum(len(chunk_records) for chunk_records in chunks)
+
+    for stream_type in ['committed', 'pending']:
+        client = LocalWriteClient(latency=latency, failure_rate=failure_rate)
+        sink = StorageWriteSink(client, 'project.dataset.benchmark', Schema.pos_schema, stream_type, logging,
+                                backoff=latency)
+
+        start = time.perf_counter()
+        for chunk_records in chunks:
+            sink.append_records(chunk_records)
+        sink.close()
+        report(f'storage_write {stream_type}', len(documents), n_rows, time.perf_counter() - start)
+
+        written = len(client.rows(table_path('project.dataset.benchmark')))
+        print(f'{stream_type}: {client.appends} appends, {written} of {n_rows} rows written')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark pipeline backends on a local csv file.')
+    parser.add_argument('benchmark', choices=['nltk', 'stanza', 'storage_write', 'quantization'])
+    parser.add_argument('--csv', required=True, help='Path to a csv file of documents')
+    parser.add_argument('--text-column', required=True, help='Name of the column containing the document text')
+    parser.add_argument('--n-docs', type=int, default=1000, help='Number of documents to benchmark on')
+    parser.add_argument('--lang', default='en')
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.csv).dropna(subset=args.text_column)
+    documents = df[args.text_column].astype(str).tolist()[:args.n_docs]
+
+    if args.benchmark == 'nltk':
+        benchmark_nltk_vs_spacy(documents, args.lang)
+    elif args.benchmark == 'stanza':
+        benchmark_stanza_extraction(documents, args.lang)
+    elif args.benchmark == 'storage_write':
+        benchmark_storage_write(documents)
+    elif args.benchmark == 'quantization':
+        benchmark_stanza_quantization(documents, args.lang)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,7 +4,13 @@ output to BigQuery.
 '''
 
 import os
+import re
 import glob
+import json
+import itertools
+from functools import partial
+from itertools import groupby, repeat
+
 import pandas as pd
 
 from google.cloud import bigquery
@@ -12,12 +18,18 @@ from google.cloud.bigquery.client import Client
 from google.cloud.exceptions import NotFound
 
 from .set_up_logging import *
+from .config import BigQuery, InputConf, OutputConf, SinkConf, FakeBigQueryConf
+from .upload_scheduler import UploadScheduler
+from .aggregates import SummaryAggregates
 
 
 class GBQCreds:
 
     def get_gbq_creds(self, project):
         # Get GBQ credentials from environment variables, or from local file in 'access_key' directory. If multiple keys exist, match with project id
+        if FakeBigQueryConf.enabled:
+            return
+
         try:
             gbq_creds = os.environ['gbq_servicekey']
             os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = gbq_creds
@@ -43,12 +55,111 @@ class GBQCreds:
 
 
     def get_client(self, project):
+        if FakeBigQueryConf.enabled:
+            return self.get_fake_client(project)
+
         client = bigquery.Client()
         bq = Client(project=project)
 
         return bq
 
+    def get_fake_client(self, project):
+        '''
+        Returns the DuckDB-backed stand-in client (see fake_bigquery.py), with the input table loaded from a csv file.
+        '''
+        from .fake_bigquery import FakeBigQueryClient
+
+        os.makedirs(os.path.dirname(FakeBigQueryConf.path) or '.', exist_ok=True)
+        bq = FakeBigQueryClient(
+            FakeBigQueryConf.path,
+            project,
+            latency=FakeBigQueryConf.latency,
+            error_rate=FakeBigQueryConf.error_rate,
+            load_jobs_per_table=FakeBigQueryConf.load_jobs_per_table
+        )
+
+        seed_csv = FakeBigQueryConf.seed_csv or self.default_seed_csv()
+        if seed_csv:
+            self.seed_fake_table(bq, project, BigQuery.dataset_name, BigQuery.tablename, seed_csv)
+
+        return bq
+
+    def default_seed_csv(self):
+        '''
+        With from_csv, the input table only has to exist, so the first input csv is loaded as it.
+        '''
+        if InputConf.from_database == True:
+            return ''
+        input_csvs = glob.glob('./TextAnalyticsPipeline/input_csv/*.csv')
+        return input_csvs[0] if input_csvs else ''
+
+    def seed_fake_table(self, bq, project, dataset, table, seed_csv):
+        '''
+        Loads a csv file as an input table of the fake client (e.g. one for each job in job_runner.py).
+        '''
+        bq.load_csv(f'{project}.{dataset}.{table}', seed_csv)
+        logging.info(f'Fake BigQuery client: loaded {seed_csv} as {dataset}.{table}')
+
+
 class QueryGBQ:
+    def build_query(self, project, dataset, table, id_column, text_column, tablesample_percent=None):
+        '''
+        Returns the input query, with the filters, sampling, ordering and limit from config.yml pushed into it so
+        BigQuery only scans and returns the documents to be analysed. tablesample_percent overrides the configured
+        tablesample_percent.
+        '''
+        if tablesample_percent is None:
+            tablesample_percent = InputConf.tablesample_percent
+
+        conditions = [f'{text_column} IS NOT NULL']
+        if InputConf.where:
+            conditions.append(f'({InputConf.where})')
+        if InputConf.min_text_length:
+            conditions.append(f'LENGTH({text_column}) >= {int(InputConf.min_text_length)}')
+        if InputConf.max_text_length:
+            conditions.append(f'LENGTH({text_column}) <= {int(InputConf.max_text_length)}')
+
+        sample = ''
+        if tablesample_percent:
+            sample = f' TABLESAMPLE SYSTEM ({float(tablesample_percent)} PERCENT)'
+
+        # GROUP BY is SELECT DISTINCT, but also allows ordering by columns that are not selected (by their
+        # first value for each document)
+        query_string = f"""
+            SELECT {id_column}, {text_column}
+            FROM `{project}.{dataset}.{table}`{sample}
+            WHERE {' AND '.join(conditions)}
+            GROUP BY {id_column}, {text_column}"""
+
+        if InputConf.order_by:
+            order = []
+            for column, direction in self.parse_order_by(InputConf.order_by):
+                if column not in (id_column, text_column):
+                    column = f'MIN({column})'
+                order.append(f'{column} {direction}')
+            query_string += f"""
+            ORDER BY {', '.join(order)}"""
+
+        if InputConf.limit:
+            query_string += f"""
+            LIMIT {int(InputConf.limit)}"""
+
+        return query_string
+
+    @staticmethod
+    def parse_order_by(order_by):
+        '''
+        Returns (column, direction) for each comma-separated 'column [ASC|DESC]' in order_by, or None if it is not
+        in that form.
+        '''
+        terms = []
+        for term in order_by.split(','):
+            match = re.fullmatch(r'\s*([A-Za-z_][A-Za-z0-9_]*)(?:\s+(ASC|DESC))?\s*', term, flags=re.IGNORECASE)
+            if match is None:
+                return None
+            terms.append((match.group(1), (match.group(2) or 'ASC').upper()))
+        return terms
+
     def query_gbq(self, logging, table, query_string, bq, dataset, text_column):
         # Run query and save to dataframe
         try:
@@ -63,11 +174,12 @@ class QueryGBQ:
 
         return n_docs, df
 
-    def read_csv_from_file(self, logging):
-        # Read csv from /input_csv/ directory into dataframe
+    def read_csv_from_file(self, logging, input_csv=None):
+        # Read csv from /input_csv/ directory into dataframe (or from input_csv if given)
         csv_path = './TextAnalyticsPipeline/input_csv/'
         # Glob to locate csv file
-        input_csv = glob.glob(csv_path + '*.csv')[0]  # Set to [0] for now, TODO accept multiple input files
+        if input_csv is None:
+            input_csv = glob.glob(csv_path + '*.csv')[0]  # Set to [0] for now, TODO accept multiple input files
         if len(input_csv) > 0:
             try:
                 df = pd.read_csv(input_csv)
@@ -82,6 +194,45 @@ class QueryGBQ:
 
         return n_docs, df
 
+def nested_schema(compact_schema):
+    '''
+    Builds a per-document schema from a compact token-level schema: identifier, then a repeated sentences record
+    holding sentence_num and a repeated tokens record with the remaining fields.
+    '''
+    identifier, sentence_num = compact_schema[0], compact_schema[1]
+    token_fields = compact_schema[2:]
+    return [
+        identifier,
+        bigquery.SchemaField('sentences', 'RECORD', mode='REPEATED', description='Sentences of the document', fields=[
+            sentence_num,
+            bigquery.SchemaField('tokens', 'RECORD', mode='REPEATED', description='Words of the sentence',
+                                 fields=token_fields)
+        ])
+    ]
+
+
+def nest_rows(df):
+    '''
+    Groups the rows of a compact token-level table into one nested record per document. Rows must be ordered by
+    identifier and sentence_num, as the extractors produce them. A language column is kept at the document level.
+    '''
+    token_columns = [column for column in df.columns[2:] if column != 'language']
+    df = df.astype(object).where(df.notna(), None)
+    languages = df['language'] if 'language' in df.columns else repeat(None)
+    rows = zip(df['identifier'], df['sentence_num'], df[token_columns].itertuples(index=False, name=None), languages)
+
+    for identifier, doc_rows in groupby(rows, key=lambda row: row[0]):
+        doc_rows = list(doc_rows)
+        record = {'identifier': identifier}
+        if 'language' in df.columns:
+            record['language'] = doc_rows[0][3]
+        record['sentences'] = [
+            {'sentence_num': sentence_num, 'tokens': [dict(zip(token_columns, row[2])) for row in sentence_rows]}
+            for sentence_num, sentence_rows in groupby(doc_rows, key=lambda row: row[1])
+        ]
+        yield record
+
+
 class Schema:
 
     # Named Entity Recognition schema
@@ -217,83 +368,573 @@ class Schema:
         'end_char'
     ]
 
+    # Long-format morphology schema; one row per word and feature, including features without a morphology_schema column
+    morphology_features_schema = [
+        bigquery.SchemaField('identifier', 'STRING', description='Identifier for the record'),
+        bigquery.SchemaField('word_id', 'STRING', description='Word identifier'),
+        bigquery.SchemaField('feature', 'STRING', description='Morphological feature name'),
+        bigquery.SchemaField('value', 'STRING', description='Morphological feature value')
+    ]
+
+    morphology_features_column_order = [
+        'identifier',
+        'word_id',
+        'feature',
+        'value'
+    ]
+
+    # Sentiment schema; one row per sentence plus one document-level aggregate row per document
+    sentiment_schema = [
+        bigquery.SchemaField('identifier', 'STRING', description='Identifier for the record'),
+        bigquery.SchemaField('level', 'STRING', description='Row level: sentence or document'),
+        bigquery.SchemaField('sentence_num', 'INTEGER', description='Sentence number (null for document rows)'),
+        bigquery.SchemaField('text', 'STRING', description='Sentence text (null for document rows)'),
+        bigquery.SchemaField('sentiment', 'STRING', description='Sentiment label: negative, neutral or positive'),
+        bigquery.SchemaField('score', 'FLOAT', description='Sentiment score from -1 (negative) to 1 (positive); mean of sentence scores for document rows'),
+        bigquery.SchemaField('start_char', 'INTEGER', description='Start character position in text'),
+        bigquery.SchemaField('end_char', 'INTEGER', description='End character position in text')
+    ]
+
+    sentiment_column_order = [
+        'identifier',
+        'level',
+        'sentence_num',
+        'text',
+        'sentiment',
+        'score',
+        'start_char',
+        'end_char'
+    ]
+
+    # Compact schemas (OutputConf.compact_schema) for the token-level tables. word_id and head_id are dropped because
+    # they are built from identifier, sentence_num and word_num/head_num; the head_* columns of depparse are dropped
+    # because they repeat the head word's own row; and head_num is an INTEGER. The views created by
+    # PushTables.create_wide_view rebuild the wide layout for existing queries.
+    pos_compact_schema = [field for field in pos_schema if field.name != 'word_id']
+
+    depparse_compact_schema = [
+        field for field in depparse_schema
+        if field.name not in ('word_id', 'head_num', 'head_id', 'head_text', 'head_lemma', 'head_start_char', 'head_end_char')
+    ] + [bigquery.SchemaField('head_num', 'INTEGER', description='Target word number in the sentence')]
+
+    morphology_compact_schema = [field for field in morphology_schema if field.name != 'word_id']
+
+    morphology_features_compact_schema = [
+        bigquery.SchemaField('identifier', 'STRING', description='Identifier for the record'),
+        bigquery.SchemaField('sentence_num', 'INTEGER', description='Sentence number'),
+        bigquery.SchemaField('word_num', 'INTEGER', description='Word number in the sentence'),
+        bigquery.SchemaField('feature', 'STRING', description='Morphological feature name'),
+        bigquery.SchemaField('value', 'STRING', description='Morphological feature value')
+    ]
+
+    # Nested schemas (OutputConf.nested_schema): one row per document, with the sentences and their tokens as repeated
+    # records. Token fields are those of the compact schema, so head_num refers to a word_num in the same sentence.
+    pos_nested_schema = nested_schema(pos_compact_schema)
+
+    depparse_nested_schema = nested_schema(depparse_compact_schema)
+
+    morphology_nested_schema = nested_schema(morphology_compact_schema)
+
+    # Summary tables (OutputConf.summary_tables): one row per key, counted over the whole run; see aggregates.py
+    ner_summary_schema = [
+        bigquery.SchemaField('type', 'STRING', description='Named entity type'),
+        bigquery.SchemaField('text', 'STRING', description='Named entity text'),
+        bigquery.SchemaField('count', 'INTEGER', description='Number of mentions'),
+        bigquery.SchemaField('doc_count', 'INTEGER', description='Number of documents with at least one mention')
+    ]
+
+    pos_summary_schema = [
+        bigquery.SchemaField('upos', 'STRING', description='Universal Part-of-Speech tag'),
+        bigquery.SchemaField('lemma', 'STRING', description='Lemma of the word'),
+        bigquery.SchemaField('count', 'INTEGER', description='Number of words with the lemma and tag'),
+        bigquery.SchemaField('doc_count', 'INTEGER', description='Number of documents with at least one such word')
+    ]
+
+    # Table suffix for each schema
+    suffixes = {
+        'ner': 'named_entities',
+        'pos': 'part_of_speech',
+        'depparse': 'depparse',
+        'morphology': 'morphology',
+        'morphology_features': 'morphology_features',
+        'sentiment': 'sentiment',
+        'ner_summary': 'named_entities_summary',
+        'pos_summary': 'part_of_speech_summary'
+    }
+
+    # Summary tables (see aggregates.py)
+    summary_procs = ('ner_summary', 'pos_summary')
+
+    # Tables written alongside a processor's main table, which always get their suffix (with csv input the main table
+    # has none), so that the two cannot share a name
+    secondary_procs = ('morphology_features',) + summary_procs
+
+    # Wide schema and its compact variant (where there is one) for each processor
+    schemas = {
+        'ner': (ner_schema, None),
+        'pos': (pos_schema, pos_compact_schema),
+        'depparse': (depparse_schema, depparse_compact_schema),
+        'morphology': (morphology_schema, morphology_compact_schema),
+        'morphology_features': (morphology_features_schema, morphology_features_compact_schema),
+        'sentiment': (sentiment_schema, None),
+        'ner_summary': (ner_summary_schema, None),
+        'pos_summary': (pos_summary_schema, None)
+    }
+
+    @classmethod
+    def get_schema(cls, proc, compact=False):
+        '''
+        Returns the schema for a processor's table; the compact variant if compact is True and one exists.
+        '''
+        wide, compact_schema = cls.schemas[proc]
+        if compact and compact_schema is not None:
+            return compact_schema
+        return wide
+
+    @classmethod
+    def get_column_order(cls, proc, compact=False):
+        return [field.name for field in cls.get_schema(proc, compact)]
+
+    # Detected language of each document, added to every table with language: 'auto' (see language_router.py)
+    language_field = bigquery.SchemaField('language', 'STRING', description='Detected language of the document')
+
+    @classmethod
+    def with_language(cls, schema):
+        '''
+        Returns the schema with the language column: last, or after identifier in nested (per-document) schemas.
+        '''
+        if len(schema) > 1 and schema[1].name == 'sentences':
+            return [schema[0], cls.language_field] + list(schema[1:])
+        return list(schema) + [cls.language_field]
+
+    # Nested schema for each processor that has one
+    nested_schemas = {
+        'pos': pos_nested_schema,
+        'depparse': depparse_nested_schema,
+        'morphology': morphology_nested_schema
+    }
+
+
+# SQL for the views that rebuild the wide layout from a compact table; {compact} is the compact table id, and
+# {language} adds the language column with language: 'auto'
+WIDE_VIEW_SQL = {
+    'pos': '''
+        SELECT identifier, sentence_num, word_num,
+            CONCAT(identifier, '_', CAST(sentence_num AS STRING), '_', CAST(word_num AS STRING)) AS word_id,
+            word, lemma, upos, xpos, start_char, end_char{language}
+        FROM `{compact}`''',
+    'depparse': '''
+        SELECT w.identifier, w.sentence_num, w.word_num,
+            CONCAT(w.identifier, '_', CAST(w.sentence_num AS STRING), '_', CAST(w.word_num AS STRING)) AS word_id,
+            w.word_text, w.word_lemma, w.word_start_char, w.word_end_char, w.relation,
+            CAST(w.head_num AS STRING) AS head_num,
+            CONCAT(w.identifier, '_', CAST(w.sentence_num AS STRING), '_', CAST(w.head_num AS STRING)) AS head_id,
+            h.word_text AS head_text, h.word_lemma AS head_lemma,
+            h.word_start_char AS head_start_char, h.word_end_char AS head_end_char{language}
+        FROM `{compact}` AS w
+        LEFT JOIN `{compact}` AS h
+            ON h.identifier = w.identifier AND h.sentence_num = w.sentence_num AND h.word_num = w.head_num''',
+    'morphology': '''
+        SELECT identifier, sentence_num, word_num,
+            CONCAT(identifier, '_', CAST(sentence_num AS STRING), '_', CAST(word_num AS STRING)) AS word_id,
+            word, lemma, features_Number, features_Mood, features_Person, features_Tense, features_VerbForm,
+            features_Case, features_Gender, features_PronType, features_Degree, features_Definite, features_NumForm,
+            features_NumType, features_Voice, start_char, end_char{language}
+        FROM `{compact}`''',
+    'morphology_features': '''
+        SELECT identifier,
+            CONCAT(identifier, '_', CAST(sentence_num AS STRING), '_', CAST(word_num AS STRING)) AS word_id,
+            feature, value{language}
+        FROM `{compact}`'''
+}
+
+class DestinationSession:
+    '''
+    The dataset and destination tables of one run, resolved once. The dataset is checked (and created if missing) when
+    the session is created, and each destination table the first time it is written to: an existing table is used as
+    it is, and a missing one is created with its schema, partitioning and clustering. After that only loads are issued.
+    '''
+
+    # Metadata calls push_to_gbq made for every chunk before sessions: get_dataset, get_table on the source table, and
+    # get_table after the load
+    CALLS_PER_CHUNK = 3
+
+    def __init__(self, bq, dataset, logging):
+        self.bq = bq
+        self.dataset = dataset
+        self.logging = logging
+        self.tables = {}
+        self.metadata_calls = 0
+        self.chunks = 0
+
+        self.ensure_dataset()
+
+    def ensure_dataset(self):
+        self.logging.info(f'Checking if dataset {self.dataset} exists...')
+        self.metadata_calls += 1
+        try:
+            self.bq.get_dataset(self.dataset)  # Make an API request.
+            self.logging.info(f'Dataset {self.dataset} already exists. Pushing to existing dataset...')
+        except NotFound:
+            self.logging.info(f'Dataset {self.dataset} is not found. Creating new dataset.')
+            self.metadata_calls += 1
+            self.bq.create_dataset(self.dataset)
+            self.logging.info(f'Created new dataset: {self.dataset}.')
+
+    def resolve(self, table_id, schema):
+        '''
+        Returns the destination table, creating it on first use if it does not exist. New tables are partitioned by
+        ingestion time (OutputConf.partition_type) and clustered on identifier (summary tables, which have no
+        identifier, on their first column).
+        '''
+        if table_id in self.tables:
+            return self.tables[table_id]
+
+        self.metadata_calls += 1
+        try:
+            table = self.bq.get_table(table_id)
+            self.logging.info(f'Table {table_id} exists')
+        except NotFound:
+            table = bigquery.Table(table_id, schema=schema)
+            if OutputConf.partition_type:
+                table.time_partitioning = bigquery.TimePartitioning(type_=OutputConf.partition_type)
+            names = [field.name for field in schema]
+            table.clustering_fields = ['identifier' if 'identifier' in names else names[0]]
+
+            self.metadata_calls += 1
+            table = self.bq.create_table(table, exists_ok=True)
+            self.logging.info(f'Created table {table_id}')
+
+        self.tables[table_id] = table
+        return table
+
+    def load(self, fh, table_id, job_config):
+        job = self.bq.load_table_from_file(fh, table_id, job_config=job_config)
+        job.result()  # Waits for the job to complete.
+        return job
+
+    def report(self):
+        saved = self.chunks * self.CALLS_PER_CHUNK - self.metadata_calls
+        self.logging.info(f'Destination session: {self.chunks} chunks pushed with {self.metadata_calls} metadata API '
+                          f'calls ({max(saved, 0)} saved over per-chunk checks)')
+
+
 class PushTables:
 
+    # Wide views already created in this run
+    views_created = set()
+
+    # Numbers PushTables instances, so that runs in one process (see job_runner.py) use separate temp files
+    instance_numbers = itertools.count()
+
+    def __init__(self):
+        self.run_id = f'{os.getpid()}_{next(PushTables.instance_numbers)}'
+        self.compact = OutputConf.compact_schema
+        self.nested = OutputConf.nested_schema
+        self.sink = SinkConf.sink
+
+        # With the storage_write sink, rows are held here between prepare_chunk_for_push and push_to_gbq, and appended
+        # to one write stream per destination table
+        self.prepared = {}
+        self.write_client = None
+        self.write_sinks = {}
+
+        # With the spool sink, chunks are written to a directory for the run and loaded by close()
+        self.spool = None
+
+        # Dataset and destination tables, resolved on the first push of the run
+        self.session = None
+
+        # With the duckdb or parquet sink, output is written locally and BigQuery is not used
+        self.local_sink = None
+
+        # With the load_job sink, load jobs run in the background through an upload scheduler
+        self.scheduler = None
+        self.uploads = 0
+
+        # With language: 'auto', the language of each identifier, written to a language column (see language_router.py)
+        self.languages = None
+
+        # With summary_tables, entity and lemma counts over the run, pushed by close() (see aggregates.py). The
+        # arguments of the last push_to_gbq are kept so that close() can push them to the same place.
+        self.aggregates = SummaryAggregates(self.run_id, OutputConf.summary_max_keys, logging) if OutputConf.summary_tables else None
+        self.push_args = None
+
+    def is_nested(self, proc):
+        return self.nested and proc in Schema.nested_schemas
+
+    def temp_file(self, proc, library):
+        # Nested tables are written as newline-delimited JSON, since CSV cannot hold repeated records
+        extension = 'json' if self.is_nested(proc) else 'csv'
+        return f'TextAnalyticsPipeline/temp/temp_{proc}_{library}_{self.run_id}.{extension}'
+
     def prepare_chunk_for_push(self, result_dfs, processor_name, library):
         dfs_concat = [inner_list[0] for inner_list in result_dfs]
         results_dfs_concat = pd.concat(dfs_concat, ignore_index=True)
 
+        # Keep only the columns of the schema being loaded, in order
+        if processor_name in Schema.schemas:
+            compact = self.compact or self.is_nested(processor_name)
+            columns = Schema.get_column_order(processor_name, compact)
+
+            # Summary chunks come with their language column
+            if processor_name in Schema.summary_procs and 'language' in results_dfs_concat.columns:
+                columns = columns + ['language']
+            results_dfs_concat = results_dfs_concat[columns]
+
+        if self.languages is not None and 'identifier' in results_dfs_concat.columns:
+            results_dfs_concat['language'] = results_dfs_concat['identifier'].map(self.languages)
+
+        if self.aggregates is not None:
+            self.aggregates.observe(processor_name, results_dfs_concat)
+
+        if self.sink in ('spool', 'duckdb', 'parquet'):
+            if self.is_nested(processor_name):
+                self.prepared[processor_name] = list(nest_rows(results_dfs_concat))
+            else:
+                self.prepared[processor_name] = results_dfs_concat
+            return
+
+        if self.sink == 'storage_write':
+            if self.is_nested(processor_name):
+                records = list(nest_rows(results_dfs_concat))
+            else:
+                records = results_dfs_concat.astype(object).where(results_dfs_concat.notna(), None).to_dict('records')
+            self.prepared[processor_name] = records
+            return
+
+        if self.is_nested(processor_name):
+            logging.info(f'Writing {processor_name} output to json...')
+
+            with open(self.temp_file(processor_name, library), 'w', encoding='utf-8') as f:
+                for record in nest_rows(results_dfs_concat):
+                    f.write(json.dumps(record, ensure_ascii=False))
+                    f.write('\n')
+            return
+
         # Write results_dfs_concat to csv
         logging.info(f'Writing {processor_name} output to csv...')
 
         results_dfs_concat.to_csv(
-            f'TextAnalyticsPipeline/temp/temp_{processor_name}_{library}.csv',
+            self.temp_file(processor_name, library),
             encoding='utf-8',
             index=False
         )
 
+    def get_destination(self, database_import, dataset, table, table_schema, library, proc):
+        '''
+        Returns the table the output is written to, and its schema.
+        '''
+        if database_import == True or proc in Schema.secondary_procs:
+            suff = Schema.suffixes.get(proc, 'sentiment')
+        else:
+            suff = ''
+
+        destination = f'{dataset}.{table}_{library}_{suff}'
+        if self.is_nested(proc):
+            destination, schema = f'{destination}_nested', Schema.nested_schemas[proc]
+        elif self.is_compact(proc):
+            destination, schema = f'{destination}_compact', Schema.get_schema(proc, compact=True)
+        else:
+            schema = table_schema
+
+        if self.languages is not None:
+            schema = Schema.with_language(schema)
+        return destination, schema
+
     def push_to_gbq(self, database_import, bq, project, dataset, table, table_schema, library, logging, proc):
 
-        logging.info(f'Checking if dataset {dataset} exists...')
+        self.push_args = (database_import, bq, project, dataset, table, library, logging)
 
-        dataset = f'{project}.{dataset}'
-        schema = table_schema
+        if self.sink in ('duckdb', 'parquet'):
+            if proc in self.prepared:
+                self.write_local(table, table_schema, library, proc, self.prepared.pop(proc), logging)
+            return
 
-        # Create dataset if does not exist
-        try:
-            bq.get_dataset(dataset)  # Make an API request.
-            logging.info(f'Dataset {dataset} already exists. Pushing to existing dataset...')
-        except NotFound:
-            logging.info(f'Dataset {dataset} is not found. Creating new dataset.')
-            bq.create_dataset(dataset)
-            logging.info(f'Created new dataset: {dataset}.')
+        if self.session is None:
+            self.session = DestinationSession(bq, f'{project}.{dataset}', logging)
 
-        if os.path.isfile(f'TextAnalyticsPipeline/temp/temp_{proc}_{library}.csv') == True:
+        dataset = f'{project}.{dataset}'
+
+        destination, schema = self.get_destination(database_import, dataset, table, table_schema, library, proc)
+        if self.is_compact(proc) and not self.is_nested(proc):
+            self.create_wide_view(destination[:-len('_compact')], proc, schema, logging)
+
+        if self.sink == 'spool':
+            if proc in self.prepared:
+                self.session.resolve(destination, schema)
+                self.spool_chunk(destination, schema, self.prepared.pop(proc), logging)
+                self.session.chunks += 1
+            return
+
+        if self.sink == 'storage_write':
+            if proc in self.prepared:
+                self.append_to_stream(destination, schema, self.prepared.pop(proc), logging)
+                self.session.chunks += 1
+            return
+
+        temp_file = self.temp_file(proc, library)
+        if os.path.isfile(temp_file) == True:
             logging.info(f'Pushing {proc} to BigQuery dataset: {dataset}...')
 
-            table_id = bigquery.Table(f'{dataset}.{table}')
-            try:
-                bq.get_table(table_id)
-                logging.info('Table exists')
-            except:
-                table_ = bq.create_table(table_id)
-                logging.info(f'Created table {table_.project}.{table_.dataset_id}.{table_.table_id}')
-
-            job_config = bigquery.LoadJobConfig(
-                source_format=bigquery.SourceFormat.CSV,
-                skip_leading_rows=1,
-                schema=schema,
-                max_bad_records=0
+            self.session.resolve(destination, schema)
+
+            if self.is_nested(proc):
+                job_config = bigquery.LoadJobConfig(
+                    source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+                    schema=schema,
+                    max_bad_records=0
+                )
+            else:
+                job_config = bigquery.LoadJobConfig(
+                    source_format=bigquery.SourceFormat.CSV,
+                    skip_leading_rows=1,
+                    schema=schema,
+                    max_bad_records=0
+                )
+
+                job_config.allow_quoted_newlines = True
+
+            if self.scheduler is None:
+                self.scheduler = UploadScheduler(
+                    logging,
+                    max_concurrency=SinkConf.upload_concurrency,
+                    max_retries=SinkConf.upload_max_retries,
+                    dead_letter_dir=SinkConf.dead_letter_dir
+                )
+
+            # Each scheduled chunk gets a file of its own, so the next chunk can be written while it uploads
+            root, extension = os.path.splitext(temp_file)
+            chunk_file = f'{root}_{self.uploads}{extension}'
+            os.replace(temp_file, chunk_file)
+            self.uploads += 1
+
+            self.scheduler.submit(chunk_file, destination, partial(self.load_file, destination, job_config, len(schema), proc))
+            self.session.chunks += 1
+
+    def load_file(self, destination, job_config, n_columns, proc, path):
+        with open(path, 'rb') as fh:
+            job = self.session.load(fh, destination, job_config)
+
+        logging.info(
+            f"Loaded {job.output_rows} rows and {n_columns} columns to {destination}")
+
+        logging.info(f'Results of {proc} successfully pushed to BigQuery!\n')
+
+    def append_to_stream(self, destination, schema, records, logging):
+        '''
+        Appends rows to the destination table through the Storage Write API (see storage_write.py). The table is
+        resolved by the session first, as the Storage Write API does not create tables.
+        '''
+        from .storage_write import StorageWriteClient, LocalWriteClient, StorageWriteSink
+
+        if self.write_client is None:
+            self.write_client = LocalWriteClient() if SinkConf.storage_write_local else StorageWriteClient()
+
+        if destination not in self.write_sinks:
+            if not SinkConf.storage_write_local:
+                self.session.resolve(destination, schema)
+            self.write_sinks[destination] = StorageWriteSink(
+                self.write_client, destination, schema, SinkConf.write_stream_type, logging
             )
 
-            job_config.allow_quoted_newlines = True
-
-            with open(f'TextAnalyticsPipeline/temp/temp_{proc}_{library}.csv', 'rb') as fh:
-                records = sum(1 for line in fh)
-                fh.seek(0)
-                if database_import == True:
-                    if table_schema == Schema.ner_schema:
-                        suff = 'named_entities'
-                    elif table_schema == Schema.pos_schema:
-                        suff = 'part_of_speech'
-                    elif table_schema == Schema.depparse_schema:
-                        suff = 'depparse'
-                    elif table_schema == Schema.morphology_schema:
-                        suff = 'morphology'
-                    else:
-                        suff = 'sentiment'
-                else:
-                    suff = ''
-
-                job = bq.load_table_from_file(fh, f'{dataset}.{table}_{library}_{suff}', job_config=job_config)
-                job.result()  # Waits for the job to complete.
-
-
-            table = bq.get_table(table_id)
-            logging.info(
-                f"Loaded {records} rows and {len(table.schema)} columns to {table.project}.{table.dataset_id}.{table.table_id}_{library}_{suff}")
-                # Todo (Records)
-
-            os.remove(f'TextAnalyticsPipeline/temp/temp_{proc}_{library}.csv')
-
-            logging.info(f'Results of {proc} successfully pushed to BigQuery!\n')
+        n_rows = self.write_sinks[destination].append_records(records)
+        logging.info(f'Appended {n_rows} rows to {destination}')
+
+    def spool_chunk(self, destination, schema, data, logging):
+        '''
+        Writes a chunk to the run's spool directory (see spool.py); it is loaded to BigQuery by close().
+        '''
+        from .spool import Spool
+
+        if self.spool is None:
+            self.spool = Spool.for_run(SinkConf.spool_dir, logging)
+            logging.info(f'Spooling output to {self.spool.directory}')
+
+        # The session has created the table, so the load jobs do not set clustering
+        self.spool.write(destination, schema, data)
+
+    def write_local(self, table, table_schema, library, proc, data, logging):
+        '''
+        Appends a chunk to the local sink (see local_sink.py). Tables are named as in BigQuery, always with the
+        processor suffix.
+        '''
+        from .local_sink import LOCAL_SINKS
+
+        if self.local_sink is None:
+            self.local_sink = LOCAL_SINKS[self.sink](SinkConf.local_output_path, logging)
+
+        destination, schema = self.get_destination(True, '', table, table_schema, library, proc)
+        self.local_sink.write(destination.rpartition('.')[2], schema, data)
+
+    def close(self):
+        '''
+        Finishes writing at the end of a run: loads the spooled output, and finalizes (and for pending streams
+        commits) every write stream. The summary tables are pushed first.
+        '''
+        if self.aggregates is not None and self.push_args is not None:
+            self.push_summaries()
+
+        if self.spool is not None:
+            logging.info(f'Loading spooled output from {self.spool.directory}...')
+            if not self.spool.load(self.session.bq, SinkConf.spool_gcs_uri, SinkConf.spool_load_mb):
+                logging.info(f'Not all spooled output was loaded. Retry with: python -m TextAnalyticsPipeline.spool {self.spool.directory}')
+            self.spool = None
+
+        if self.local_sink is not None:
+            self.local_sink.close()
+            self.local_sink = None
+
+        if self.scheduler is not None:
+            self.scheduler.close()
+            self.scheduler = None
+
+        for destination, sink in self.write_sinks.items():
+            n_rows = sink.close()
+            logging.info(f'Wrote {n_rows} rows to {destination} through the Storage Write API')
+        self.write_sinks = {}
+
+        if self.session is not None:
+            self.session.report()
+
+    def push_summaries(self):
+        '''
+        Pushes the summary tables of the run (see aggregates.py) through the run's sink.
+        '''
+        database_import, bq, project, dataset, table, library, logging = self.push_args
+
+        for proc, df in self.aggregates.summaries():
+            self.prepare_chunk_for_push([[df]], proc, library)
+            self.push_to_gbq(database_import, bq, project, dataset, table, Schema.get_schema(proc), library, logging, proc)
+
+    def is_compact(self, proc):
+        return self.compact and proc in Schema.schemas and Schema.schemas[proc][1] is not None
+
+    def create_wide_view(self, view_id, proc, schema, logging):
+        '''
+        Creates (once per run) a view at the table's usual name that rebuilds the wide layout from the compact table,
+        unless a table from a previous run without compact_schema already has that name.
+        '''
+        if view_id in PushTables.views_created:
+            return
+        PushTables.views_created.add(view_id)
+
+        bq = self.session.bq
+        self.session.metadata_calls += 1
+        try:
+            existing = bq.get_table(view_id)
+            if existing.table_type != 'VIEW':
+                logging.info(f'{view_id} already exists as a table. Not creating a wide view for {view_id}_compact')
+                return
+        except NotFound:
+            pass
+
+        # The compact table must exist before a view can reference it
+        self.session.resolve(f'{view_id}_compact', schema)
+
+        language = ''
+        if self.languages is not None:
+            language = ', w.language' if proc == 'depparse' else ', language'
+        view_sql = WIDE_VIEW_SQL[proc].format(compact=f'{view_id}_compact', language=language)
+        bq.query(f'CREATE OR REPLACE VIEW `{view_id}` AS {view_sql}').result()
+        logging.info(f'Created view {view_id} in the wide layout of {view_id}_compact')
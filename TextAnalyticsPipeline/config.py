@@ -35,9 +35,27 @@ class InputConf:
     from_csv = config['from_csv']
     id_column = config['id_column']
     text_column = config['text_column']
+    input_format = config.get('input_format', 'raw')    # raw, sentences, tokens or token_lists (Stanza only)
+
+    # Optional filters pushed into the input query (from_database only); validated by ValidateParams
+    where = config.get('where', '')                                 # SQL condition on the input table, e.g. "platform = 'twitter'"
+    tablesample_percent = config.get('tablesample_percent', 0)      # Read a random sample of this percentage of the table's storage blocks (0 for all)
+    limit = config.get('limit', 0)                                  # Maximum number of documents (0 for no limit)
+    order_by = config.get('order_by', '')                           # Columns to order by, e.g. 'created_at DESC'
+    min_text_length = config.get('min_text_length', 0)              # Minimum LENGTH(text) in characters (0 for no minimum)
+    max_text_length = config.get('max_text_length', 0)              # Maximum LENGTH(text) in characters (0 for no maximum)
 
 class ProcessorClass:
 
+    # Stanza processors needed for each processor name
+    processor_classes = {
+        'ner': 'ner',
+        'pos': 'lemma, pos',
+        'depparse': 'lemma, pos, depparse',
+        'sentiment': 'sentiment',
+        'morphology': 'lemma, pos'
+    }
+
     def get_processor_class(self):
 
         ner = config['named_entity_recognition']
@@ -75,13 +93,30 @@ class ProcessorClass:
 
         return processor_class, processor_name
     
+class PreprocessConf:
+    # Optional input pre-processing and junk filter; off by default, so documents reach the model unchanged. See preprocess.py
+    enabled = config.get('preprocess', False)
+    normalise_whitespace = config.get('normalise_whitespace', True)     # Replace control characters and unusual whitespace with spaces
+    min_words = config.get('min_words', 1)                              # Reject documents with fewer words (URLs not counted)
+    min_alpha_ratio = config.get('min_alpha_ratio', 0.0)                # Reject documents with a lower share of letters among non-space characters
+
 class Language:
+    # Optional per-document language detection, used with language: 'auto' (stanza and spacy); see language_router.py
+    detector = config.get('language_detector', 'stanza')           # 'stanza' (langid model) or 'fasttext' (model at fasttext_model_path)
+    fasttext_model_path = config.get('fasttext_model_path', '')     # e.g. lid.176.ftz
+    languages = config.get('languages', [])                         # Languages to detect ([] for every language the detector knows)
+    fallback_language = config.get('fallback_language', 'en')       # For empty documents, other languages, and languages with no model installed
+    model_memory_mb = config.get('model_memory_mb', 0)              # Memory for loaded models (0 for no limit); the least recently used is unloaded
 
     def get_language(self):
 
         lang = config['language']
         return lang
 
+    @classmethod
+    def detect(cls):
+        return config['language'] == 'auto'
+
 class Library:
 
     def get_library(self):
@@ -89,6 +124,7 @@ class Library:
         l_stanza = config['stanza']
         l_spacy = config['spacy']
         l_nltk = config['nltk']
+        l_corenlp = config.get('corenlp', False)
     
         # If any of ner, pos, or sentiment are True, then set processor_class to whichever is True
         if l_stanza == True:
@@ -97,14 +133,104 @@ class Library:
             library = 'spacy'
         elif l_nltk == True:
             library = 'nltk'
+        elif l_corenlp == True:
+            library = 'corenlp'
         else:
             library = None
 
         # If more than once of processor_class is True, then exit
-        if [l_stanza, l_spacy, l_nltk].count(True) > 1:
+        if [l_stanza, l_spacy, l_nltk, l_corenlp].count(True) > 1:
             print("\nMore than one library is True. Please set only one to True.")
             exit()
         else:
             pass
 
         return library
+
+class Performance:
+    # Optional settings; older config files without these keys fall back to the defaults
+    batch_size = config.get('batch_size', 200)      # Number of documents passed to the model at once
+    n_process = config.get('n_process', 0)          # Number of worker processes for spaCy and NLTK (0 uses every available CPU)
+    max_memory_mb = config.get('max_memory_mb', 0)  # Resident memory budget; batches shrink as it is approached (0 for no limit)
+    torch_threads = config.get('torch_threads', 0)  # Torch intra-op threads for Stanza (0 for torch's default)
+    tuned_profile = config.get('tuned_profile', 'TextAnalyticsPipeline/config/tuned_profile.yml')   # Written by autotune.py ('' to ignore)
+
+    # Settings a tuned profile can override
+    tunable = ('batch_size', 'n_process', 'torch_threads')
+
+    @classmethod
+    def apply_profile(cls, library, processor_name):
+        '''
+        Sets batch_size, n_process and torch_threads to the tuned settings for the library and processor if
+        autotune.py has written them, otherwise to the values in config.yml. Returns the tuned settings used.
+        '''
+        tuned = {}
+        if cls.tuned_profile and os.path.isfile(cls.tuned_profile):
+            with open(cls.tuned_profile, encoding='utf-8') as f:
+                profile = yaml.safe_load(f) or {}
+            tuned = (profile.get(library) or {}).get(processor_name) or {}
+
+        defaults = {'batch_size': 200, 'n_process': 0, 'torch_threads': 0}
+        for key in cls.tunable:
+            setattr(cls, key, tuned.get(key, config.get(key, defaults[key])))
+        return tuned
+
+    @classmethod
+    def processes(cls):
+        '''
+        Number of worker processes n_process stands for (0 is every available CPU).
+        '''
+        return cls.n_process or os.cpu_count() or 1
+
+class CoreNLPConf:
+    # Only used when corenlp: True. If no server is running at url, one is started from corenlp_home
+    url = config.get('corenlp_url', 'http://localhost:9000')
+    corenlp_home = config.get('corenlp_home') or os.environ.get('CORENLP_HOME')
+    memory = config.get('corenlp_memory', '4g')
+    docs_per_request = config.get('corenlp_docs_per_request', 20)   # Documents joined into each request
+    max_in_flight = config.get('corenlp_max_in_flight', 4)          # Concurrent requests (and server threads)
+
+class SpacyConf:
+    # Optional DocBin storage; see spacy_docbin.py
+    docbin_dir = config.get('docbin_dir', '')                       # Directory to save processed Docs to ('' to disable)
+    docbin_shard_size = config.get('docbin_shard_size', 1000)       # Docs per DocBin shard
+    derive_from_docbin = config.get('derive_from_docbin', False)    # Derive tables from docbin_dir instead of running the model
+
+class StanzaConf:
+    # Dynamic int8 quantisation of Stanza models (CPU only); check accuracy with: python -m TextAnalyticsPipeline.benchmark quantization
+    quantize = config.get('stanza_quantize', [])    # Processors whose Linear and LSTM layers are quantised, e.g. ['pos', 'depparse', 'ner']
+
+class SinkConf:
+    # Where and how output tables are written; see storage_write.py, spool.py and local_sink.py
+    sink = config.get('sink', 'load_job')                                   # 'load_job' (one load job per chunk), 'storage_write', 'spool', or local 'duckdb'/'parquet'
+    write_stream_type = config.get('write_stream_type', 'committed')        # 'committed' (visible on append) or 'pending' (visible at the end)
+    storage_write_local = config.get('storage_write_local', False)          # Use the in-memory stand-in instead of BigQuery (offline testing)
+    upload_concurrency = config.get('upload_concurrency', 4)                # Maximum load jobs in flight (adjusted down on rate limits)
+    upload_max_retries = config.get('upload_max_retries', 6)                # Retries of a chunk after transient errors
+    dead_letter_dir = config.get('dead_letter_dir', 'TextAnalyticsPipeline/dead_letter')   # Chunks that cannot be loaded are moved here
+    local_output_path = config.get('local_output_path', 'TextAnalyticsPipeline/output/results.duckdb')   # DuckDB file, or directory for parquet
+    spool_dir = config.get('spool_dir', 'TextAnalyticsPipeline/spool')     # Parent directory of the per-run spool directories
+    spool_gcs_uri = config.get('spool_gcs_uri', '')                         # gs://bucket/prefix to stage shards for one multi-URI load ('' loads local files)
+    spool_load_mb = config.get('spool_load_mb', 1024)                       # Without spool_gcs_uri, shards are combined into loads of up to this size
+
+    @classmethod
+    def is_local(cls):
+        return cls.sink in ('duckdb', 'parquet')
+
+class FakeBigQueryConf:
+    # In-process stand-in for the BigQuery client, for offline end-to-end testing; see fake_bigquery.py
+    enabled = config.get('fake_bigquery', False)
+    path = config.get('fake_bigquery_path', 'TextAnalyticsPipeline/output/fake_bigquery.duckdb')
+    latency = config.get('fake_bigquery_latency', 0.0)                      # Seconds added to every API call
+    error_rate = config.get('fake_bigquery_error_rate', 0.0)                # Fraction of queries and loads failing with a rate limit
+    load_jobs_per_table = config.get('fake_bigquery_load_jobs_per_table', 0)   # Load job quota per table (0 for none)
+    seed_csv = config.get('fake_bigquery_seed_csv', '')                     # csv loaded as the input table (defaults to the input csv with from_csv)
+
+class OutputConf:
+    # Optional settings for the shape of the output tables
+    morphology_features_table = config.get('morphology_features_table', False)    # Also write every feature to a long-format _morphology_features table
+    compact_schema = config.get('compact_schema', False)                          # Load token tables in the compact schema, with views in the wide layout
+    nested_schema = config.get('nested_schema', False)                            # Load token tables as one row per document with nested sentences and tokens
+    partition_type = config.get('partition_type', 'DAY')                          # Ingestion-time partitioning of new output tables ('' for none)
+    summary_tables = config.get('summary_tables', False)                          # Also write _summary tables of entity and lemma/UPOS counts (see aggregates.py)
+    summary_max_keys = config.get('summary_max_keys', 500000)                     # Summary keys held in memory before they are spilled to the temp directory
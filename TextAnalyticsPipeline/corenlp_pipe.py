@@ -1,8 +1,394 @@
+'''
+Uses a Stanford CoreNLP server to process documents for:
+    - named entity recognition
+    - part-of-speech tagging
+    - dependency parsing
+    - morphology (features derived from the Penn Treebank tags; English only)
+
+The pipeline either starts a local CoreNLP server (CORENLP_HOME or corenlp_home in config.yml must point at the
+unzipped CoreNLP distribution) or talks to an already running server, or a test stand-in, at corenlp_url.
+
+Several documents are joined into each request, separated by blank lines that force a sentence break, and several
+requests are kept in flight over a persistent HTTP connection pool. Sentences are mapped back to their documents using
+the character offsets returned by the server.
+
+Documentation: https://stanfordnlp.github.io/CoreNLP/corenlp-server.html
+'''
+
 import os
+import json
+import time
+import subprocess
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
 import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
 
-from .bigquery_tools import Schema
+from .bigquery_tools import Schema, PushTables
+from .config import CoreNLPConf
 from .data_processor import ProcessResults
+from .morphology import MORPHOLOGY_FEATURES
+from .tagsets import PTB_TO_UPOS, PTB_TO_FEATS
+
+
+# Separator placed between documents in a request; with ssplit.newlineIsSentenceBreak=two it always ends a sentence
+DOCUMENT_SEPARATOR = '\n\n'
+
+def get_annotators(processor_class):
+    '''
+    Maps the processor_class from config.py to the CoreNLP annotators required to produce it.
+    '''
+    annotators = ['tokenize', 'ssplit', 'pos', 'lemma']
+    if processor_class == 'ner':
+        annotators.append('ner')
+    elif processor_class == 'lemma, pos, depparse':
+        annotators.append('depparse')
+
+    return ','.join(annotators)
+
+
+class CoreNLPServer:
+    '''
+    Starts a local CoreNLP server with the required annotators preloaded, and stops it when the pipeline finishes.
+    '''
+
+    def __init__(self, url, annotators, corenlp_home, memory, threads, logging):
+        self.url = url
+        self.annotators = annotators
+        self.corenlp_home = corenlp_home
+        self.memory = memory
+        self.threads = threads
+        self.logging = logging
+        self.process = None
+
+    def is_ready(self):
+        try:
+            return requests.get(f'{self.url}/ready', timeout=2).ok
+        except requests.exceptions.RequestException:
+            return False
+
+    def start(self, timeout=120):
+        if self.is_ready():
+            self.logging.info(f'Using running CoreNLP server at {self.url}')
+            return
+
+        if not self.corenlp_home:
+            self.logging.info('No CoreNLP server running and CORENLP_HOME is not set. Exiting.')
+            exit()
+
+        port = urlparse(self.url).port or 9000
+        command = [
+            'java', f'-mx{self.memory}', '-cp', os.path.join(self.corenlp_home, '*'),
+            'edu.stanford.nlp.pipeline.StanfordCoreNLPServer',
+            '-port', str(port),
+            '-timeout', '120000',
+            '-threads', str(self.threads),
+            '-preload', self.annotators,
+            '-quiet'
+        ]
+        self.logging.info(f'Starting CoreNLP server on port {port}...')
+        self.process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        start = time.time()
+        while not self.is_ready():
+            if self.process.poll() is not None or time.time() - start > timeout:
+                self.logging.info('CoreNLP server failed to start. Exiting.')
+                self.stop()
+                exit()
+            time.sleep(1)
+        self.logging.info('CoreNLP server ready')
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+
+
+class CoreNLPClient:
+    '''
+    Sends batches of documents to the server over a pooled, keep-alive HTTP session.
+    '''
+
+    def __init__(self, url, annotators, lang, pool_size):
+        self.url = url
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=3)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        properties = {
+            'annotators': annotators,
+            'outputFormat': 'json',
+            'ssplit.newlineIsSentenceBreak': 'two'
+        }
+        if lang != 'en':
+            properties['pipelineLanguage'] = lang
+        self.params = {'properties': json.dumps(properties)}
+
+    def annotate_batch(self, batch):
+        '''
+        Annotates a batch of (identifier, document) pairs in a single request. Returns a list of
+        (identifier, document, sentences) where each sentence's offsets are relative to its own document.
+        '''
+        documents = [document for _, document in batch]
+        text = DOCUMENT_SEPARATOR.join(documents)
+
+        response = self.session.post(self.url, params=self.params, data=text.encode('utf-8'), timeout=600)
+        response.raise_for_status()
+        sentences = response.json()['sentences']
+
+        # CoreNLP offsets count UTF-16 code units, so document start offsets are computed the same way
+        separator_len = utf16_len(DOCUMENT_SEPARATOR)
+        doc_starts = []
+        offset = 0
+        for document in documents:
+            doc_starts.append(offset)
+            offset += utf16_len(document) + separator_len
+
+        doc_sentences = [[] for _ in documents]
+        for sentence in sentences:
+            if len(sentence['tokens']) == 0:
+                continue
+            doc_index = bisect_right(doc_starts, sentence['tokens'][0]['characterOffsetBegin']) - 1
+            doc_sentences[doc_index].append(sentence)
+
+        results = []
+        for (id, document), doc_start, sentences in zip(batch, doc_starts, doc_sentences):
+            to_index = utf16_index_map(document)
+            for sentence in sentences:
+                for item in sentence['tokens'] + sentence.get('entitymentions', []):
+                    begin = item['characterOffsetBegin'] - doc_start
+                    end = item['characterOffsetEnd'] - doc_start
+                    item['start_char'] = to_index[begin] if to_index else begin
+                    item['end_char'] = to_index[end] if to_index else end
+            results.append((id, document, sentences))
+
+        return results
+
+    def close(self):
+        self.session.close()
+
+
+def utf16_len(text):
+    return len(text.encode('utf-16-le')) // 2
+
+
+def utf16_index_map(text):
+    '''
+    Returns a list mapping UTF-16 offsets to Python string offsets, or None when the text has no characters outside
+    the Basic Multilingual Plane (e.g. emoji), in which case the offsets are identical.
+    '''
+    if all(ord(char) < 0x10000 for char in text):
+        return None
+
+    index_map = []
+    for i, char in enumerate(text):
+        index_map.append(i)
+        if ord(char) >= 0x10000:
+            index_map.append(i)
+    index_map.append(len(text))
+
+    return index_map
+
+
+def extract_ner(sentences):
+    entities_list = []
+    for sentence in sentences:
+        for mention in sentence.get('entitymentions', []):
+            entities_list.append({
+                'text': mention['text'],
+                'type': mention['ner'],
+                'start_char': mention['start_char'],
+                'end_char': mention['end_char']
+            })
+
+    return entities_list
+
+
+def extract_pos(id, sentences):
+    tokens_list = []
+    for sentence_num, sentence in enumerate(sentences, start=1):
+        for token in sentence['tokens']:
+            tokens_list.append({
+                'sentence_num': sentence_num,
+                'word_num': token['index'],
+                'word_id': f'{id}_{sentence_num}_{token["index"]}',
+                'word': token['originalText'],
+                'lemma': token['lemma'],
+                'upos': PTB_TO_UPOS.get(token['pos'], 'X'),
+                'xpos': token['pos'],
+                'start_char': token['start_char'],
+                'end_char': token['end_char']
+            })
+
+    return tokens_list
+
+
+def extract_depparse(id, sentences):
+    dependency_info = []
+    for sentence_num, sentence in enumerate(sentences, start=1):
+        tokens = sentence['tokens']
+
+        # Root words are their own head, matching the spaCy and Stanza output
+        heads = {}
+        for dependency in sentence['basicDependencies']:
+            governor = dependency['governor'] or dependency['dependent']
+            heads[dependency['dependent']] = (dependency['dep'], governor)
+
+        for token in tokens:
+            relation, head_num = heads.get(token['index'], ('dep', token['index']))
+            head_token = tokens[head_num - 1]
+            dependency_info.append({
+                'sentence_num': sentence_num,
+                'word_num': token['index'],
+                'word_id': f'{id}_{sentence_num}_{token["index"]}',
+                'word_text': token['originalText'],
+                'word_lemma': token['lemma'],
+                'word_start_char': token['start_char'],
+                'word_end_char': token['end_char'],
+                'relation': relation,
+                'head_num': head_num,
+                'head_id': f'{id}_{sentence_num}_{head_num}',
+                'head_text': head_token['originalText'],
+                'head_lemma': head_token['lemma'],
+                'head_start_char': head_token['start_char'],
+                'head_end_char': head_token['end_char']
+            })
+
+    return dependency_info
+
+
+def extract_morphology(id, sentences):
+    morphology_info = []
+    for sentence_num, sentence in enumerate(sentences, start=1):
+        for token in sentence['tokens']:
+            feats = PTB_TO_FEATS.get(token['pos'], {})
+            morphology_row = {
+                'sentence_num': sentence_num,
+                'word_num': token['index'],
+                'word_id': f'{id}_{sentence_num}_{token["index"]}',
+                'word': token['originalText'],
+                'lemma': token['lemma']
+            }
+            for feature in MORPHOLOGY_FEATURES:
+                morphology_row[f'features_{feature}'] = feats.get(feature)
+            morphology_row['start_char'] = token['start_char']
+            morphology_row['end_char'] = token['end_char']
+            morphology_info.append(morphology_row)
+
+    return morphology_info
+
+
+def process_annotations(processor_name, id, sentences):
+    '''
+    Converts the annotated sentences of one document to a dataframe in the output table layout, or None if the
+    document produced no rows.
+    '''
+    result_processor = ProcessResults()
+
+    if processor_name == 'ner':
+        rows = extract_ner(sentences)
+        return result_processor.process_ner(id, pd.DataFrame(rows)) if rows else None
+    elif processor_name == 'pos':
+        rows = extract_pos(id, sentences)
+        return result_processor.process_pos(id, pd.DataFrame(rows)) if rows else None
+    elif processor_name == 'depparse':
+        rows = extract_depparse(id, sentences)
+        return result_processor.process_depparse(id, pd.DataFrame(rows)) if rows else None
+    elif processor_name == 'morphology':
+        rows = extract_morphology(id, sentences)
+        return result_processor.process_morphology(id, pd.DataFrame(rows)) if rows else None
+
+
+def run_corenlp_pipeline(chunk, n_docs, bq, identifiers, documents, lang, library, processor_class, processor_name, logging, database_import, project, dataset, table, result_dfs):
+
+    if processor_name == 'ner':
+        table_schema = Schema.ner_schema
+    elif processor_name == 'pos':
+        table_schema = Schema.pos_schema
+    elif processor_name == 'depparse':
+        table_schema = Schema.depparse_schema
+    elif processor_name == 'morphology':
+        table_schema = Schema.morphology_schema
+    else:
+        logging.info(f'CoreNLP does not support {processor_name}. Exiting.')
+        return
+
+    conf = CoreNLPConf()
+    annotators = get_annotators(processor_class)
+
+    server = CoreNLPServer(conf.url, annotators, conf.corenlp_home, conf.memory, conf.max_in_flight, logging)
+    server.start()
+    client = CoreNLPClient(conf.url, annotators, lang, conf.max_in_flight)
+
+    push_tables = PushTables()
+
+    def push_chunk(result_dfs):
+        push_tables.prepare_chunk_for_push(result_dfs, processor_name, library)
+        push_tables.push_to_gbq(
+            database_import,
+            bq,
+            project,
+            dataset,
+            table,
+            table_schema,
+            library,
+            logging,
+            proc=processor_name
+        )
+
+    def handle_results(results, count, result_dfs):
+        for id, document, sentences in results:
+
+            # Count keeps track of the number of documents processed
+            count = count + 1
+
+            df = process_annotations(processor_name, id, sentences)
+            if df is not None:
+                result_dfs.append([df])
+
+        logging.info(f'Processed {count} of {n_docs} documents')
+
+        # Check len of result_dfs and if len(result_dfs) >= chunk, push chunk to BigQuery
+        if len(result_dfs) >= chunk:
+            push_chunk(result_dfs)
+            result_dfs = []
+
+        return count, result_dfs
+
+    logging.info(f'Processing documents for {processor_name} with annotators {annotators}, '
+                 f'{conf.docs_per_request} documents per request and {conf.max_in_flight} requests in flight...')
+
+    pairs = list(zip(identifiers, documents))
+    batches = (pairs[i:i + conf.docs_per_request] for i in range(0, len(pairs), conf.docs_per_request))
+
+    try:
+        count = 0
+        in_flight = deque()
+        with ThreadPoolExecutor(max_workers=conf.max_in_flight) as executor:
+            for batch in batches:
+                in_flight.append(executor.submit(client.annotate_batch, batch))
+
+                # Once the pool is full, wait for the oldest request so results are handled in input order. After
+                # the last batch is submitted, drain the remaining requests.
+                while len(in_flight) >= conf.max_in_flight:
+                    count, result_dfs = handle_results(in_flight.popleft().result(), count, result_dfs)
+
+            while in_flight:
+                count, result_dfs = handle_results(in_flight.popleft().result(), count, result_dfs)
+
+        # Push any remaining results
+        if len(result_dfs) > 0:
+            push_chunk(result_dfs)
+
+        # Finish any open write streams
+        push_tables.close()
 
-def run_corenlp_pipeline(identifiers, documents, lang, processor_class, processor_name, logging):
-    pass
\ No newline at end of file
+    finally:
+        client.close()
+        server.stop()
@@ -123,3 +123,47 @@ class ProcessResults:
 
         return morphology_df
 
+    def process_sentiment(self, id, df):
+        '''
+        For Sentiment: Adds a document-level aggregate row to the sentence-level results, and processes them into a
+        table with the following columns:
+            'identifier',
+            'level',
+            'sentence_num',
+            'text',
+            'sentiment',
+            'score',
+            'start_char',
+            'end_char'
+        '''
+
+        # Document score is the mean sentence score, labelled with the same thresholds as the sentences
+        score = df['score'].mean()
+        document_row = pd.DataFrame([{
+            'sentence_num': None,
+            'text': None,
+            'sentiment': sentiment_label(score),
+            'score': score,
+            'start_char': df['start_char'].min(),
+            'end_char': df['end_char'].max()
+        }])
+
+        sentiment_df = pd.concat([df, document_row], ignore_index=True)
+        sentiment_df.insert(0, 'level', ['sentence'] * len(df) + ['document'])
+        sentiment_df.insert(0, 'identifier', id)
+        sentiment_df.columns = ['identifier', 'level', 'sentence_num', 'text', 'sentiment', 'score', 'start_char', 'end_char']
+        sentiment_df['sentence_num'] = sentiment_df['sentence_num'].astype('Int64')
+
+        return sentiment_df
+
+
+def sentiment_label(score, threshold=0.05):
+    '''
+    Labels a sentiment score between -1 and 1 as negative, neutral or positive.
+    '''
+    if score > threshold:
+        return 'positive'
+    elif score < -threshold:
+        return 'negative'
+    else:
+        return 'neutral'
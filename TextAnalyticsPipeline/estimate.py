@@ -0,0 +1,275 @@
+'''
+Estimates how long a run with the current config.yml will take and how much it will write, before launching it.
+
+The number and length distribution of the input documents come from one aggregate query over the input query (or
+from the input csv). A stratified sample is drawn from each length bucket, all buckets in one query. When the sample
+needs only a small share of the input, that query reads a TABLESAMPLE of it, and any bucket the table sample leaves
+short is sampled from the whole input in one more query. The configured library and processor
+are run on each bucket's sample with the current batch_size, n_process and hardware. Output goes to an in-memory fake
+BigQuery client (see fake_bigquery.py), so nothing is written to BigQuery. The time, output rows and upload bytes
+measured for each bucket are scaled up to the number of documents in the bucket.
+
+Usage (from the repository root):
+    python -m TextAnalyticsPipeline.estimate --sample-size 300
+'''
+
+import time
+import logging
+import argparse
+
+import numpy as np
+
+from .config import InputConf, SinkConf, SpacyConf, Performance
+from .bigquery_tools import GBQCreds, QueryGBQ
+from .fake_bigquery import FakeBigQueryClient
+from .preprocess import preprocess_documents
+from .set_up_logging import set_up_logging
+from .validate_params import ValidateParams
+from .perform_analysis import get_processor_params, get_input_params, apply_tuned_profile, run_library_pipeline
+
+
+# Lower bounds of the document length buckets, in characters; the last bucket is open-ended
+LENGTH_BUCKETS = [0, 64, 128, 256, 512, 1024, 2048, 4096, 8192]
+
+# Chunk size as in run_text_pipeline
+CHUNK = 20
+
+# The sample query reads a TABLESAMPLE of this many times the share of the input the sample needs, if that is less
+# than MAX_SAMPLE_FRACTION of the input
+OVERSAMPLE = 10
+MAX_SAMPLE_FRACTION = 0.5
+
+
+def bucket_sql(text_column):
+    cases = ' '.join(f'WHEN LENGTH({text_column}) < {upper} THEN {i}' for i, upper in enumerate(LENGTH_BUCKETS[1:]))
+    return f'CASE {cases} ELSE {len(LENGTH_BUCKETS) - 1} END'
+
+
+def bucket_label(bucket):
+    if bucket == len(LENGTH_BUCKETS) - 1:
+        return f'{LENGTH_BUCKETS[bucket]}+'
+    return f'{LENGTH_BUCKETS[bucket]}-{LENGTH_BUCKETS[bucket + 1] - 1}'
+
+
+def allocate(population, sample_size):
+    '''
+    Splits the sample between the buckets in proportion to their number of documents, with at least one document
+    from every bucket.
+    '''
+    total = sum(n_docs for n_docs, _ in population.values())
+    return {bucket: min(n_docs, max(1, round(sample_size * n_docs / total))) for bucket, (n_docs, _) in population.items()}
+
+
+def population_from_database(bq, query_string, text_column):
+    '''
+    Returns {bucket: (documents, characters)} for the documents the input query selects.
+    '''
+    df = bq.query(f'''
+        SELECT {bucket_sql(text_column)} AS bucket, COUNT(*) AS n_docs, SUM(LENGTH({text_column})) AS n_chars
+        FROM ({query_string}) AS input
+        GROUP BY bucket''').result().to_dataframe()
+    return {int(row.bucket): (int(row.n_docs), int(row.n_chars)) for row in df.itertuples()}
+
+
+def sample_from_database(bq, query_string, id_column, text_column, allocation):
+    '''
+    Returns {bucket: (identifiers, documents)} with a random sample of up to allocation[bucket] documents from each
+    bucket, drawn in one query.
+    '''
+    limits = ' '.join(f'WHEN {bucket} THEN {k}' for bucket, k in sorted(allocation.items()))
+    df = bq.query(f'''
+        SELECT {id_column}, {text_column}, bucket
+        FROM (
+            SELECT {id_column}, {text_column}, {bucket_sql(text_column)} AS bucket
+            FROM ({query_string}) AS input
+        ) AS bucketed
+        WHERE bucket IN ({', '.join(str(bucket) for bucket in sorted(allocation))})
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY bucket ORDER BY RAND()) <= CASE bucket {limits} END''').result().to_dataframe()
+
+    samples = {}
+    for bucket, bucket_df in df.groupby('bucket'):
+        samples[int(bucket)] = (bucket_df[id_column].tolist(), bucket_df[text_column].tolist())
+    return samples
+
+
+def sample_percent(population, allocation):
+    '''
+    Percentage of the input's storage blocks the sample query reads, or None to read all of it.
+    '''
+    fraction = OVERSAMPLE * sum(allocation.values()) / sum(n_docs for n_docs, _ in population.values())
+    if fraction >= MAX_SAMPLE_FRACTION:
+        return None
+
+    # A configured table sample is sampled further
+    return 100 * fraction * (InputConf.tablesample_percent / 100 if InputConf.tablesample_percent else 1)
+
+
+def samples_from_database(bq, gbqq, project, dataset, table, id_column, text_column, population, sample_size):
+    '''
+    Returns a sample of (identifiers, documents) from each bucket of the input query, in one query over a table sample
+    of the input when the sample needs a small share of it, and one over the whole input for the buckets left short.
+    '''
+    allocation = allocate(population, sample_size)
+
+    samples = {}
+    percent = sample_percent(population, allocation)
+    if percent is not None:
+        sampled_query = gbqq.build_query(project, dataset, table, id_column, text_column, tablesample_percent=percent)
+        samples = sample_from_database(bq, sampled_query, id_column, text_column, allocation)
+
+    short = {bucket: k for bucket, k in allocation.items() if len(samples.get(bucket, ([], []))[0]) < k}
+    if short:
+        if percent is not None:
+            logging.info(f'{len(short)} length buckets have too few documents in a {percent:.3g}% table sample; '
+                         f'sampling them from the whole input')
+        samples.update(sample_from_database(bq, gbqq.build_query(project, dataset, table, id_column, text_column),
+                                            id_column, text_column, short))
+
+    return samples
+
+
+def samples_from_csv(df, id_column, text_column, sample_size):
+    '''
+    Returns the population of each bucket and a sample of (identifiers, documents) from each.
+    '''
+    df = df.dropna(subset=[text_column])
+    lengths = df[text_column].astype(str).str.len()
+    buckets = np.searchsorted(LENGTH_BUCKETS, lengths, side='right') - 1
+
+    population = {}
+    for bucket in np.unique(buckets):
+        population[int(bucket)] = (int((buckets == bucket).sum()), int(lengths[buckets == bucket].sum()))
+
+    samples = {}
+    for bucket, k in allocate(population, sample_size).items():
+        sample = df[buckets == bucket].sample(k, random_state=0)
+        samples[bucket] = (sample[id_column].tolist(), sample[text_column].tolist())
+
+    return population, samples
+
+
+def draw_sample(sample_size, project, dataset, table, id_column, text_column, database_import):
+    '''
+    Reads the population of each length bucket of the input, and a stratified sample of (identifiers, documents)
+    from each bucket. Returns the validated project, dataset and table, the population and the samples.
+    '''
+    gbqq = QueryGBQ()
+    if database_import == True:
+        gbq_creds = GBQCreds()
+        gbq_creds.get_gbq_creds(project)
+        bq = gbq_creds.get_client(project)
+
+        vdp = ValidateParams()
+        project, dataset, table = vdp.validate_project_parameters(project, dataset, table, bq)
+        query_bytes = vdp.validate_query_parameters(project, dataset, table, id_column, text_column, bq)
+
+        input_table = bq.get_table(f'{project}.{dataset}.{table}')
+        logging.info(f'Input table: {input_table.num_rows} rows; the input query will scan {query_bytes / 1024 ** 2:.1f} MB')
+
+        query_string = gbqq.build_query(project, dataset, table, id_column, text_column)
+        population = population_from_database(bq, query_string, text_column)
+        samples = samples_from_database(bq, gbqq, project, dataset, table, id_column, text_column, population,
+                                        sample_size)
+    else:
+        _, df = gbqq.read_csv_from_file(logging)
+        population, samples = samples_from_csv(df, id_column, text_column, sample_size)
+
+    return project, dataset, table, population, samples
+
+
+def loaded(bq):
+    return {table: tuple(counts) for table, counts in bq.loaded.items()}
+
+
+def run_sample(params, bq, identifiers, documents):
+    '''
+    Runs the configured processor on the documents, writing to the fake client bq. Returns the seconds taken, and the
+    rows and bytes loaded to each output table.
+    '''
+    library, processor_class, processor_name, lang, database_import, project, dataset, table = params
+
+    before = loaded(bq)
+    start = time.perf_counter()
+
+    identifiers, documents, _ = preprocess_documents(identifiers, documents, logging)
+    if len(documents) > 0:
+        run_library_pipeline(library, CHUNK, len(documents), bq, identifiers, documents, lang, processor_class,
+                             processor_name, database_import, project, dataset, table)
+
+    seconds = time.perf_counter() - start
+    output = {}
+    for table_id, (rows, n_bytes) in loaded(bq).items():
+        rows_before, bytes_before = before.get(table_id, (0, 0))
+        output[table_id] = (rows - rows_before, n_bytes - bytes_before)
+
+    return seconds, output
+
+
+def estimate(sample_size):
+    processor_class, processor_name, lang, library = get_processor_params()
+    project, dataset, table, id_column, text_column, database_import = get_input_params()
+    set_up_logging('TextAnalyticsPipeline/logs', library, f'{processor_name}_estimate')
+
+    if library == 'spacy' and SpacyConf.derive_from_docbin:
+        logging.info('Nothing to estimate: with derive_from_docbin no model is run. Exiting.')
+        return
+
+    # Output is counted as it would be loaded; local and Storage Write API sinks are measured as load jobs
+    if SinkConf.sink not in ('load_job', 'spool'):
+        logging.info(f'Measuring output with the load_job sink instead of {SinkConf.sink}; upload bytes are those of '
+                     f'the CSV or JSON load files.')
+        SinkConf.sink = 'load_job'
+
+    project, dataset, table, population, samples = draw_sample(sample_size, project, dataset, table, id_column,
+                                                               text_column, database_import)
+
+    n_docs = sum(n for n, _ in population.values())
+    if n_docs == 0:
+        logging.info('The input has no documents. Exiting.')
+        return
+    logging.info(f'Sampling {sum(len(ids) for ids, _ in samples.values())} of {n_docs} documents from '
+                 f'{len(samples)} length buckets')
+
+    params = (library, processor_class, processor_name, lang, database_import, project, dataset, table)
+    apply_tuned_profile(library, processor_name)
+
+    # Warm-up: load the models (kept for the timed runs) on a few documents, writing to a separate fake client
+    warmup_ids, warmup_docs = max(samples.values(), key=lambda sample: len(sample[0]))
+    load_seconds, _ = run_sample(params, FakeBigQueryClient(':memory:', project), warmup_ids[:5], warmup_docs[:5])
+
+    # Timed runs, one per bucket, scaled up to the bucket's size
+    output_bq = FakeBigQueryClient(':memory:', project)
+    total_seconds = 0
+    total_output = {}
+    logging.info(f'{"length":>10} {"documents":>10} {"sampled":>8} {"s/doc":>8} {"est. hours":>11}')
+    for bucket, (bucket_ids, bucket_docs) in sorted(samples.items()):
+        seconds, output = run_sample(params, output_bq, bucket_ids, bucket_docs)
+
+        scale = population[bucket][0] / len(bucket_ids)
+        total_seconds += seconds * scale
+        for table_id, (rows, n_bytes) in output.items():
+            total_rows, total_bytes = total_output.get(table_id, (0, 0))
+            total_output[table_id] = (total_rows + rows * scale, total_bytes + n_bytes * scale)
+
+        logging.info(f'{bucket_label(bucket):>10} {population[bucket][0]:>10} {len(bucket_ids):>8} '
+                     f'{seconds / len(bucket_ids):>8.3f} {seconds * scale / 3600:>11.2f}')
+
+    perf = Performance()
+    logging.info(f'Estimate for {library} {processor_name} over {n_docs} documents '
+                 f'(batch_size {perf.batch_size}, n_process {perf.n_process}):')
+    logging.info(f'  model loading: {load_seconds:.0f} s (includes {min(5, len(warmup_ids))} documents)')
+    logging.info(f'  processing and upload: {total_seconds / 3600:.2f} hours ({n_docs / total_seconds:.1f} docs/s)')
+    for table_id, (rows, n_bytes) in sorted(total_output.items()):
+        logging.info(f'  {table_id}: {rows:,.0f} rows, {n_bytes / 1024 ** 2:,.1f} MB uploaded')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Estimate the run time and output size of the configured run.')
+    parser.add_argument('--sample-size', type=int, default=300, help='Number of documents to process (default 300)')
+    args = parser.parse_args()
+
+    estimate(args.sample_size)
+
+
+if __name__ == '__main__':
+    main()
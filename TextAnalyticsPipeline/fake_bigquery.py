@@ -0,0 +1,277 @@
+'''
+An in-process stand-in for google.cloud.bigquery.Client, backed by a DuckDB database file, for profiling and
+benchmarking the whole pipeline (querying, table resolution, serialisation and loads) without a network connection.
+Selected with fake_bigquery: True in config.yml.
+
+It implements the calls the pipeline makes: query, get_dataset, create_dataset, get_table, create_table and
+load_table_from_file (CSV, newline-delimited JSON and Parquet). Datasets are DuckDB schemas and the project part of
+table ids is ignored. Every call can be slowed by a simulated latency, loads and queries can fail with a simulated
+rate limit error, and a per-table load job quota can be enforced, to exercise the upload scheduler.
+'''
+
+import re
+import time
+import json
+import random
+import threading
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from google.api_core import exceptions
+from google.cloud import bigquery
+
+from .spool import arrow_schema, to_arrow
+
+
+# BigQuery column types for DuckDB types, for tables not created through this client
+BIGQUERY_TYPES = {'VARCHAR': 'STRING', 'BIGINT': 'INTEGER', 'INTEGER': 'INTEGER', 'DOUBLE': 'FLOAT', 'BOOLEAN': 'BOOLEAN'}
+
+
+def split_table_id(table_id):
+    '''
+    Returns (project, dataset, table) for a table id string, TableReference or Table.
+    '''
+    if not isinstance(table_id, str):
+        return table_id.project, table_id.dataset_id, table_id.table_id
+    parts = table_id.split('.')
+    if len(parts) == 2:
+        return None, parts[0], parts[1]
+    return parts[0], parts[1], parts[2]
+
+
+def dataset_name(dataset):
+    if not isinstance(dataset, str):
+        return dataset.dataset_id
+    return dataset.split('.')[-1]
+
+
+class FakeTable:
+
+    def __init__(self, project, dataset_id, table_id, schema, num_rows, table_type):
+        self.project = project
+        self.dataset_id = dataset_id
+        self.table_id = table_id
+        self.schema = schema
+        self.num_rows = num_rows
+        self.table_type = table_type
+
+
+class FakeDataset:
+
+    def __init__(self, project, dataset_id):
+        self.project = project
+        self.dataset_id = dataset_id
+
+
+class FakeRowIterator:
+
+    def __init__(self, df):
+        self.df = df
+        self.total_rows = len(df)
+
+    def to_dataframe(self, **kwargs):
+        return self.df
+
+    def __iter__(self):
+        return iter(self.df.to_dict('records'))
+
+
+class FakeJob:
+
+    def __init__(self, result=None, output_rows=None, total_bytes_processed=None):
+        self._result = result
+        self.output_rows = output_rows
+        self.total_bytes_processed = total_bytes_processed
+        self.state = 'DONE'
+
+    def result(self, *args, **kwargs):
+        return self._result
+
+
+class FakeBigQueryClient:
+
+    def __init__(self, path, project, latency=0.0, error_rate=0.0, load_jobs_per_table=0, seed=0):
+        import duckdb
+
+        self.connection = duckdb.connect(path)
+        self.project = project
+        self.latency = latency
+        self.error_rate = error_rate
+        self.load_jobs_per_table = load_jobs_per_table
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.schemas = {}
+        self.load_jobs = {}
+        self.calls = {}
+
+        # Rows and bytes loaded to each table, as [rows, bytes] (see estimate.py)
+        self.loaded = {}
+
+    def call(self, name, can_fail=False):
+        '''
+        Counts an API call, applies the simulated latency, and raises a simulated rate limit for calls that can fail.
+        '''
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            fail = can_fail and self.random.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            raise exceptions.TooManyRequests(f'Simulated rate limit on {name}')
+
+    def execute(self, sql, parameters=None):
+        with self.lock:
+            return self.connection.execute(sql, parameters or []).fetchall()
+
+    # Datasets
+
+    def get_dataset(self, dataset):
+        self.call('get_dataset')
+        name = dataset_name(dataset)
+        if not self.execute('SELECT 1 FROM information_schema.schemata WHERE schema_name = ?', [name]):
+            raise exceptions.NotFound(f'Not found: Dataset {self.project}:{name}')
+        return FakeDataset(self.project, name)
+
+    def create_dataset(self, dataset, exists_ok=False):
+        self.call('create_dataset')
+        name = dataset_name(dataset)
+        self.execute(f'CREATE SCHEMA {"IF NOT EXISTS " if exists_ok else ""}"{name}"')
+        return FakeDataset(self.project, name)
+
+    # Tables
+
+    def table_type(self, dataset, table):
+        rows = self.execute(
+            'SELECT table_type FROM information_schema.tables WHERE table_schema = ? AND table_name = ?', [dataset, table]
+        )
+        if not rows:
+            return None
+        return 'VIEW' if rows[0][0] == 'VIEW' else 'TABLE'
+
+    def get_table(self, table_id):
+        self.call('get_table')
+        project, dataset, table = split_table_id(table_id)
+        table_type = self.table_type(dataset, table)
+        if table_type is None:
+            raise exceptions.NotFound(f'Not found: Table {self.project}:{dataset}.{table}')
+
+        schema = self.schemas.get((dataset, table))
+        if schema is None:
+            columns = self.execute(f'DESCRIBE "{dataset}"."{table}"')
+            schema = [bigquery.SchemaField(name, BIGQUERY_TYPES.get(column_type, 'STRING')) for name, column_type, *_ in columns]
+        num_rows = self.execute(f'SELECT COUNT(*) FROM "{dataset}"."{table}"')[0][0]
+
+        return FakeTable(self.project, dataset, table, schema, num_rows, table_type)
+
+    def create_table(self, table, exists_ok=False):
+        self.call('create_table')
+        project, dataset, name = split_table_id(table)
+        if self.table_type(dataset, name) is not None:
+            if exists_ok:
+                return self.get_table(table)
+            raise exceptions.Conflict(f'Already Exists: Table {self.project}:{dataset}.{name}')
+
+        self.create_from_schema(dataset, name, table.schema)
+        return FakeTable(self.project, dataset, name, table.schema, 0, 'TABLE')
+
+    def create_from_schema(self, dataset, table, schema):
+        with self.lock:
+            empty = pa.Table.from_pylist([], schema=arrow_schema(schema))
+            self.connection.register('empty_table', empty)
+            self.connection.execute(f'CREATE TABLE IF NOT EXISTS "{dataset}"."{table}" AS SELECT * FROM empty_table')
+            self.connection.unregister('empty_table')
+            self.schemas[(dataset, table)] = list(schema)
+
+    # Queries
+
+    def translate(self, sql):
+        # `project.dataset.table` (or `dataset.table`) becomes "dataset"."table", and RAND() is DuckDB's random()
+        def quote(match):
+            project, dataset, table = split_table_id(match.group(1))
+            return f'"{dataset}"."{table}"'
+        sql = re.sub(r'\bRAND\(\)', 'random()', sql)
+        return re.sub(r'`([^`]+)`', quote, sql)
+
+    def query(self, query, job_config=None, **kwargs):
+        self.call('query', can_fail=True)
+
+        # A dry run only checks the query; bytes processed are not simulated
+        if job_config is not None and job_config.dry_run:
+            import duckdb
+
+            with self.lock:
+                try:
+                    self.connection.execute(f'EXPLAIN {self.translate(query)}')
+                except duckdb.Error as e:
+                    raise exceptions.BadRequest(str(e))
+            return FakeJob(total_bytes_processed=0)
+
+        with self.lock:
+            result = self.connection.execute(self.translate(query))
+            df = result.df() if result.description else pd.DataFrame()
+        return FakeJob(result=FakeRowIterator(df))
+
+    # Loads
+
+    def read_source(self, file_obj, job_config):
+        schema = job_config.schema
+        source_format = job_config.source_format
+
+        if source_format == bigquery.SourceFormat.PARQUET:
+            return pq.read_table(file_obj).cast(arrow_schema(schema))
+
+        if source_format == bigquery.SourceFormat.NEWLINE_DELIMITED_JSON:
+            records = [json.loads(line) for line in file_obj if line.strip()]
+            return to_arrow(records, schema)
+
+        df = pd.read_csv(file_obj, header=None, skiprows=job_config.skip_leading_rows or 0,
+                         names=[field.name for field in schema], keep_default_na=False, na_values=[''], dtype=object)
+        for field in schema:
+            if field.field_type in ('INTEGER', 'INT64'):
+                df[field.name] = pd.array(pd.to_numeric(df[field.name]), dtype='Int64')
+            elif field.field_type in ('FLOAT', 'FLOAT64'):
+                df[field.name] = pd.to_numeric(df[field.name])
+        return to_arrow(df, schema)
+
+    def load_table_from_file(self, file_obj, destination, job_config=None, **kwargs):
+        self.call('load_table_from_file', can_fail=True)
+        project, dataset, table = split_table_id(destination)
+
+        with self.lock:
+            jobs = self.load_jobs.get((dataset, table), 0) + 1
+            self.load_jobs[(dataset, table)] = jobs
+        if self.load_jobs_per_table and jobs > self.load_jobs_per_table:
+            raise exceptions.Forbidden(f'Quota exceeded: too many load jobs for table {dataset}.{table}',
+                                       errors=[{'reason': 'quotaExceeded'}])
+
+        start = file_obj.tell()
+        n_bytes = file_obj.seek(0, 2) - start
+        file_obj.seek(start)
+
+        arrow_table = self.read_source(file_obj, job_config)
+        if self.table_type(dataset, table) is None:
+            self.create_from_schema(dataset, table, job_config.schema)
+
+        with self.lock:
+            self.connection.register('load_source', arrow_table)
+            self.connection.execute(f'INSERT INTO "{dataset}"."{table}" BY NAME SELECT * FROM load_source')
+            self.connection.unregister('load_source')
+            loaded = self.loaded.setdefault(f'{dataset}.{table}', [0, 0])
+            loaded[0] += arrow_table.num_rows
+            loaded[1] += n_bytes
+
+        return FakeJob(output_rows=arrow_table.num_rows)
+
+    def load_csv(self, table_id, path):
+        '''
+        Creates (or replaces) a table from a csv file, e.g. to provide the input table of a run.
+        '''
+        project, dataset, table = split_table_id(table_id)
+        df = pd.read_csv(path)
+        with self.lock:
+            self.connection.execute(f'CREATE SCHEMA IF NOT EXISTS "{dataset}"')
+            self.connection.register('csv_source', df)
+            self.connection.execute(f'CREATE OR REPLACE TABLE "{dataset}"."{table}" AS SELECT * FROM csv_source')
+            self.connection.unregister('csv_source')
@@ -0,0 +1,140 @@
+'''
+Runs a list of jobs in one process, each applying one or more processors of a library to one input table. Credentials
+and the BigQuery client are resolved once, and models are loaded once and reused by every job that needs them (see
+get_pipeline in stanza_pipe.py and load_model in spacy_pipe.py). Every run writes its own temp files, spool directory
+and output tables, and the throughput of each job is reported at the end.
+
+Usage (from the repository root; see config/jobs_template.yml):
+    python -m TextAnalyticsPipeline.job_runner TextAnalyticsPipeline/config/jobs.yml
+'''
+
+import sys
+import time
+import logging
+
+import yaml
+
+from .config import BigQuery, InputConf, ProcessorClass, Language, Library, SinkConf, FakeBigQueryConf
+from .bigquery_tools import GBQCreds
+from .set_up_logging import set_up_logging
+from .validate_params import ValidateParams
+from .perform_analysis import load_documents, apply_tuned_profile, run_library_pipeline
+
+
+class Job:
+    '''
+    One job spec from the jobs file; keys that are not given fall back to config.yml.
+    '''
+
+    def __init__(self, spec):
+        self.project = spec.get('project', BigQuery.project_name)
+        self.dataset = spec.get('dataset', BigQuery.dataset_name)
+        self.table = spec.get('table', BigQuery.tablename)
+        self.library = spec.get('library') or Library().get_library()
+        self.lang = spec.get('lang') or Language().get_language()
+        self.csv = spec.get('csv')
+
+        # With fake_bigquery, the csv loaded as this job's input table
+        self.seed_csv = spec.get('seed_csv')
+
+        processors = spec.get('processors')
+        if processors is None:
+            processors = [ProcessorClass().get_processor_class()[1]]
+        self.processors = [processors] if isinstance(processors, str) else list(processors)
+
+    def __str__(self):
+        return f'{self.library} {",".join(self.processors)} on {self.project}.{self.dataset}.{self.table}'
+
+
+def read_jobs(path):
+    with open(path, encoding='utf-8') as f:
+        jobs = yaml.safe_load(f)['jobs']
+
+    # Processors are checked as Job reads them, so a single processor may be given as a string
+    jobs = [(spec, Job(spec)) for spec in jobs]
+    for spec, job in jobs:
+        unknown = [p for p in job.processors if p not in ProcessorClass.processor_classes]
+        if unknown:
+            print(f'Unknown processors {unknown} in job {spec}. Exiting.')
+            exit()
+
+    return [job for _, job in jobs]
+
+
+def run_jobs(jobs):
+    '''
+    Runs the jobs in order and returns (job, processor, documents, seconds) for every processor run.
+    '''
+    database_import = InputConf.from_database
+    clients = {}
+    validated = set()
+    results = []
+
+    for job in jobs:
+        logging.info(f'Starting job: {job}')
+
+        # One client per project, shared by every job in it
+        if SinkConf.is_local() and database_import != True:
+            bq = None
+        else:
+            if job.project not in clients:
+                gbq_creds = GBQCreds()
+                gbq_creds.get_gbq_creds(job.project)
+                clients[job.project] = gbq_creds.get_client(job.project)
+            bq = clients[job.project]
+
+            # With fake_bigquery, each job's input table is loaded from its seed_csv (or its input csv with from_csv)
+            if FakeBigQueryConf.enabled and (job.project, job.dataset, job.table) not in validated:
+                gbq_creds = GBQCreds()
+                seed_csv = job.seed_csv or (job.csv if database_import != True else None) or gbq_creds.default_seed_csv()
+                if seed_csv:
+                    gbq_creds.seed_fake_table(bq, job.project, job.dataset, job.table, seed_csv)
+
+            if (job.project, job.dataset, job.table) not in validated:
+                vdp = ValidateParams()
+                vdp.validate_project_parameters(job.project, job.dataset, job.table, bq)
+                if database_import == True:
+                    vdp.validate_query_parameters(job.project, job.dataset, job.table, InputConf.id_column,
+                                                  InputConf.text_column, bq)
+                validated.add((job.project, job.dataset, job.table))
+
+        n_docs, identifiers, documents = load_documents(bq, job.project, job.dataset, job.table, InputConf.id_column,
+                                                        InputConf.text_column, database_import, job.library, job.csv)
+
+        for processor_name in job.processors:
+            apply_tuned_profile(job.library, processor_name)
+            start = time.perf_counter()
+            # Chunk size as in run_text_pipeline
+            run_library_pipeline(job.library, 20, n_docs, bq, identifiers, documents, job.lang,
+                                 ProcessorClass.processor_classes[processor_name], processor_name,
+                                 database_import, job.project, job.dataset, job.table)
+            seconds = time.perf_counter() - start
+
+            results.append((job, processor_name, n_docs, seconds))
+            logging.info(f'{job.library} {processor_name} on {job.table}: {n_docs} documents in {seconds:.1f}s '
+                         f'({n_docs / seconds:.1f} docs/s)')
+
+    return results
+
+
+def report(results):
+    logging.info('Job throughput:')
+    logging.info(f'{"table":<30} {"library":<8} {"processor":<11} {"docs":>9} {"seconds":>9} {"docs/s":>9}')
+    for job, processor_name, n_docs, seconds in results:
+        logging.info(f'{job.table:<30} {job.library:<8} {processor_name:<11} {n_docs:>9} {seconds:>9.1f} '
+                     f'{n_docs / seconds:>9.1f}')
+
+
+def main():
+    if len(sys.argv) != 2:
+        print('Usage: python -m TextAnalyticsPipeline.job_runner <jobs.yml>')
+        exit()
+
+    jobs = read_jobs(sys.argv[1])
+    set_up_logging('TextAnalyticsPipeline/logs', 'jobs', f'{len(jobs)}_jobs')
+
+    report(run_jobs(jobs))
+
+
+if __name__ == '__main__':
+    main()
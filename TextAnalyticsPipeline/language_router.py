@@ -0,0 +1,161 @@
+'''
+Per-document language detection for mixed-language corpora, used with language: 'auto' (stanza and spacy).
+
+Each document's language is detected with a fast detector (Stanza's langid model, or a fastText lid.176 model), the
+documents are grouped into one batch per language, and each batch is processed with that language's model. Output
+tables gain a language column.
+
+Models are loaded on first use and kept in a ModelPool: when the models loaded would take more than model_memory_mb,
+the least recently used one is unloaded. A language with no model installed is processed with the fallback_language
+model and logged.
+'''
+
+import gc
+from collections import OrderedDict
+
+from .config import Language
+from .memory_budget import rss_mb
+
+
+class ModelPool:
+    '''
+    Least recently used cache of loaded models. The size of a model is measured as the growth of the process's
+    resident memory while it loads, so it is approximate (and 0 if memory cannot be read, in which case nothing is
+    unloaded).
+    '''
+
+    def __init__(self, memory_mb=0):
+        self.memory_mb = memory_mb
+        self.models = OrderedDict()
+        self.sizes = {}
+        self.loads = 0
+        self.evictions = 0
+
+    def get(self, key, load, logging=None):
+        '''
+        Returns the model for key, calling load() to load it if it is not in the pool.
+        '''
+        if key in self.models:
+            self.models.move_to_end(key)
+            return self.models[key]
+
+        # A model unloaded earlier has a known size, so room is made before it is loaded again
+        self.evict(self.sizes.get(key, 0), logging)
+
+        before = rss_mb()
+        model = load()
+        self.sizes[key] = max(rss_mb() - before, 0)
+
+        self.models[key] = model
+        self.loads += 1
+        if logging is not None:
+            logging.info(f'Loaded model {key} ({self.sizes[key]:.0f} MB, {self.used_mb():.0f} MB in use)')
+
+        self.evict(0, logging, keep=key)
+        return model
+
+    def used_mb(self):
+        return sum(self.sizes[key] for key in self.models)
+
+    def evict(self, incoming_mb, logging=None, keep=None):
+        if not self.memory_mb:
+            return
+
+        evicted = False
+        while self.models and self.used_mb() + incoming_mb > self.memory_mb:
+            key = next(iter(self.models))
+            if key == keep:
+                break
+            del self.models[key]
+            self.evictions += 1
+            evicted = True
+            if logging is not None:
+                logging.info(f'Unloaded model {key} to stay within model_memory_mb ({self.memory_mb} MB)')
+
+        if evicted:
+            gc.collect()
+
+
+# Detectors loaded in this process
+detectors = {}
+
+
+def get_detector():
+    if Language.detector not in detectors:
+        if Language.detector == 'fasttext':
+            detectors[Language.detector] = FastTextDetector(Language.fasttext_model_path)
+        else:
+            detectors[Language.detector] = StanzaDetector(Language.languages)
+    return detectors[Language.detector]
+
+
+class StanzaDetector:
+    '''
+    Stanza's character-level langid model (the 'multilingual' pipeline), restricted to languages if given.
+    '''
+
+    def __init__(self, languages):
+        import stanza
+
+        self.stanza = stanza
+        options = {'langid_lang_subset': languages} if languages else {}
+        self.nlp = stanza.Pipeline(lang='multilingual', processors='langid', download_method=None, **options)
+
+    def detect(self, documents):
+        docs = [self.stanza.Document([], text=document) for document in documents]
+        self.nlp(docs)
+        return [doc.lang for doc in docs]
+
+
+class FastTextDetector:
+    '''
+    A fastText language identification model such as lid.176.ftz (requires the fasttext package).
+    '''
+
+    def __init__(self, model_path):
+        import fasttext
+
+        self.model = fasttext.load_model(model_path)
+
+    def detect(self, documents):
+        # fastText predicts one line at a time
+        labels, _ = self.model.predict([document.replace('\n', ' ') for document in documents])
+        return [label[0][len('__label__'):] for label in labels]
+
+
+def detect_languages(documents, batch_size=1000):
+    '''
+    Returns the detected language of each document. Empty documents, and languages outside the configured
+    languages, get the fallback language.
+    '''
+    detector = get_detector()
+    languages = [Language.fallback_language] * len(documents)
+
+    texts = [(i, document) for i, document in enumerate(documents) if isinstance(document, str) and document.strip()]
+    for start in range(0, len(texts), batch_size):
+        batch = texts[start:start + batch_size]
+        for (i, _), lang in zip(batch, detector.detect([document for _, document in batch])):
+            if not Language.languages or lang in Language.languages:
+                languages[i] = lang
+
+    return languages
+
+
+def route_documents(identifiers, documents, logging):
+    '''
+    Detects the language of every document and groups the documents by language. Returns a list of
+    (language, identifiers, documents), largest group first, and a dict of the language of each identifier.
+    '''
+    logging.info(f'Detecting the language of {len(documents)} documents with {Language.detector}...')
+    languages = detect_languages(documents)
+
+    groups = {}
+    for id, document, lang in zip(identifiers, documents, languages):
+        group_ids, group_docs = groups.setdefault(lang, ([], []))
+        group_ids.append(id)
+        group_docs.append(document)
+
+    routed = sorted(((lang, ids, docs) for lang, (ids, docs) in groups.items()), key=lambda group: -len(group[1]))
+    logging.info('Documents per language: ' + ', '.join(f'{lang} {len(ids)}' for lang, ids, _ in routed))
+
+    return routed, dict(zip(identifiers, languages))
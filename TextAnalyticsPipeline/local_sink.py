@@ -0,0 +1,86 @@
+'''
+Local output backends, used with sink: duckdb or sink: parquet. Result chunks are appended to a DuckDB database file
+or to a Parquet dataset on disk, with column types taken from the same Schema definitions used for BigQuery. No
+credentials or network calls are needed, so with a local input csv an offline run is limited only by NLP speed.
+
+A sink has two methods: write(table_name, schema, data) appends a chunk (a DataFrame, or a list of nested records
+for the nested schemas) and close() finishes the run.
+'''
+
+import os
+import itertools
+from datetime import datetime
+
+import pyarrow.parquet as pq
+
+from .spool import to_arrow
+
+
+# Distinguishes runs started in the same second by one process (see job_runner.py)
+run_numbers = itertools.count()
+
+
+class DuckDBSink:
+    '''
+    Appends each chunk to a table in a DuckDB database (requires the duckdb package), creating the table from the
+    first chunk's Arrow schema.
+    '''
+
+    def __init__(self, path, logging):
+        import duckdb
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.logging = logging
+        self.connection = duckdb.connect(path)
+        self.rows = {}
+
+    def write(self, table_name, schema, data):
+        arrow_table = to_arrow(data, schema)
+        self.connection.register('chunk', arrow_table)
+        self.connection.execute(f'CREATE TABLE IF NOT EXISTS "{table_name}" AS SELECT * FROM chunk LIMIT 0')
+        self.connection.execute(f'INSERT INTO "{table_name}" SELECT * FROM chunk')
+        self.connection.unregister('chunk')
+
+        self.rows[table_name] = self.rows.get(table_name, 0) + arrow_table.num_rows
+        self.logging.info(f'Appended {arrow_table.num_rows} rows to {table_name} in {self.path}')
+
+    def close(self):
+        self.connection.close()
+        for table_name, rows in self.rows.items():
+            self.logging.info(f'Wrote {rows} rows to {table_name} in {self.path}')
+
+
+class ParquetSink:
+    '''
+    Writes each chunk as a zstd Parquet file in a Hive-partitioned dataset: <path>/<table_name>/run=<run id>/.
+    '''
+
+    def __init__(self, path, logging):
+        self.path = path
+        self.logging = logging
+        self.run_id = f'{datetime.now().strftime("%Y%m%d%H%M%S")}_{os.getpid()}_{next(run_numbers)}'
+        self.parts = {}
+        self.rows = {}
+
+    def write(self, table_name, schema, data):
+        directory = os.path.join(self.path, table_name, f'run={self.run_id}')
+        os.makedirs(directory, exist_ok=True)
+
+        part = self.parts.get(table_name, 0)
+        arrow_table = to_arrow(data, schema)
+        pq.write_table(arrow_table, os.path.join(directory, f'part_{part:06d}.parquet'), compression='zstd')
+
+        self.parts[table_name] = part + 1
+        self.rows[table_name] = self.rows.get(table_name, 0) + arrow_table.num_rows
+        self.logging.info(f'Wrote {arrow_table.num_rows} rows to {directory}/part_{part:06d}.parquet')
+
+    def close(self):
+        for table_name, rows in self.rows.items():
+            self.logging.info(f'Wrote {rows} rows to {os.path.join(self.path, table_name)}')
+
+
+LOCAL_SINKS = {
+    'duckdb': DuckDBSink,
+    'parquet': ParquetSink
+}
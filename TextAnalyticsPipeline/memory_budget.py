@@ -0,0 +1,165 @@
+'''
+Keeps a run within max_memory_mb of resident memory (0 for no limit).
+
+A background thread samples the process's RSS, so the peak reached inside a model call is known once the batch
+returns. An AdaptiveBatcher forms the batches for Stanza and spaCy from that peak: when a batch takes memory above
+HIGH_WATER of the budget, the batch size and a limit on the characters per batch are halved. Documents longer than
+the limit are then processed on their own (the serial path). When batches stay below LOW_WATER, both grow again,
+the batch size up to the configured batch_size and the character limit more slowly. Result buffers are pushed early
+and upload queues are drained while memory is above HIGH_WATER (see under_pressure).
+'''
+
+import gc
+import os
+import time
+import threading
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from .config import Performance
+
+
+# Shares of max_memory_mb at which batches shrink, and below which they grow
+HIGH_WATER = 0.85
+LOW_WATER = 0.6
+
+MB = 1024 * 1024
+
+
+def rss_mb():
+    '''
+    Resident memory of this process in MB, from psutil or /proc (0 if neither is available).
+    '''
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / MB
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / MB
+    except (OSError, ValueError):
+        return 0
+
+
+def under_pressure():
+    '''
+    True when the process is above HIGH_WATER of max_memory_mb.
+    '''
+    return bool(Performance.max_memory_mb) and rss_mb() > HIGH_WATER * Performance.max_memory_mb
+
+
+class PeakMonitor:
+    '''
+    Samples RSS every interval seconds in a daemon thread and keeps the peak since the last reset.
+    '''
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = rss_mb()
+        self.lock = threading.Lock()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            rss = rss_mb()
+            with self.lock:
+                self.peak = max(self.peak, rss)
+            time.sleep(self.interval)
+
+    def reset(self):
+        '''
+        Returns the peak since the last reset, and starts a new one from the current RSS.
+        '''
+        rss = rss_mb()
+        with self.lock:
+            peak = max(self.peak, rss)
+            self.peak = rss
+        return peak
+
+
+# One monitor per process, started by the first AdaptiveBatcher with a budget
+monitor = None
+
+
+def get_monitor():
+    global monitor
+    if monitor is None:
+        monitor = PeakMonitor()
+    return monitor
+
+
+class AdaptiveBatcher:
+
+    def __init__(self, batch_size, logging, max_memory_mb=None):
+        self.max_batch_size = batch_size
+        self.batch_size = batch_size
+        self.max_memory_mb = Performance.max_memory_mb if max_memory_mb is None else max_memory_mb
+        self.logging = logging
+
+        # No limit on characters per batch until the budget is first approached
+        self.max_chars = None
+        self.batch_chars = 0
+        self.serial = 0
+
+        self.monitor = get_monitor() if self.max_memory_mb else None
+
+    @property
+    def enabled(self):
+        return bool(self.max_memory_mb)
+
+    def batches(self, identifiers, documents):
+        '''
+        Yields (identifiers, documents) batches of up to batch_size documents and max_chars characters. The sizes are
+        read as each batch is formed, so changes made by update() apply to the next batch.
+        '''
+        i = 0
+        while i < len(documents):
+            end = i
+            chars = 0
+            while end < len(documents) and end - i < self.batch_size:
+                length = len(documents[end]) if isinstance(documents[end], str) else 0
+                if self.max_chars is not None and end > i and chars + length > self.max_chars:
+                    break
+                chars = chars + length
+                end = end + 1
+
+            if self.max_chars is not None and end == i + 1 and chars > self.max_chars:
+                self.serial += 1
+                self.logging.info(f'Document {identifiers[i]} ({chars} characters) is over the batch limit of '
+                                  f'{self.max_chars} characters. Processing it on its own.')
+
+            self.batch_chars = chars
+            yield identifiers[i:end], documents[i:end]
+            i = end
+
+    def update(self):
+        '''
+        Adjusts the batch size from the peak memory of the batch just processed.
+        '''
+        if self.monitor is None:
+            return
+
+        peak = self.monitor.reset()
+        if peak > HIGH_WATER * self.max_memory_mb:
+            self.batch_size = max(1, self.batch_size // 2)
+            self.max_chars = max(1, min(self.max_chars or self.batch_chars, self.batch_chars) // 2)
+            gc.collect()
+            self.logging.info(f'Peak memory {peak:.0f} MB is close to max_memory_mb ({self.max_memory_mb} MB). '
+                              f'Batches reduced to {self.batch_size} documents and {self.max_chars} characters.')
+
+            rss = rss_mb()
+            if rss > self.max_memory_mb:
+                self.logging.info(f'Memory in use ({rss:.0f} MB) is over max_memory_mb after the batch.')
+
+        elif peak < LOW_WATER * self.max_memory_mb and (self.batch_size < self.max_batch_size or self.max_chars):
+            self.batch_size = min(self.max_batch_size, self.batch_size + max(1, self.batch_size // 2))
+            # The character limit grows more slowly, as it was set by a batch that did reach the budget
+            if self.max_chars is not None:
+                self.max_chars = self.max_chars + self.max_chars // 8
+
+    def report(self):
+        if self.enabled:
+            self.logging.info(f'Memory: final batches of {self.batch_size} documents'
+                              + (f' and {self.max_chars} characters' if self.max_chars else '')
+                              + f', {self.serial} oversized documents processed on their own')
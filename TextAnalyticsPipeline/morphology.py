@@ -0,0 +1,86 @@
+'''
+Decoding of Universal Dependencies morphological feature strings (e.g. 'Case=Nom|Number=Sing') for the morphology
+tables.
+
+The set of distinct feature strings in a corpus is small, so each one is parsed once and given an integer code. Words
+are then mapped to codes, and the fixed morphology columns are filled for a whole batch with one lookup per column.
+The same codes give the optional long-format table, which has one (word, feature, value) row for every feature,
+including those without a column in Schema.morphology_schema.
+'''
+
+import numpy as np
+import pandas as pd
+
+
+# Features with a column in Schema.morphology_schema
+MORPHOLOGY_FEATURES = ['Number', 'Mood', 'Person', 'Tense', 'VerbForm', 'Case', 'Gender', 'PronType', 'Degree',
+                       'Definite', 'NumForm', 'NumType', 'Voice']
+
+
+class FeatureDecoder:
+    '''
+    Interns feature strings. missing is the value used for features a word does not have, and first_value_only keeps
+    only the first of several comma-separated values in the fixed columns; both follow the existing output of each
+    library (spaCy: '' and True, Stanza: None and False). The long-format table always keeps the full value.
+    '''
+
+    def __init__(self, missing=None, first_value_only=False):
+        self.missing = missing
+        self.first_value_only = first_value_only
+        self.codes = {}
+        self.pairs = []
+        self.values = [[] for _ in MORPHOLOGY_FEATURES]
+        self.lookup = None
+
+    def code(self, feats):
+        code = self.codes.get(feats)
+        if code is None:
+            code = self.add(feats)
+        return code
+
+    def add(self, feats):
+        # '_' is the CoNLL-U (and spaCy) notation for no features
+        pairs = []
+        if feats and feats != '_':
+            for feature in feats.split('|'):
+                key, _, value = feature.partition('=')
+                pairs.append((key, value))
+        parsed = dict(pairs)
+
+        code = len(self.pairs)
+        self.codes[feats] = code
+        self.pairs.append(pairs)
+        for values, feature in zip(self.values, MORPHOLOGY_FEATURES):
+            value = parsed.get(feature, self.missing)
+            if self.first_value_only and value:
+                value = value.split(',')[0]
+            values.append(value)
+        self.lookup = None
+
+        return code
+
+    def columns(self, codes):
+        '''
+        Returns the fixed morphology columns for an array of codes.
+        '''
+        if self.lookup is None:
+            self.lookup = [np.array(values, dtype=object) for values in self.values]
+
+        codes = np.asarray(codes, dtype=np.int64)
+        return {f'features_{feature}': lookup[codes] for feature, lookup in zip(MORPHOLOGY_FEATURES, self.lookup)}
+
+    def long_format(self, identifiers, sentence_nums, word_nums, word_ids, codes):
+        '''
+        Returns the long-format table (one row per word and feature) for the words with the given codes, or None if
+        none of them have features. Both the word_id and the sentence_num/word_num columns are included, so that the
+        columns of either the wide or the compact schema can be taken from it.
+        '''
+        rows = [
+            (identifier, sentence_num, word_num, word_id, feature, value)
+            for identifier, sentence_num, word_num, word_id, code in zip(identifiers, sentence_nums, word_nums, word_ids, codes)
+            for feature, value in self.pairs[code]
+        ]
+        if len(rows) == 0:
+            return None
+
+        return pd.DataFrame(rows, columns=['identifier', 'sentence_num', 'word_num', 'word_id', 'feature', 'value'])
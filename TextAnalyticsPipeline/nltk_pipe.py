@@ -1,8 +1,228 @@
+'''
+Uses NLTK to process documents for:
+    - named entity recognition (maximum entropy NE chunker)
+    - part-of-speech tagging (averaged perceptron tagger)
+
+NLTK is considerably less accurate than the spaCy and Stanza models but is several times faster, so it is intended for
+very large corpora where throughput matters more than accuracy. Documents are processed in batches across a process
+pool and written to the same tables as the other libraries.
+
+Required NLTK data: punkt, averaged_perceptron_tagger, maxent_ne_chunker, words, wordnet
+'''
+
 import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import nltk
 import pandas as pd
+from nltk.stem import WordNetLemmatizer
+from nltk.tag.perceptron import PerceptronTagger
+from nltk.tokenize import TreebankWordTokenizer
 
-from .bigquery_tools import Schema
+from .bigquery_tools import Schema, PushTables
+from .config import Performance
 from .data_processor import ProcessResults
+from .tagsets import PTB_TO_UPOS
+
+
+# Penn Treebank tag prefixes mapped to WordNet parts of speech for lemmatisation
+PTB_TO_WORDNET = {'J': 'a', 'V': 'v', 'N': 'n', 'R': 'r'}
+
+# Models are loaded once per worker process, not once per document (nltk.pos_tag reloads the tagger on every call)
+_models = {}
+
+
+def _get_models():
+    if not _models:
+        _models['sentences'] = nltk.data.load('tokenizers/punkt/english.pickle')
+        _models['words'] = TreebankWordTokenizer()
+        _models['tagger'] = PerceptronTagger()
+        _models['lemmatizer'] = WordNetLemmatizer()
+    return _models
+
+
+def tag_document(document):
+    '''
+    Splits a document into sentences and tokens and tags each token. Returns a list of sentences, where each sentence
+    is a list of (word, xpos, start_char, end_char) tuples with offsets into the original document.
+    '''
+    models = _get_models()
+
+    tagged_sentences = []
+    for sent_start, sent_end in models['sentences'].span_tokenize(document):
+        sentence = document[sent_start:sent_end]
+        spans = list(models['words'].span_tokenize(sentence))
+        words = [sentence[start:end] for start, end in spans]
+        tags = models['tagger'].tag(words)
+        tagged_sentences.append([
+            (word, tag, sent_start + start, sent_start + end)
+            for (word, tag), (start, end) in zip(tags, spans)
+        ])
+
+    return tagged_sentences
+
+
+def extract_pos(document):
+    '''
+    Returns part-of-speech rows for a document, in the column order expected by ProcessResults.process_pos
+    (without the identifier).
+    '''
+    lemmatizer = _get_models()['lemmatizer']
+
+    tokens_list = []
+    for sentence_num, sentence in enumerate(tag_document(document), start=1):
+        for word_num, (word, xpos, start_char, end_char) in enumerate(sentence, start=1):
+            wordnet_pos = PTB_TO_WORDNET.get(xpos[:1])
+            tokens_list.append({
+                'sentence_num': sentence_num,
+                'word_num': word_num,
+                'word_id': None,
+                'word': word,
+                'lemma': lemmatizer.lemmatize(word.lower(), wordnet_pos) if wordnet_pos else word.lower(),
+                'upos': PTB_TO_UPOS.get(xpos, 'X'),
+                'xpos': xpos,
+                'start_char': start_char,
+                'end_char': end_char
+            })
+
+    return tokens_list
+
+
+def extract_ner(document):
+    '''
+    Returns named entity rows for a document, in the column order expected by ProcessResults.process_ner
+    (without the identifier).
+    '''
+    entities_list = []
+    for sentence in tag_document(document):
+        if len(sentence) == 0:
+            continue
+
+        # ne_chunk keeps tokens in order, so a running token index recovers the character offsets of each chunk
+        tree = nltk.ne_chunk([(word, xpos) for word, xpos, _, _ in sentence])
+        token_index = 0
+        for node in tree:
+            if isinstance(node, nltk.Tree):
+                n_tokens = len(node.leaves())
+                start_char = sentence[token_index][2]
+                end_char = sentence[token_index + n_tokens - 1][3]
+                entities_list.append({
+                    'text': document[start_char:end_char],
+                    'type': node.label(),
+                    'start_char': start_char,
+                    'end_char': end_char
+                })
+                token_index += n_tokens
+            else:
+                token_index += 1
+
+    return entities_list
+
+
+def process_batch(batch, processor_name):
+    '''
+    Worker function: processes a batch of (identifier, document) pairs and returns one dataframe per document.
+    '''
+    result_processor = ProcessResults()
+
+    dfs = []
+    for id, document in batch:
+        if processor_name == 'ner':
+            entities_list = extract_ner(document)
+            if len(entities_list) > 0:
+                dfs.append(result_processor.process_ner(id, pd.DataFrame(entities_list)))
+        elif processor_name == 'pos':
+            tokens_list = extract_pos(document)
+            if len(tokens_list) > 0:
+                df = pd.DataFrame(tokens_list)
+                df['word_id'] = [f'{id}_{s}_{w}' for s, w in zip(df['sentence_num'], df['word_num'])]
+                dfs.append(result_processor.process_pos(id, df))
+
+    return dfs
+
+
+def iter_batches(identifiers, documents, batch_size):
+    pairs = list(zip(identifiers, documents))
+    for i in range(0, len(pairs), batch_size):
+        yield pairs[i:i + batch_size]
+
+
+def map_batches(executor, batches, processor_name, max_in_flight):
+    '''
+    Submits batches to the process pool, keeping at most max_in_flight batches queued so that results for a large
+    corpus are not all held in memory at once. Yields (batch length, dataframes) in input order.
+    '''
+    in_flight = deque()
+    for batch in batches:
+        in_flight.append((len(batch), executor.submit(process_batch, batch, processor_name)))
+        if len(in_flight) >= max_in_flight:
+            batch_len, future = in_flight.popleft()
+            yield batch_len, future.result()
+
+    while in_flight:
+        batch_len, future = in_flight.popleft()
+        yield batch_len, future.result()
+
+
+def run_nltk_pipeline(chunk, n_docs, bq, identifiers, documents, lang, library, processor_class, processor_name, logging, database_import, project, dataset, table, result_dfs):
+
+    if processor_name == 'ner':
+        table_schema = Schema.ner_schema
+        logging.info('Processing documents for entity extraction...')
+    elif processor_name == 'pos':
+        table_schema = Schema.pos_schema
+        logging.info('Processing documents for part-of-speech extraction...')
+    else:
+        logging.info(f'NLTK does not support {processor_name}. Supported processors are ner and pos. Exiting.')
+        return
+
+    if lang != 'en':
+        logging.info(f'NLTK models are English only; language {lang} will be processed with English models.')
+
+    perf = Performance()
+    batch_size = perf.batch_size
+    n_process = perf.processes()
+
+    logging.info(f'Using {n_process} processes with a batch size of {batch_size} documents.')
+
+    push_tables = PushTables()
+
+    def push_chunk(result_dfs):
+        push_tables.prepare_chunk_for_push(result_dfs, processor_name, library)
+        push_tables.push_to_gbq(
+            database_import,
+            bq,
+            project,
+            dataset,
+            table,
+            table_schema,
+            library,
+            logging,
+            proc=processor_name
+        )
+
+    count = 0
+    with ProcessPoolExecutor(max_workers=n_process) as executor:
+        for batch_len, dfs in map_batches(executor, iter_batches(identifiers, documents, batch_size), processor_name, n_process * 2):
+
+            # Count keeps track of the number of documents processed
+            count = count + batch_len
+            logging.info(f'Processed {count} of {n_docs} documents')
+
+            # Append results
+            result_dfs.extend([df] for df in dfs)
+
+            # Check len of result_dfs and if len(result_dfs) >= chunk, push chunk to BigQuery
+            if len(result_dfs) >= chunk:
+                push_chunk(result_dfs)
+
+                # Reset result_dfs
+                result_dfs = []
+
+    # Push any remaining results
+    if len(result_dfs) > 0:
+        push_chunk(result_dfs)
 
-def run_nltk_pipeline(identifiers, documents, lang, processor_class, processor_name, logging):
-    pass
\ No newline at end of file
+    # Finish any open write streams
+    push_tables.close()
@@ -22,13 +22,17 @@ from google.cloud.bigquery.client import Client
 from google.api_core import exceptions
 
 # local imports
-from .config import BigQuery, InputConf, ProcessorClass, Language, Library
+from .config import BigQuery, InputConf, ProcessorClass, Language, Library, Performance, SpacyConf, SinkConf
 from .bigquery_tools import GBQCreds, QueryGBQ
 from .set_up_logging import set_up_logging
+from .spacy_docbin import count_docbin_docs
 from .validate_params import ValidateParams
+from .preprocess import preprocess_documents
 
 from .stanza_pipe import run_stanza_pipeline
 from .spacy_pipe import run_spacy_pipeline
+from .nltk_pipe import run_nltk_pipeline
+from .corenlp_pipe import run_corenlp_pipeline
 
 
 def get_processor_params():
@@ -80,6 +84,85 @@ def find_optimal_chunk_size(a, min_chunk_size=5000, max_chunk_size=10000):
     return min_chunk_size
 
 
+def load_documents(bq, project, dataset, table, id_column, text_column, database_import, library, input_csv=None):
+    '''
+    Returns the number of documents, and their identifiers and texts, from the BigQuery table or the input csv.
+    '''
+    # If database_import is True, query BigQuery table. If False, read csv into dataframe
+    gbqq = QueryGBQ()
+    if library == 'spacy' and SpacyConf.derive_from_docbin:
+        # Identifiers and annotations are read from the saved DocBin shards, so there is nothing to query
+        n_docs = count_docbin_docs(SpacyConf.docbin_dir)
+        df = pd.DataFrame({id_column: [], text_column: []})
+    elif database_import == True:
+        # Prepare SQL query, with the configured filters pushed into it
+        query_string = gbqq.build_query(project, dataset, table, id_column, text_column)
+        n_docs, df = gbqq.query_gbq(logging, table, query_string, bq, dataset, text_column)
+    else:
+        n_docs, df = gbqq.read_csv_from_file(logging, input_csv)
+
+    # Get identifiers and documents from dataframe
+    identifiers = df[id_column].tolist()
+    documents = df[text_column].tolist()
+
+    # Junk documents are removed before they reach the model (see preprocess.py)
+    if len(documents) > 0:
+        identifiers, documents, _ = preprocess_documents(identifiers, documents, logging)
+        n_docs = len(documents)
+
+    return n_docs, identifiers, documents
+
+def apply_tuned_profile(library, processor_name):
+    '''
+    Uses the settings tuned for the library and processor by autotune.py, if any, in place of those in config.yml.
+    '''
+    tuned = Performance.apply_profile(library, processor_name)
+    if tuned:
+        logging.info(f'Using tuned settings from {Performance.tuned_profile}: batch_size {Performance.batch_size}, '
+                     f'n_process {Performance.n_process}, torch_threads {Performance.torch_threads}')
+        if tuned.get('cpus') != os.cpu_count():
+            logging.info(f'The settings were tuned on a machine with {tuned.get("cpus")} CPUs; this one has '
+                         f'{os.cpu_count()}. Consider running autotune again.')
+
+def run_library_pipeline(library, chunk, n_docs, bq, identifiers, documents, lang, processor_class, processor_name,
+                         database_import, project, dataset, table):
+    '''
+    Runs one processor of one library over the documents and pushes the output.
+    '''
+    pipelines = {
+        'stanza': run_stanza_pipeline,
+        'spacy': run_spacy_pipeline,
+        'nltk': run_nltk_pipeline,
+        'corenlp': run_corenlp_pipeline
+    }
+
+    # Only Stanza and spaCy route documents by detected language
+    if Language.detect() and library not in ('stanza', 'spacy'):
+        logging.info(f'Language detection is not supported with {library}. Processing every document as {Language.fallback_language}.')
+        lang = Language.fallback_language
+
+    # Initialise result_dfs (starter is blank list)
+    result_dfs = []
+
+    pipelines[library](
+        chunk,
+        n_docs,
+        bq,
+        identifiers,
+        documents,
+        lang,
+        library,
+        processor_class,
+        processor_name,
+        logging,
+        database_import,
+        project,
+        dataset,
+        table,
+        result_dfs
+    )
+
+
 # Main -----------------------------------------------------------------------------------------------------------------
 
 def run_text_pipeline():
@@ -94,30 +177,26 @@ def run_text_pipeline():
     # Set up logging (see set_up_logging.py)
     set_up_logging('TextAnalyticsPipeline/logs', library, processor_name)
 
-    # Get Google BigQuery credentials
-    gbq_creds = GBQCreds()
-    gbq_creds.get_gbq_creds(project)
+    if SinkConf.is_local() and database_import != True:
+        # Local input and local output: no BigQuery client, credentials or network calls are needed
+        bq = None
+        logging.info(f'Writing output locally to {SinkConf.local_output_path}')
+    else:
+        # Get Google BigQuery credentials
+        gbq_creds = GBQCreds()
+        gbq_creds.get_gbq_creds(project)
 
-    # Initialise BigQuery client
-    bq = gbq_creds.get_client(project)
+        # Initialise BigQuery client
+        bq = gbq_creds.get_client(project)
 
-    # Validate GBQ parameters
-    vdp = ValidateParams()
-    project, dataset, table = vdp.validate_project_parameters(project, dataset, table, bq)
+        # Validate GBQ parameters
+        vdp = ValidateParams()
+        project, dataset, table = vdp.validate_project_parameters(project, dataset, table, bq)
 
-
-    # If database_import is True, query BigQuery table. If False, read csv into dataframe
-    gbqq = QueryGBQ()
-    if database_import == True:
-        # Prepare SQL query
-        query_string = f"""
-            SELECT DISTINCT
-            {id_column}, {text_column}
-            FROM `{project}.{dataset}.{table}`
-            """
-        n_docs, df = gbqq.query_gbq(logging, table, query_string, bq, dataset, text_column)
-    else:
-        n_docs, df = gbqq.read_csv_from_file(logging)
+        # Validate the filters pushed into the input query
+        if database_import == True:
+            query_bytes = vdp.validate_query_parameters(project, dataset, table, id_column, text_column, bq)
+            logging.info(f'The input query will process {query_bytes / 1024 ** 2:.1f} MB')
 
 
     # Specify a chunk size so that when result_dfs reaches chunk size, it is pushed to BigQuery
@@ -126,88 +205,11 @@ def run_text_pipeline():
     # )
     chunk = 20
 
-    # Get identifiers and documents from dataframe
-    identifiers = df[id_column].tolist()
-    documents = df[text_column].tolist()
-
-    # Initialise result_dfs (starter is blank list)
-    result_dfs = []
+    n_docs, identifiers, documents = load_documents(bq, project, dataset, table, id_column, text_column, database_import, library)
 
-    if library == 'stanza':
-        run_stanza_pipeline(
-            chunk,
-            n_docs,
-            bq,
-            identifiers,
-            documents,
-            lang,
-            library,
-            processor_class,
-            processor_name,
-            logging,
-            database_import,
-            project,
-            dataset,
-            table,
-            result_dfs
-        )
-
-    elif library == 'spacy':
-        run_spacy_pipeline(
-            chunk,
-            n_docs,
-            bq,
-            identifiers,
-            documents,
-            lang,
-            library,
-            processor_class,
-            processor_name,
-            logging,
-            database_import,
-            project,
-            dataset,
-            table,
-            result_dfs
-        )
-
-    elif library == 'nltk':
-        run_nltk_pipeline(
-            chunk,
-            n_docs,
-            bq,
-            identifiers,
-            documents,
-            lang,
-            library,
-            processor_class,
-            processor_name,
-            logging,
-            database_import,
-            project,
-            dataset,
-            table,
-            result_dfs
-        )
-
-    elif library == 'corenlp':
-        run_corenlp_pipeline(
-            chunk,
-            n_docs,
-            bq,
-            identifiers,
-            documents,
-            lang,
-            library,
-            processor_class,
-            processor_name,
-            logging,
-            database_import,
-            project,
-            dataset,
-            table,
-            result_dfs
-        )
+    apply_tuned_profile(library, processor_name)
+    run_library_pipeline(library, chunk, n_docs, bq, identifiers, documents, lang, processor_class, processor_name,
+                         database_import, project, dataset, table)
 
     logging.info(f'{library} {processor_name} processing complete!')
     exit()
@@ -0,0 +1,95 @@
+'''
+Pre-processing and junk filter applied to the input documents before any NLP library sees them, with preprocess: True
+(off by default, so that existing configs process every document as it is).
+
+The steps run column-wise over all documents at once with pandas string methods:
+    - control characters and unusual whitespace (no-break spaces, line and paragraph separators, ...) are each
+      replaced with one space, so every character keeps its position and offsets in the output remain valid against
+      the original text. Newlines are kept, as the sentences and tokens input formats rely on them.
+    - documents that are empty or whitespace only, have fewer than min_words words (runs of characters containing
+      a letter, not counting URLs), or whose share of letters among non-space characters is below min_alpha_ratio
+      are rejected. URL-only and emoji-only documents have no words.
+
+Rejected documents never reach the model; the number rejected for each reason is logged with the run.
+'''
+
+import unicodedata
+
+import pandas as pd
+
+from .config import PreprocessConf
+
+
+URL_PATTERN = r'(?:https?://|www\.)\S+'
+WORD_PATTERN = r'\S*[^\W\d_]\S*'
+LETTER_PATTERN = r'[^\W\d_]'
+
+
+def build_whitespace_table():
+    '''
+    Maps control characters (other than newline) and unicode space separators to a space.
+    '''
+    table = {}
+    # The last space separator is U+3000 (ideographic space)
+    for code in range(0x3001):
+        char = chr(code)
+        if char not in '\n ' and unicodedata.category(char) in ('Cc', 'Zs', 'Zl', 'Zp'):
+            table[code] = ' '
+    return table
+
+
+WHITESPACE_TABLE = build_whitespace_table()
+
+
+def normalise(texts):
+    '''
+    Replaces control characters and unusual whitespace with spaces, one for one.
+    '''
+    return texts.str.translate(WHITESPACE_TABLE)
+
+
+def find_rejects(texts, min_words, min_alpha_ratio):
+    '''
+    Returns a Series with the reason each document is rejected ('empty', 'too_few_words' or 'low_alpha_ratio'), or
+    None for documents that are kept. Documents that are not strings (e.g. missing values) count as empty.
+    '''
+    reasons = pd.Series(None, index=texts.index, dtype=object)
+
+    is_text = texts.str.len().notna()
+    texts = texts.where(is_text, '')
+    empty = texts.str.strip() == ''
+
+    content = texts.str.replace(URL_PATTERN, ' ', regex=True)
+    words = content.str.count(WORD_PATTERN)
+    letters = content.str.count(LETTER_PATTERN)
+    visible = content.str.count(r'\S')
+    alpha_ratio = (letters / visible.where(visible > 0)).fillna(0)
+
+    reasons[alpha_ratio < min_alpha_ratio] = 'low_alpha_ratio'
+    reasons[words < min_words] = 'too_few_words'
+    reasons[empty] = 'empty'
+    return reasons
+
+
+def preprocess_documents(identifiers, documents, logging):
+    '''
+    Normalises the documents and removes rejected ones. Returns the identifiers and documents that are kept, and the
+    number of documents rejected for each reason.
+    '''
+    if not PreprocessConf.enabled or len(documents) == 0:
+        return identifiers, documents, {}
+
+    texts = pd.Series(documents, dtype=object)
+    reasons = find_rejects(texts, PreprocessConf.min_words, PreprocessConf.min_alpha_ratio)
+    keep = reasons.isna()
+
+    kept = texts[keep]
+    if PreprocessConf.normalise_whitespace:
+        kept = normalise(kept)
+
+    rejected = reasons[~keep].value_counts().to_dict()
+    logging.info(f'Pre-processing: kept {int(keep.sum())} of {len(texts)} documents; rejected '
+                 + (', '.join(f'{count} {reason}' for reason, count in sorted(rejected.items())) or 'none'))
+
+    identifiers = [id for id, k in zip(identifiers, keep) if k]
+    return identifiers, kept.tolist(), rejected
@@ -0,0 +1,121 @@
+'''
+Stores processed spaCy Docs in sharded DocBin files, so that any of the ner, pos, depparse or morphology tables can be
+derived later from the saved annotations without running the model again.
+
+Each shard holds up to docbin_shard_size Docs. The document identifier is kept in doc.user_data['identifier'], and
+manifest.json records the number of Docs in each shard. The identifiers of each shard are also listed in a .ids.json
+file next to it, so that a re-run, or a run of another processor, into the same directory skips the documents already
+saved instead of saving them again (every processor runs the full model, so a saved Doc serves them all).
+
+Documentation: https://spacy.io/api/docbin
+'''
+
+import os
+import json
+import glob
+
+from spacy.tokens import DocBin
+from spacy.vocab import Vocab
+
+
+MANIFEST = 'manifest.json'
+
+
+class DocBinWriter:
+
+    def __init__(self, directory, shard_size, logging):
+        self.directory = directory
+        self.shard_size = shard_size
+        self.logging = logging
+
+        os.makedirs(directory, exist_ok=True)
+        self.manifest = read_manifest(directory)
+
+        # Continue numbering after any shards already in the directory, and skip the documents they hold
+        self.shard_index = len(self.manifest)
+        self.saved = read_saved_identifiers(directory)
+        self.skipped = 0
+        self.doc_bin = DocBin(store_user_data=True)
+        self.identifiers = []
+
+        if self.saved:
+            logging.info(f'{len(self.saved)} docs are already saved in {directory}; they will not be saved again')
+
+    def add(self, id, doc):
+        if str(id) in self.saved:
+            self.skipped += 1
+            return
+
+        doc.user_data['identifier'] = id
+        self.doc_bin.add(doc)
+        self.identifiers.append(id)
+        self.saved.add(str(id))
+        if len(self.doc_bin) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.doc_bin) == 0:
+            return
+
+        shard = f'shard_{self.shard_index:06d}.spacy'
+        self.doc_bin.to_disk(os.path.join(self.directory, shard))
+        with open(os.path.join(self.directory, ids_file(shard)), 'w', encoding='utf-8') as f:
+            json.dump(self.identifiers, f)
+
+        self.manifest[shard] = len(self.doc_bin)
+        with open(os.path.join(self.directory, MANIFEST), 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f, indent=1)
+
+        self.logging.info(f'Saved {len(self.doc_bin)} docs to {self.directory}/{shard}')
+        self.shard_index += 1
+        self.doc_bin = DocBin(store_user_data=True)
+        self.identifiers = []
+
+    def close(self):
+        self.flush()
+        if self.skipped:
+            self.logging.info(f'Skipped {self.skipped} docs already saved in {self.directory}')
+
+
+def ids_file(shard):
+    return f'{os.path.splitext(shard)[0]}.ids.json'
+
+
+def read_saved_identifiers(directory):
+    '''
+    Returns the identifiers (as strings) of the Docs saved in the directory. Shards written without an identifiers
+    file are read with an empty Vocab, which is enough to get their user_data.
+    '''
+    saved = set()
+    for shard in read_manifest(directory):
+        path = os.path.join(directory, ids_file(shard))
+        if os.path.isfile(path):
+            with open(path, encoding='utf-8') as f:
+                saved.update(str(id) for id in json.load(f))
+        else:
+            doc_bin = DocBin(store_user_data=True).from_disk(os.path.join(directory, shard))
+            saved.update(str(doc.user_data['identifier']) for doc in doc_bin.get_docs(Vocab()))
+    return saved
+
+
+def read_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def count_docbin_docs(directory):
+    return sum(read_manifest(directory).values())
+
+
+def read_docbins(directory, vocab):
+    '''
+    Streams (identifier, doc) pairs from every shard in the directory, one shard in memory at a time. Only a Vocab is
+    needed to deserialise the Docs (e.g. spacy.blank(lang).vocab), so no model is loaded.
+    '''
+    for path in sorted(glob.glob(os.path.join(directory, 'shard_*.spacy'))):
+        doc_bin = DocBin(store_user_data=True).from_disk(path)
+        for doc in doc_bin.get_docs(vocab):
+            yield doc.user_data['identifier'], doc
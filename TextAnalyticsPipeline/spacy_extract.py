@@ -0,0 +1,153 @@
+'''
+Vectorised extraction of token-level tables (pos, depparse, morphology) from processed spaCy Docs.
+
+Token attributes are pulled into a NumPy array with a single Doc.to_array call. Sentence and word numbering and head
+positions are computed with array operations, and hash values are resolved to strings through the StringStore once per
+distinct value rather than once per token. The tables produced are identical to the per-token extraction they replace.
+
+Documentation: https://spacy.io/api/doc#to_array
+'''
+
+import numpy as np
+import pandas as pd
+from spacy.attrs import ORTH, LEMMA, POS, TAG, DEP, HEAD, IDX, LENGTH, SENT_START, MORPH
+
+from .bigquery_tools import Schema
+from .morphology import FeatureDecoder
+
+
+ATTRS = [ORTH, LEMMA, POS, TAG, DEP, HEAD, IDX, LENGTH, SENT_START, MORPH]
+COLUMNS = {attr: i for i, attr in enumerate(ATTRS)}
+
+# Feature strings are interned for the whole run; as in the original spaCy output, missing features are empty strings
+# and only the first of several values is kept
+feature_decoder = FeatureDecoder(missing='', first_value_only=True)
+
+
+class TokenArrays:
+    '''
+    Token attributes of one Doc as arrays, with sentence/word numbering and absolute head indices.
+    '''
+
+    def __init__(self, doc):
+        self.strings = doc.vocab.strings
+        self.n_tokens = len(doc)
+
+        # Hashes must stay unsigned for StringStore lookups; HEAD and SENT_START are signed values stored as uint64
+        self.values = doc.to_array(ATTRS)
+        signed = self.values.view(np.int64)
+
+        self.idx = signed[:, COLUMNS[IDX]]
+        self.end = self.idx + signed[:, COLUMNS[LENGTH]]
+
+        # The first token always starts a sentence; other tokens start one when SENT_START is 1
+        sent_start = signed[:, COLUMNS[SENT_START]] == 1
+        sent_start[:1] = True
+        self.sentence_num = np.cumsum(sent_start)
+        sentence_first = np.flatnonzero(sent_start)
+        positions = np.arange(self.n_tokens)
+        self.word_num = positions - sentence_first[self.sentence_num - 1] + 1
+
+        # HEAD is relative to the token; heads outside the sentence get head_num 0
+        self.head = positions + signed[:, COLUMNS[HEAD]]
+        self.head_num = np.where(self.sentence_num[self.head] == self.sentence_num, self.word_num[self.head], 0)
+
+    def strings_for(self, attr):
+        '''
+        Resolves a hash column to strings, looking up each distinct hash once.
+        '''
+        hashes, inverse = np.unique(self.values[:, COLUMNS[attr]], return_inverse=True)
+        lookup = np.array([self.strings[int(h)] for h in hashes], dtype=object)
+        return lookup[inverse.reshape(-1)]
+
+    def word_ids(self, id, word_num):
+        return [f'{id}_{s}_{w}' for s, w in zip(self.sentence_num.tolist(), word_num.tolist())]
+
+
+def extract_pos(id, doc):
+    '''
+    Extracts part-of-speech tags from a processed Doc. Returns None for empty documents.
+    '''
+    if len(doc) == 0:
+        return None
+
+    t = TokenArrays(doc)
+    return pd.DataFrame({
+        'identifier': id,
+        'sentence_num': t.sentence_num,
+        'word_num': t.word_num,
+        'word_id': t.word_ids(id, t.word_num),
+        'word': t.strings_for(ORTH),
+        'lemma': t.strings_for(LEMMA),
+        'upos': t.strings_for(POS),
+        'xpos': t.strings_for(TAG),
+        'start_char': t.idx,
+        'end_char': t.end
+    }, columns=Schema.pos_column_order)
+
+
+def extract_depparse(id, doc):
+    '''
+    Extracts dependency relations from a processed Doc. Returns None for empty documents.
+    '''
+    if len(doc) == 0:
+        return None
+
+    t = TokenArrays(doc)
+    words = t.strings_for(ORTH)
+    lemmas = t.strings_for(LEMMA)
+    return pd.DataFrame({
+        'identifier': id,
+        'sentence_num': t.sentence_num,
+        'word_num': t.word_num,
+        'word_id': t.word_ids(id, t.word_num),
+        'word_text': words,
+        'word_lemma': lemmas,
+        'word_start_char': t.idx,
+        'word_end_char': t.end,
+        'relation': t.strings_for(DEP),
+        'head_num': t.head_num,
+        'head_id': t.word_ids(id, t.head_num),
+        'head_text': words[t.head],
+        'head_lemma': lemmas[t.head],
+        'head_start_char': t.idx[t.head],
+        'head_end_char': t.end[t.head]
+    }, columns=Schema.depparse_column_order)
+
+
+def extract_morphology(id, doc, feature_dfs=None):
+    '''
+    Extracts morphological features from a processed Doc. Each distinct analysis is decoded once, and missing features
+    are empty strings. If feature_dfs is a list, the long-format table for the Doc is appended to it. Returns None for
+    empty documents.
+    '''
+    if len(doc) == 0:
+        return None
+
+    t = TokenArrays(doc)
+
+    # Map each distinct MORPH hash to its interned code, then every token to the code of its hash
+    hashes, inverse = np.unique(t.values[:, COLUMNS[MORPH]], return_inverse=True)
+    hash_codes = np.array([feature_decoder.code(t.strings[int(h)] if h else '') for h in hashes], dtype=np.int64)
+    codes = hash_codes[inverse.reshape(-1)]
+
+    word_ids = t.word_ids(id, t.word_num)
+    if feature_dfs is not None:
+        features_df = feature_decoder.long_format([id] * len(word_ids), t.sentence_num.tolist(), t.word_num.tolist(), word_ids,
+                                                   codes.tolist())
+        if features_df is not None:
+            feature_dfs.append([features_df])
+
+    table = {
+        'identifier': id,
+        'sentence_num': t.sentence_num,
+        'word_num': t.word_num,
+        'word_id': word_ids,
+        'word': t.strings_for(ORTH),
+        'lemma': t.strings_for(LEMMA)
+    }
+    table.update(feature_decoder.columns(codes))
+    table['start_char'] = t.idx
+    table['end_char'] = t.end
+
+    return pd.DataFrame(table, columns=Schema.morphology_column_order)
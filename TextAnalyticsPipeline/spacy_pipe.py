@@ -1,347 +1,274 @@
+from functools import partial
+
 import spacy
 import pandas as pd
+from spacy.language import Language
+from spacy.tokens import Span
 
 from .bigquery_tools import Schema, PushTables
-from .data_processor import ProcessResults
+from .config import Language as LanguageConf, OutputConf, Performance, SpacyConf
+from .data_processor import ProcessResults, sentiment_label
+from .language_router import ModelPool, route_documents
+from .memory_budget import AdaptiveBatcher, under_pressure
+from .spacy_docbin import DocBinWriter, read_docbins
+from .spacy_extract import extract_pos, extract_depparse, extract_morphology
+
+
+# Sentence sentiment score from -1 to 1, set by the vader_sentiment component
+Span.set_extension('sentiment', default=None, force=True)
+
+_vader = {}
+
+
+@Language.component('vader_sentiment')
+def vader_sentiment(doc):
+    '''
+    Scores each sentence with the VADER lexicon (English only; requires the NLTK vader_lexicon data).
+    '''
+    if not _vader:
+        from nltk.sentiment.vader import SentimentIntensityAnalyzer
+        _vader['analyzer'] = SentimentIntensityAnalyzer()
+
+    for sentence in doc.sents:
+        sentence._.sentiment = _vader['analyzer'].polarity_scores(sentence.text)['compound']
+
+    return doc
+
+
+def extract_ner(id, doc):
+    '''
+    Extracts named entities from a processed Doc. Returns None if there are no entities.
+    '''
+    # Extract the entities
+    entities = doc.ents
+
+    # Test if there is entities, and, if so, process them
+    if len(entities) == 0:
+        return None
+
+    # Create empty list to hold entities dictionaries
+    entities_list = []
+
+    # Get entities information
+    for ent in entities:
+        entities_list.append({
+            'text': ent.text,
+            'type': ent.label_,
+            'start_char': ent.start_char,
+            'end_char': ent.end_char,
+        })
+
+    # Convert entities list to dataframe and run processor
+    return ProcessResults().process_ner(id, pd.DataFrame(entities_list))
+
+
+def extract_sentiment(id, doc):
+    '''
+    Extracts sentence sentiment scores set by the vader_sentiment component. Returns None for empty documents.
+    '''
+    sentiment_info = []
+    for sentence_num, sentence in enumerate(doc.sents, start=1):
+        score = sentence._.sentiment
+        sentiment_info.append({
+            'sentence_num': sentence_num,
+            'text': sentence.text,
+            'sentiment': sentiment_label(score),
+            'score': score,
+            'start_char': sentence.start_char,
+            'end_char': sentence.end_char
+        })
+
+    if len(sentiment_info) == 0:
+        return None
+
+    return ProcessResults().process_sentiment(id, pd.DataFrame(sentiment_info))
+
+
+# Extraction function and output table schema for each processor
+EXTRACTORS = {
+    'ner': (extract_ner, Schema.ner_schema),
+    'pos': (extract_pos, Schema.pos_schema),
+    'depparse': (extract_depparse, Schema.depparse_schema),
+    'morphology': (extract_morphology, Schema.morphology_schema),
+    'sentiment': (extract_sentiment, Schema.sentiment_schema)
+}
+
+
+# Models loaded in this process, shared by every run (see job_runner.py) and unloaded least recently used first beyond
+# model_memory_mb
+models = ModelPool(LanguageConf.model_memory_mb)
+
+
+def load_model(name, logging=None):
+    return models.get(name, partial(spacy.load, name), logging)
+
+
+def model_name(lang):
+    # spaCy's English and Chinese pipelines are trained on web text, the others on news
+    lang = lang.split('-')[0]
+    genre = 'web' if lang in ('en', 'zh') else 'news'
+    return f'{lang}_core_{genre}_lg'
+
+
+def get_language_model(lang, processor_name, logging):
+    '''
+    Returns the pipeline for the processor in language lang, or in the fallback language if lang has no model
+    installed (with language: 'auto').
+    '''
+    try:
+        # Sentiment only needs tokens and sentence boundaries, so a blank pipeline is used
+        if processor_name == 'sentiment':
+            nlp = spacy.blank(lang.split('-')[0])
+            nlp.add_pipe('sentencizer')
+            nlp.add_pipe('vader_sentiment')
+            if lang != 'en':
+                logging.info(f'The VADER lexicon is English only; scores for language {lang} will be unreliable.')
+            return nlp
+
+        return load_model(model_name(lang), logging)
+
+    except (OSError, ImportError) as e:
+        if not LanguageConf.detect() or lang == LanguageConf.fallback_language:
+            raise
+        logging.info(f'No spaCy {processor_name} model for language {lang} ({e}). Using {LanguageConf.fallback_language}.')
+        return get_language_model(LanguageConf.fallback_language, processor_name, logging)
+
+
+def pipe_groups(groups, processor_name, batcher, logging):
+    '''
+    Yields (identifier, Doc) for each group of (language, identifiers, documents), loading each group's model when
+    the group is reached. With max_memory_mb, documents are piped in the batches formed by batcher, in this process
+    only, since the budget is measured on this process's memory and worker processes would be started for each batch.
+    '''
+    n_process = Performance.processes()
+    if batcher.enabled and n_process > 1:
+        logging.info(f'max_memory_mb is set, so spaCy runs in one process (n_process {Performance.n_process} is not used).')
+
+    for lang, group_ids, group_docs in groups:
+        nlp = get_language_model(lang, processor_name, logging)
+
+        if not batcher.enabled:
+            yield from zip(group_ids, nlp.pipe(group_docs, batch_size=batcher.batch_size, n_process=n_process))
+            continue
+
+        for batch_ids, batch_docs in batcher.batches(group_ids, group_docs):
+            yield from zip(batch_ids, nlp.pipe(batch_docs, batch_size=len(batch_docs)))
+            batcher.update()
+
 
 def run_spacy_pipeline(chunk, n_docs, bq, identifiers, documents, lang, library, processor_class, processor_name, logging, database_import, project, dataset, table, result_dfs):
-    # Initialize the Spacy model
-    nlp = spacy.load(f'{lang}_core_web_lg')
 
-    if processor_name == 'ner':
+    if processor_name not in EXTRACTORS:
+        return
+
+    # Set extraction function and table schema
+    extract, table_schema = EXTRACTORS[processor_name]
 
-        # Set table schema
-        table_schema = Schema.ner_schema
+    conf = SpacyConf()
+    docbin_writer = None
+    languages = None
 
-        count = 0
-        for id, document in zip(identifiers, documents):
+    # Batch sizes adapt to max_memory_mb (see memory_budget.py)
+    batcher = AdaptiveBatcher(Performance().batch_size, logging)
 
-            # Count keeps track of the number of documents processed
-            count = count + 1
+    if conf.derive_from_docbin:
 
-            # Process the document with the Spacy model
-            doc = nlp(document)
+        # Derive mode: annotations are read from saved DocBin shards, so no model is loaded
+        if processor_name == 'sentiment':
+            logging.info('Sentiment cannot be derived from saved DocBins. Exiting.')
+            return
 
-            print(
-                f'Document ID: {id}\n',
-                f'Document Text: {document}'
-            )
+        logging.info(f'Deriving {processor_name} from DocBin shards in {conf.docbin_dir}...')
+        if LanguageConf.detect():
+            lang = LanguageConf.fallback_language
+        docs = read_docbins(conf.docbin_dir, spacy.blank(lang).vocab)
 
-            # Extract the entities
-            entities = doc.ents
-
-            # Process document entities
-            logging.info('Processing documents for entity extraction...')
-            logging.info(f'Processing document id: {id}')
+    else:
 
-            # Test if there is entities, and, if so, process them
-            if len(entities) > 0:
+        # Save every processed Doc so other tables can be derived later without re-running the model
+        if processor_name != 'sentiment' and conf.docbin_dir:
+            docbin_writer = DocBinWriter(conf.docbin_dir, conf.docbin_shard_size, logging)
 
-                # Create empty list to hold entities dictionaries
-                entities_list = []
+        # With language: 'auto', documents are processed in one group per detected language
+        if LanguageConf.detect():
+            groups, languages = route_documents(identifiers, documents, logging)
+        else:
+            groups = [(lang, identifiers, documents)]
 
-                # Get entities information
-                for ent in entities:
-                    entities_list.append({
-                        'text': ent.text,
-                        'type': ent.label_,
-                        'start_char': ent.start_char,
-                        'end_char': ent.end_char,
-                    })
+        docs = pipe_groups(groups, processor_name, batcher, logging)
 
-                # Convert entities list to dataframe
-                df = pd.DataFrame(entities_list)
+    logging.info(f'Processing documents for {processor_name}...')
 
-                # Initialize result processor
-                result_processor = ProcessResults()
-
-                # Run processor
-                entities_df = result_processor.process_ner(id, df)
-
-                # Append results
-                result_dfs.append([entities_df])
-
-                # Check len of result_dfs and if len(result_dfs) == chunk, push chunk to BigQuery
-                if len(result_dfs) == chunk or count > n_docs - chunk:
-                    push_tables = PushTables()
-
-                    push_tables.prepare_chunk_for_push(result_dfs, processor_name, library)
+    # Optional long-format morphology table, pushed alongside the morphology table
+    feature_dfs = None
+    if processor_name == 'morphology' and OutputConf.morphology_features_table:
+        feature_dfs = []
+        extract = partial(extract, feature_dfs=feature_dfs)
 
-                    # Push results_dfs_concat to BigQuery
-                    push_tables.push_to_gbq(
-                        database_import,
-                        bq,
-                        project,
-                        dataset,
-                        table,
-                        table_schema,
-                        library,
-                        logging,
-                        proc=processor_name
-                    )
+    push_tables = PushTables()
+    push_tables.languages = languages
 
-                    # Reset result_dfs
-                    result_dfs = []
+    def push_table(dfs, proc, schema):
+        push_tables.prepare_chunk_for_push(dfs, proc, library)
 
-            else:
-                logging.info('No entities found in document.\n')
+        # Push results_dfs_concat to BigQuery
+        push_tables.push_to_gbq(
+            database_import,
+            bq,
+            project,
+            dataset,
+            table,
+            schema,
+            library,
+            logging,
+            proc=proc
+        )
 
-    elif processor_name == 'pos':
+    def push_chunk(result_dfs):
+        push_table(result_dfs, processor_name, table_schema)
 
-        # Set table schema
-        table_schema = Schema.pos_schema
+        if feature_dfs:
+            push_table(feature_dfs, 'morphology_features', Schema.morphology_features_schema)
+            feature_dfs.clear()
 
-        count = 0
-        for id, document in zip(identifiers, documents):
+    count = 0
+    for id, doc in docs:
 
-            # Count keeps track of the number of documents processed
-            count = count + 1
+        # Count keeps track of the number of documents processed
+        count = count + 1
 
-            # Process the document with the Spacy model
-            doc = nlp(document)
+        logging.info(f'Processing document id: {id}')
 
-            # Process document part-of-speech tagging
-            logging.info('Processing documents for part-of-speech extraction...')
-            logging.info(f'Processing document id: {id}')
-
-            # Initialize result processor
-            result_processor = ProcessResults()
-
-            # Create empty list to hold tokens dictionaries
-            tokens_list = []
-
-            # Initialize sentence number
-            sentence_num = 1
-
-            # Get tokens information
-            for sentence in doc.sents:
-                word_num = 1  # Initialize word_num for each sentence
-                for token in sentence:
-                    tokens_list.append({
-                        'sentence_num': sentence_num,
-                        'word_num': word_num,
-                        'word_id': f'{id}_{sentence_num}_{word_num}',
-                        'word': token.text,
-                        'lemma': token.lemma_,
-                        'upos': token.pos_,
-                        'xpos': token.tag_,
-                        'start_char': token.idx,
-                        'end_char': token.idx + len(token)
-                    })
-                    word_num += 1  # Increment word_num for each word in the sentence
-                sentence_num += 1  # Increment sentence_num for each sentence in the document
-
-            # Convert tokens_list = to dataframe
-            df = pd.DataFrame(tokens_list)
-
-            # Run processor
-            pos_df = result_processor.process_pos(id, df)
-
-            # Append results
-            result_dfs.append([pos_df])
-
-            # Check len of result_dfs and if len(result_dfs) == chunk, push chunk to BigQuery
-            if len(result_dfs) == chunk or count > n_docs - chunk:
-                push_tables = PushTables()
-
-                push_tables.prepare_chunk_for_push(result_dfs, processor_name, library)
-
-                # Push results_dfs_concat to BigQuery
-                push_tables.push_to_gbq(
-                    database_import,
-                    bq,
-                    project,
-                    dataset,
-                    table,
-                    table_schema,
-                    library,
-                    logging,
-                    proc=processor_name
-                )
-
-                # Reset result_dfs
-                result_dfs = []
-
-    elif processor_name == 'depparse':
-
-        # Set table schema
-        table_schema = Schema.depparse_schema
-
-        count = 0
-        for id, document in zip(identifiers, documents):
-
-            # Count keeps track of the number of documents processed
-            count = count + 1
-
-            # Process the document with the Spacy model
-            doc = nlp(document)
-
-            # Process depparse
-            logging.info('Processing documents for dependency parsing extraction...')
-            logging.info(f'Processing document id: {id}')
-
-            # Initialize result processor
-            result_processor = ProcessResults()
-
-            # Initialize sentence number
-            sentence_num = 1
-
-            # Get information
-            dependency_info = []
-            for sentence in doc.sents:
-
-                word_counter = 1
-                word_positions = {}  # Dictionary to store word positions within each sentence
-                for token in sentence:
-                    word_positions[token.i] = word_counter
-                    word_counter += 1
-
-                for token in sentence:
-                    head_token = token.head
-                    dependency_info.append({
-                        'sentence_num': sentence_num,
-                        'word_num': word_positions[token.i],
-                        'word_id': f'{id}_{sentence_num}_{word_positions[token.i]}',
-                        'word_text': token.text,
-                        'word_lemma': token.lemma_,
-                        'start_char': token.idx,
-                        'end_char': token.idx + len(token),
-                        'relation': token.dep_,
-                        'head_num': word_positions[head_token.i] if head_token.i in word_positions else 0,
-                        'head_id': f'{id}_{sentence_num}_{word_positions[head_token.i] if head_token.i in word_positions else 0}',
-                        'head_text': head_token.text,
-                        'head_lemma': head_token.lemma_,
-                        'head_start_char': head_token.idx,
-                        'head_end_char': head_token.idx + len(head_token)
-                    })
-                sentence_num += 1  # Increment sentence_num for each sentence in the document
-
-            # Transform in df
-            df = pd.DataFrame(dependency_info)
-
-            # Run processor
-            depparse_df = result_processor.process_depparse(id, df)
-
-            # Append results
-            result_dfs.append([depparse_df])
-
-            # Check len of result_dfs and if len(result_dfs) == chunk, push chunk to BigQuery
-            if len(result_dfs) == chunk or count > n_docs - chunk:
-                push_tables = PushTables()
-
-                push_tables.prepare_chunk_for_push(result_dfs, processor_name, library)
-
-                # Push results_dfs_concat to BigQuery
-                push_tables.push_to_gbq(
-                    database_import,
-                    bq,
-                    project,
-                    dataset,
-                    table,
-                    table_schema,
-                    library,
-                    logging,
-                    proc=processor_name
-                )
-
-                # Reset result_dfs
-                result_dfs = []
-
-    elif processor_name == 'morphology':
-
-        # Set table schema
-        table_schema = Schema.morphology_schema
-
-        count = 0
-        for id, document in zip(identifiers, documents):
-
-            # Count keeps track of the number of documents processed
-            count = count + 1
-
-            # Process the document with the Spacy model
-            doc = nlp(document)
-
-            # Process depparse
-            logging.info('Processing documents for morphology extraction...')
-            logging.info(f'Processing document id: {id}')
-
-            # Initialize result processor
-            result_processor = ProcessResults()
-
-            # Initialize sentence number
-            sentence_num = 1
-
-            # Run extraction
-            morphology_info = []
-            for sentence in doc.sents:
-                word_num = 1  # Initialize word_num for each sentence
-                for token in sentence:
-                    # Extracting token attributes
-                    morphology_row = {
-                        'sentence_num': sentence_num,
-                        'word_num': word_num,
-                        'word_id': f'{id}_{sentence_num}_{word_num}',
-                        'word': token.text,
-                        'lemma': token.lemma_,
-                        'features_Number': token.morph.get('Number'),
-                        'features_Mood': token.morph.get('Mood'),
-                        'features_Person': token.morph.get('Person'),
-                        'features_Tense': token.morph.get('Tense'),
-                        'features_VerbForm': token.morph.get('VerbForm'),
-                        'features_Case': token.morph.get('Case'),
-                        'features_Gender': token.morph.get('Gender'),
-                        'features_PronType': token.morph.get('PronType'),
-                        'features_Degree': token.morph.get('Degree'),
-                        'features_Definite': token.morph.get('Definite'),
-                        'features_NumForm': token.morph.get('NumForm'),
-                        'features_NumType': token.morph.get('NumType'),
-                        'features_Voice': token.morph.get('Voice'),
-                        'start_char': token.idx,
-                        'end_char': token.idx + len(token),
-                    }
-                    word_num += 1  # Increment word_num for each word in the sentence
-
-                    for key, value in morphology_row.items():
-
-                        if isinstance(value, list):
-                            if len(value) > 0:
-                                morphology_row[key] = value[0]
-                            else:
-                                morphology_row[key] = ''
-
-                    morphology_info.append(morphology_row)
-                sentence_num += 1  # Increment sentence_num for each sentence in the document
-
-            # Transform in df
-            df = pd.DataFrame(morphology_info)
-
-            # Run processor
-            morphology_df = result_processor.process_morphology(id, df)
-
-            # Append results
-            result_dfs.append([morphology_df])
-
-            # Check len of result_dfs and if len(result_dfs) == chunk, push chunk to BigQuery
-            if len(result_dfs) == chunk or count > n_docs - chunk:
-                push_tables = PushTables()
-
-                push_tables.prepare_chunk_for_push(result_dfs, processor_name, library)
-
-                # Push results_dfs_concat to BigQuery
-                push_tables.push_to_gbq(
-                    database_import,
-                    bq,
-                    project,
-                    dataset,
-                    table,
-                    table_schema,
-                    library,
-                    logging,
-                    proc=processor_name
-                )
-
-                # Reset result_dfs
-                result_dfs = []
+        if docbin_writer is not None:
+            docbin_writer.add(id, doc)
 
-    else:
-        result_dfs = None
\ No newline at end of file
+        # Run extraction
+        df = extract(id, doc)
+
+        # Append results
+        if df is not None:
+            result_dfs.append([df])
+        else:
+            logging.info(f'No {processor_name} results found in document.\n')
+
+        # Check len of result_dfs and if len(result_dfs) >= chunk, push chunk to BigQuery (sooner if memory is
+        # running short)
+        if len(result_dfs) >= chunk or (len(result_dfs) > 0 and under_pressure()):
+            push_chunk(result_dfs)
+
+            # Reset result_dfs
+            result_dfs = []
+
+    # Push any remaining results
+    if len(result_dfs) > 0:
+        push_chunk(result_dfs)
+
+    # Finish any open write streams
+    push_tables.close()
+
+    if docbin_writer is not None:
+        docbin_writer.close()
+
+    batcher.report()
+
+    logging.info(f'Processed {count} of {n_docs} documents')
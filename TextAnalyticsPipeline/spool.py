@@ -0,0 +1,251 @@
+'''
+Local spool for output tables, used with sink: spool.
+
+Instead of a load job for every chunk, each chunk is written as a zstd-compressed Parquet shard in a directory of its
+own for the run (so concurrent runs on one machine do not share temp files). At the end of the run the shards of each
+destination table are loaded with a handful of load jobs: a single multi-URI job if spool_gcs_uri is set (the shards
+are uploaded there first), otherwise one job per group of shards up to spool_load_mb.
+
+manifest.json in the run directory records the destination, schema and load state of every shard, so a failed upload
+can be retried without running the NLP again:
+    python -m TextAnalyticsPipeline.spool TextAnalyticsPipeline/spool/run_20240101120000_1234
+'''
+
+import os
+import io
+import sys
+import json
+import glob
+import shutil
+import logging
+import itertools
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from google.cloud import bigquery
+
+
+MANIFEST = 'manifest.json'
+
+# Distinguishes runs started in the same second by one process (see job_runner.py)
+run_numbers = itertools.count()
+
+ARROW_TYPES = {
+    'STRING': pa.string(),
+    'INTEGER': pa.int64(),
+    'INT64': pa.int64(),
+    'FLOAT': pa.float64(),
+    'FLOAT64': pa.float64(),
+    'BOOLEAN': pa.bool_(),
+    'BOOL': pa.bool_()
+}
+
+
+def arrow_field(field):
+    if field.field_type == 'RECORD':
+        arrow_type = pa.struct([arrow_field(subfield) for subfield in field.fields])
+    else:
+        arrow_type = ARROW_TYPES[field.field_type]
+    if field.mode == 'REPEATED':
+        arrow_type = pa.list_(arrow_type)
+    return pa.field(field.name, arrow_type)
+
+
+def arrow_schema(schema):
+    return pa.schema([arrow_field(field) for field in schema])
+
+
+def string_record(record, schema):
+    '''
+    Returns a copy of a nested record with the values of STRING fields (at any level) converted to strings.
+    '''
+    record = dict(record)
+    for field in schema:
+        value = record.get(field.name)
+        if value is None:
+            continue
+        if field.field_type == 'RECORD':
+            if field.mode == 'REPEATED':
+                record[field.name] = [string_record(item, field.fields) for item in value]
+            else:
+                record[field.name] = string_record(value, field.fields)
+        elif field.field_type == 'STRING' and not isinstance(value, str):
+            record[field.name] = str(value)
+    return record
+
+
+def to_arrow(data, schema):
+    '''
+    Converts a chunk (a DataFrame, or a list of nested records) to an Arrow table with the types of the BigQuery
+    schema. Values that do not match a STRING field (e.g. numeric identifiers, or head_num in the wide depparse schema)
+    are converted to strings first, as BigQuery checks Parquet column types against the schema.
+    '''
+    if isinstance(data, list):
+        return pa.Table.from_pylist([string_record(record, schema) for record in data], schema=arrow_schema(schema))
+
+    data = data.copy()
+    for field in schema:
+        if field.field_type == 'STRING' and data[field.name].dtype != object:
+            data[field.name] = data[field.name].astype(object).where(data[field.name].notna(), None).map(
+                lambda value: value if value is None else str(value))
+    return pa.Table.from_pandas(data, schema=arrow_schema(schema), preserve_index=False)
+
+
+class Spool:
+
+    def __init__(self, directory, logging):
+        self.directory = directory
+        self.logging = logging
+
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(os.path.join(directory, MANIFEST), encoding='utf-8') as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            self.manifest = {}
+
+    @classmethod
+    def for_run(cls, root, logging):
+        run_id = f'run_{datetime.now().strftime("%Y%m%d%H%M%S")}_{os.getpid()}_{next(run_numbers)}'
+        return cls(os.path.join(root, run_id), logging)
+
+    def save_manifest(self):
+        path = os.path.join(self.directory, MANIFEST)
+        with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(f'{path}.tmp', path)
+
+    def write(self, destination, schema, data, clustering_fields=None):
+        '''
+        Writes one chunk for the destination table as a new Parquet shard.
+        '''
+        entry = self.manifest.setdefault(destination, {
+            'schema': [field.to_api_repr() for field in schema],
+            'clustering_fields': clustering_fields,
+            'shards': []
+        })
+
+        table_dir = os.path.join(self.directory, destination)
+        os.makedirs(table_dir, exist_ok=True)
+        shard = os.path.join(destination, f'part_{len(entry["shards"]):06d}.parquet')
+
+        arrow_table = to_arrow(data, schema)
+        pq.write_table(arrow_table, os.path.join(self.directory, shard), compression='zstd')
+
+        entry['shards'].append({'file': shard, 'rows': arrow_table.num_rows, 'loaded': False})
+        self.save_manifest()
+        self.logging.info(f'Spooled {arrow_table.num_rows} rows for {destination} to {shard}')
+
+    def job_config(self, entry):
+        job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.PARQUET,
+            schema=[bigquery.SchemaField.from_api_repr(field) for field in entry['schema']],
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND
+        )
+        parquet_options = bigquery.format_options.ParquetOptions()
+        parquet_options.enable_list_inference = True
+        job_config.parquet_options = parquet_options
+        if entry['clustering_fields']:
+            job_config.clustering_fields = entry['clustering_fields']
+        return job_config
+
+    def load(self, bq, gcs_uri='', load_mb=1024):
+        '''
+        Loads every shard not yet loaded. Returns True when all shards are loaded, after which the run directory is
+        removed; on failure the spool is left in place to be retried.
+        '''
+        for destination, entry in self.manifest.items():
+            shards = [shard for shard in entry['shards'] if not shard['loaded']]
+            if len(shards) == 0:
+                continue
+
+            try:
+                if gcs_uri:
+                    self.load_from_gcs(bq, destination, entry, shards, gcs_uri)
+                else:
+                    self.load_from_files(bq, destination, entry, shards, load_mb * 1024 * 1024)
+            except Exception as e:
+                self.logging.info(f'Failed to load spooled output to {destination}: {e}')
+
+        if all(shard['loaded'] for entry in self.manifest.values() for shard in entry['shards']):
+            shutil.rmtree(self.directory)
+            self.logging.info(f'All spooled output loaded. Removed {self.directory}')
+            return True
+        return False
+
+    def mark_loaded(self, shards):
+        for shard in shards:
+            shard['loaded'] = True
+        self.save_manifest()
+
+    def load_from_gcs(self, bq, destination, entry, shards, gcs_uri):
+        from google.cloud import storage
+
+        bucket_name, _, prefix = gcs_uri[len('gs://'):].partition('/')
+        bucket = storage.Client(project=bq.project).bucket(bucket_name)
+        run_prefix = '/'.join(part for part in [prefix.strip('/'), os.path.basename(self.directory)] if part)
+
+        uris = []
+        for shard in shards:
+            blob_name = f'{run_prefix}/{shard["file"]}'
+            bucket.blob(blob_name).upload_from_filename(os.path.join(self.directory, shard['file']))
+            uris.append(f'gs://{bucket_name}/{blob_name}')
+        self.logging.info(f'Uploaded {len(uris)} shards for {destination} to gs://{bucket_name}/{run_prefix}')
+
+        job = bq.load_table_from_uri(uris, destination, job_config=self.job_config(entry))
+        job.result()
+        self.mark_loaded(shards)
+        self.logging.info(f'Loaded {sum(shard["rows"] for shard in shards)} rows to {destination} in one load job')
+
+        for uri in uris:
+            bucket.blob(uri[len(f'gs://{bucket_name}/'):]).delete()
+
+    def load_from_files(self, bq, destination, entry, shards, max_bytes):
+        # Shards are combined into files of up to max_bytes, each loaded with one job
+        groups, group, size = [], [], 0
+        for shard in shards:
+            shard_size = os.path.getsize(os.path.join(self.directory, shard['file']))
+            if group and size + shard_size > max_bytes:
+                groups.append(group)
+                group, size = [], 0
+            group.append(shard)
+            size = size + shard_size
+        groups.append(group)
+
+        for group in groups:
+            combined = pa.concat_tables([pq.read_table(os.path.join(self.directory, shard['file'])) for shard in group])
+            buffer = io.BytesIO()
+            pq.write_table(combined, buffer, compression='zstd')
+            buffer.seek(0)
+
+            job = bq.load_table_from_file(buffer, destination, job_config=self.job_config(entry))
+            job.result()
+            self.mark_loaded(group)
+            self.logging.info(f'Loaded {combined.num_rows} rows from {len(group)} shards to {destination}')
+
+
+def main():
+    from .bigquery_tools import GBQCreds
+    from .config import SinkConf
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    directories = sys.argv[1:] or sorted(glob.glob(os.path.join(SinkConf.spool_dir, 'run_*')))
+
+    for directory in directories:
+        spool = Spool(directory, logging)
+        if len(spool.manifest) == 0:
+            continue
+
+        project = next(iter(spool.manifest)).split('.')[0]
+        gbq_creds = GBQCreds()
+        gbq_creds.get_gbq_creds(project)
+        bq = gbq_creds.get_client(project)
+
+        logging.info(f'Loading spooled output from {directory}...')
+        spool.load(bq, SinkConf.spool_gcs_uri, SinkConf.spool_load_mb)
+
+
+if __name__ == '__main__':
+    main()
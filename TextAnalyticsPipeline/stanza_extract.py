@@ -0,0 +1,226 @@
+'''
+Bulk extraction of output tables from processed Stanza Documents.
+
+Each function walks a whole batch of (identifier, Document, offset fix) tuples once, reading word and entity attributes
+directly and appending them to per-column buffers (typed integer arrays for numbering, lists for strings and
+offsets). A single DataFrame is built for the batch, rather than one DataFrame per document via to_dict and
+json_normalize.
+'''
+
+from array import array
+
+import numpy as np
+import pandas as pd
+
+from .bigquery_tools import Schema
+from .data_processor import ProcessResults, sentiment_label
+from .morphology import FeatureDecoder
+
+
+# Feature strings are interned for the whole run; missing features are None, as in the original Stanza output
+feature_decoder = FeatureDecoder(missing=None, first_value_only=False)
+
+
+def to_frame(columns, column_order):
+    '''
+    Builds the batch DataFrame from the column buffers, or returns None if the batch produced no rows.
+    '''
+    if len(columns[column_order[0]]) == 0:
+        return None
+
+    return pd.DataFrame({
+        name: pd.array(values, dtype='Int64') if name.endswith('_char') else values
+        for name, values in columns.items()
+    }, columns=column_order)
+
+
+def extract_ner(batch):
+    identifier, text, type, start_char, end_char = [], [], [], [], []
+
+    for id, doc, fix in batch:
+        for ent in doc.entities:
+            identifier.append(id)
+            text.append(ent.text)
+            type.append(ent.type)
+            start_char.append(fix(ent.start_char))
+            end_char.append(fix(ent.end_char))
+
+    return to_frame({
+        'identifier': identifier,
+        'text': text,
+        'type': type,
+        'start_char': start_char,
+        'end_char': end_char
+    }, Schema.ner_column_order)
+
+
+def extract_pos(batch):
+    identifier, word_id, word, lemma, upos, xpos, start_char, end_char = [], [], [], [], [], [], [], []
+    sentence_num, word_num = array('q'), array('q')
+
+    for id, doc, fix in batch:
+        for sent_num, sentence in enumerate(doc.sentences, start=1):
+            for w in sentence.words:
+                identifier.append(id)
+                sentence_num.append(sent_num)
+                word_num.append(w.id)
+                word_id.append(f'{id}_{sent_num}_{w.id}')
+                word.append(w.text)
+                lemma.append(w.lemma)
+                upos.append(w.upos)
+                xpos.append(w.xpos)
+                start_char.append(fix(w.start_char))
+                end_char.append(fix(w.end_char))
+
+    return to_frame({
+        'identifier': identifier,
+        'sentence_num': np.frombuffer(sentence_num, dtype=np.int64),
+        'word_num': np.frombuffer(word_num, dtype=np.int64),
+        'word_id': word_id,
+        'word': word,
+        'lemma': lemma,
+        'upos': upos,
+        'xpos': xpos,
+        'start_char': start_char,
+        'end_char': end_char
+    }, Schema.pos_column_order)
+
+
+def extract_depparse(batch):
+    '''
+    Heads are resolved with one array take over the whole batch: each word records the batch-wide position of its head
+    (itself for the root) instead of looking up the head Word object.
+    '''
+    identifier, word_id, word_text, word_lemma, word_start_char, word_end_char = [], [], [], [], [], []
+    relation, head_id = [], []
+    sentence_num, word_num, head_num, head_index = array('q'), array('q'), array('q'), array('q')
+
+    for id, doc, fix in batch:
+        for sentence in doc.sentences:
+            sent_num = sentence.index + 1
+            sentence_start = len(word_num)
+            for w in sentence.words:
+                identifier.append(id)
+                sentence_num.append(sent_num)
+                word_num.append(w.id)
+                word_id.append(f'{id}_{sent_num}_{w.id}')
+                word_text.append(w.text)
+                word_lemma.append(w.lemma)
+                word_start_char.append(fix(w.start_char))
+                word_end_char.append(fix(w.end_char))
+
+                # The root is its own head, with the relation in upper case
+                if w.deprel == 'root':
+                    relation.append('ROOT')
+                    head = w.id
+                else:
+                    relation.append(w.deprel)
+                    head = w.head
+                head_num.append(head)
+                head_id.append(f'{id}_{sent_num}_{head}')
+                head_index.append(sentence_start + head - 1)
+
+    head_index = np.frombuffer(head_index, dtype=np.int64)
+    text_values = np.array(word_text, dtype=object)
+    lemma_values = np.array(word_lemma, dtype=object)
+    start_values = pd.array(word_start_char, dtype='Int64')
+    end_values = pd.array(word_end_char, dtype='Int64')
+
+    return to_frame({
+        'identifier': identifier,
+        'sentence_num': np.frombuffer(sentence_num, dtype=np.int64),
+        'word_num': np.frombuffer(word_num, dtype=np.int64),
+        'word_id': word_id,
+        'word_text': word_text,
+        'word_lemma': word_lemma,
+        'word_start_char': start_values,
+        'word_end_char': end_values,
+        'relation': relation,
+        'head_num': np.frombuffer(head_num, dtype=np.int64),
+        'head_id': head_id,
+        'head_text': text_values[head_index],
+        'head_lemma': lemma_values[head_index],
+        'head_start_char': start_values.take(head_index),
+        'head_end_char': end_values.take(head_index)
+    }, Schema.depparse_column_order)
+
+
+def extract_morphology(batch, feature_dfs=None):
+    '''
+    Each word's feats string is mapped to an interned code, and the feature columns are filled for the whole batch
+    from the codes. If feature_dfs is a list, the long-format table for the batch is appended to it.
+    '''
+    identifier, word_id, word, lemma, start_char, end_char = [], [], [], [], [], []
+    sentence_num, word_num, codes = array('q'), array('q'), array('q')
+    code = feature_decoder.code
+
+    for id, doc, fix in batch:
+        for sentence in doc.sentences:
+            sent_num = sentence.index + 1
+            for w in sentence.words:
+                identifier.append(id)
+                sentence_num.append(sent_num)
+                word_num.append(w.id)
+                word_id.append(f'{id}_{sent_num}_{w.id}')
+                word.append(w.text)
+                lemma.append(w.lemma)
+                start_char.append(fix(w.start_char))
+                end_char.append(fix(w.end_char))
+                codes.append(code(w.feats))
+
+    if feature_dfs is not None:
+        features_df = feature_decoder.long_format(identifier, sentence_num, word_num, word_id, codes)
+        if features_df is not None:
+            feature_dfs.append([features_df])
+
+    columns = {
+        'identifier': identifier,
+        'sentence_num': np.frombuffer(sentence_num, dtype=np.int64),
+        'word_num': np.frombuffer(word_num, dtype=np.int64),
+        'word_id': word_id,
+        'word': word,
+        'lemma': lemma
+    }
+    columns.update(feature_decoder.columns(np.frombuffer(codes, dtype=np.int64)))
+    columns['start_char'] = start_char
+    columns['end_char'] = end_char
+
+    return to_frame(columns, Schema.morphology_column_order)
+
+
+def extract_sentiment(batch):
+    result_processor = ProcessResults()
+
+    dfs = []
+    for id, doc, fix in batch:
+
+        # Stanza labels sentences 0 (negative), 1 (neutral) or 2 (positive); shift to a -1 to 1 score
+        sentiment_info = []
+        for sentence_num, sentence in enumerate(doc.sentences, start=1):
+            score = sentence.sentiment - 1
+            sentiment_info.append({
+                'sentence_num': sentence_num,
+                'text': sentence.text,
+                'sentiment': sentiment_label(score),
+                'score': float(score),
+                'start_char': fix(sentence.tokens[0].start_char),
+                'end_char': fix(sentence.tokens[-1].end_char)
+            })
+
+        if len(sentiment_info) > 0:
+            dfs.append(result_processor.process_sentiment(id, pd.DataFrame(sentiment_info)))
+
+    if len(dfs) == 0:
+        return None
+
+    return pd.concat(dfs, ignore_index=True)
+
+
+# Extraction function and output table schema for each processor
+EXTRACTORS = {
+    'ner': (extract_ner, Schema.ner_schema),
+    'pos': (extract_pos, Schema.pos_schema),
+    'depparse': (extract_depparse, Schema.depparse_schema),
+    'morphology': (extract_morphology, Schema.morphology_schema),
+    'sentiment': (extract_sentiment, Schema.sentiment_schema)
+}
@@ -1,333 +1,303 @@
+import re
+import json
+from bisect import bisect_right
+from functools import partial
+
+import torch
 import stanza
-import pandas as pd
 
 from .bigquery_tools import Schema, PushTables
-from .data_processor import ProcessResults
-
-def run_stanza_pipeline(chunk, n_docs, bq, identifiers, documents, lang, library, processor_class, processor_name, logging, database_import, project, dataset, table, result_dfs):
-    # Initialize the Stanza model
-    nlp = stanza.Pipeline(f'{lang}', processors=f'tokenize,mwt,{processor_class}', download_method=None)
-
-    if processor_name == 'ner':
-
-        # Set table schema
-        table_schema = Schema.ner_schema
-
-        logging.info('Processing documents for entity extraction...')
+from .config import InputConf, Language, OutputConf, Performance, StanzaConf
+from .language_router import ModelPool, route_documents
+from .memory_budget import AdaptiveBatcher, under_pressure
+from .stanza_extract import EXTRACTORS
+
+
+def get_tokenize_options(input_format):
+    '''
+    Returns the Stanza tokenizer options for the configured input_format:
+        - raw: the tokenizer splits sentences and tokens
+        - sentences: one sentence per line; the tokenizer only splits tokens
+        - tokens: one sentence per line with whitespace-separated tokens; the tokenizer neural net is skipped entirely
+        - token_lists: a JSON list of token lists per document, also skipping the tokenizer
+    '''
+    if input_format in ('tokens', 'token_lists'):
+        return {'tokenize_pretokenized': True}
+    elif input_format == 'sentences':
+        return {'tokenize_no_ssplit': True}
+    else:
+        return {}
+
+
+def no_offset_change(char):
+    return char
+
+
+def whitespace_tokens(document):
+    '''
+    Splits a document into one sentence per line of whitespace-separated tokens. Returns the sentences and a function
+    mapping Stanza's offsets back to the document.
+    '''
+    # Stanza computes offsets as if tokens were joined by exactly one space or newline, so record where each token
+    # really starts and ends in the original document
+    sentences = []
+    offset_map = {}
+    stanza_char = 0
+    for line in re.finditer(r'[^\n]+', document):
+        sentence = []
+        for token in re.finditer(r'\S+', line.group()):
+            start_char = line.start() + token.start()
+            offset_map[stanza_char] = start_char
+            offset_map[stanza_char + len(token.group())] = start_char + len(token.group())
+            stanza_char += len(token.group()) + 1
+            sentence.append(token.group())
+        if len(sentence) > 0:
+            sentences.append(sentence)
+
+    return sentences, offset_map.get
+
+
+def prepare_input(document, input_format):
+    '''
+    Converts a document to the input Stanza expects for the configured input_format. Returns the input and a function
+    that maps Stanza's character offsets back to offsets in the original document.
+    '''
+    if input_format == 'token_lists':
+
+        # Token lists have no original text; Stanza's offsets against the space-joined tokens are kept as they are. A
+        # document that is not a JSON list of token lists is read as whitespace-separated tokens instead.
+        try:
+            sentences = json.loads(document)
+        except ValueError:
+            sentences = None
+        if isinstance(sentences, list) and all(isinstance(sentence, list) for sentence in sentences):
+            return [[str(token) for token in sentence] for sentence in sentences], no_offset_change
+        return whitespace_tokens(document)
+
+    elif input_format == 'tokens':
+        return whitespace_tokens(document)
+
+    elif input_format == 'sentences':
+
+        # With tokenize_no_ssplit Stanza only breaks sentences at blank lines, so every newline is doubled. Offsets
+        # are shifted back by the number of newlines inserted before them.
+        newlines = [match.start() + i for i, match in enumerate(re.finditer('\n', document))]
+
+        def fix(char):
+            if char is None:
+                return None
+            return char - bisect_right(newlines, char - 1)
+
+        return document.replace('\n', '\n\n'), fix
 
-        count = 0
-        for id, document in zip(identifiers, documents):
+    else:
+        return document, no_offset_change
+
+
+# Pipelines loaded in this process, shared by every run (see job_runner.py) and unloaded least recently used first
+# beyond model_memory_mb
+pipelines = ModelPool(Language.model_memory_mb)
+
+
+# Sentence processed after quantisation, to check that the quantised layers work in the pipeline
+QUANTIZATION_CHECK = 'The quantised pipeline processed this sentence.'
+
+
+def processor_models(processor):
+    '''
+    Returns the torch models of a Stanza processor (NER can hold several).
+    '''
+    trainers = getattr(processor, 'trainers', None) or [getattr(processor, '_trainer', None)]
+    models = [getattr(trainer, 'model', None) for trainer in trainers if trainer is not None]
+    models.append(getattr(processor, '_model', None))
+
+    unique = []
+    for model in models:
+        if isinstance(model, torch.nn.Module) and not any(model is other for other in unique):
+            unique.append(model)
+    return unique
+
+
+def quantize_pipeline(nlp, processor_names, layers):
+    '''
+    Converts the given layer types of the named processors' models to dynamic int8, in place. Returns the number of
+    models quantised.
+    '''
+    n_models = 0
+    for name, processor in nlp.processors.items():
+        if name in processor_names:
+            for model in processor_models(processor):
+                torch.ao.quantization.quantize_dynamic(model, layers, dtype=torch.qint8, inplace=True)
+                n_models += 1
+    return n_models
+
+
+def load_pipeline(lang, processors, tokenize_options, quantize=(), logging=None):
+    '''
+    Loads a Stanza pipeline. With quantize, the Linear and LSTM layers of the named processors are quantised to int8.
+    If the pipeline then fails on a test sentence, it is reloaded with only the Linear layers quantised, and failing
+    that without quantisation.
+    '''
+    def load():
+        return stanza.Pipeline(f'{lang}', processors=processors, download_method=None, **tokenize_options)
+
+    nlp = load()
+    quantize = [name for name in quantize if name in [p.strip() for p in processors.split(',')]]
+    if not quantize:
+        return nlp
+
+    if 'cuda' in str(getattr(nlp, 'device', 'cpu')):
+        if logging is not None:
+            logging.info('Stanza is running on a GPU; int8 dynamic quantisation is CPU only and is not applied.')
+        return nlp
+
+    for layers in ({torch.nn.Linear, torch.nn.LSTM}, {torch.nn.Linear}):
+        n_models = quantize_pipeline(nlp, quantize, layers)
+        try:
+            nlp(QUANTIZATION_CHECK)
+        # Some Stanza modules read LSTM weights directly, which quantised LSTMs do not have
+        except Exception as e:
+            if logging is not None:
+                logging.info(f'Stanza {",".join(quantize)} failed with quantised {"/".join(l.__name__ for l in layers)} '
+                             f'layers ({e}). Reloading...')
+            nlp = load()
+            continue
+
+        if logging is not None:
+            logging.info(f'Quantised the {"/".join(l.__name__ for l in layers)} layers of {n_models} Stanza models '
+                         f'({",".join(quantize)}) to int8')
+        return nlp
+
+    return nlp
+
+
+def get_pipeline(lang, processors, tokenize_options, logging=None, quantize=None):
+    quantize = tuple(StanzaConf.quantize if quantize is None else quantize)
+    key = (lang, processors, tuple(sorted(tokenize_options.items())), quantize)
+    return pipelines.get(key, partial(load_pipeline, lang, processors, tokenize_options, quantize, logging), logging)
+
+
+def get_language_pipeline(lang, processor_class, processor_name, tokenize_options, logging):
+    '''
+    Returns the pipeline for the processor in language lang, or in the fallback language if lang has no model
+    installed (with language: 'auto').
+    '''
+    # Sentiment only needs the tokenizer, so no other processors are loaded
+    if processor_name == 'sentiment':
+        processors = 'tokenize,sentiment'
+    else:
+        processors = f'tokenize,mwt,{processor_class}'
 
-            # Count keeps track of the number of documents processed
-            count = count + 1
+    try:
+        return get_pipeline(lang, processors, tokenize_options, logging)
+    except (OSError, ValueError) as e:
+        if not Language.detect() or lang == Language.fallback_language:
+            raise
+        logging.info(f'No Stanza {processor_name} model for language {lang} ({e}). Using {Language.fallback_language}.')
+        return get_pipeline(Language.fallback_language, processors, tokenize_options, logging)
 
-            # Process the document with the Stanza model
-            doc = nlp(document)
 
-            print(
-                f'Document ID: {id}\n',
-                f'Document Text: {document}'
-            )
+def run_stanza_pipeline(chunk, n_docs, bq, identifiers, documents, lang, library, processor_class, processor_name, logging, database_import, project, dataset, table, result_dfs):
 
-            # Extract the entities
-            entities = doc.entities
+    if processor_name not in EXTRACTORS:
+        return
 
-            # Process document entities
-            logging.info(f'Processing document id: {id}')
+    # Set extraction function and table schema
+    extract, table_schema = EXTRACTORS[processor_name]
 
-            # Test if there are entities in the output, and, if so, process them
-            if len(entities) > 0:
+    # Tokenizer options for pre-tokenized or pre-segmented input
+    input_format = InputConf.input_format
+    tokenize_options = get_tokenize_options(input_format)
+    logging.info(f'Input format: {input_format}')
 
-                # Convert entities to dataframe and extract dictionary values
-                df = pd.DataFrame(entities)
+    perf = Performance()
+    batch_size = perf.batch_size
 
-                # Transform the stanza output to a dict
-                df[0] = df[0].apply(lambda x: x.to_dict())
+    if perf.torch_threads:
+        torch.set_num_threads(perf.torch_threads)
 
-                # Extract values from dictionary
-                df = pd.json_normalize(df[0])
+    # Batch sizes adapt to max_memory_mb (see memory_budget.py)
+    batcher = AdaptiveBatcher(batch_size, logging)
 
-                # Initialise result processor
-                result_processor = ProcessResults()
+    logging.info(f'Processing documents for {processor_name} in batches of {batch_size}...')
 
-                # Run processor
-                entities_df = result_processor.process_ner(id, df)
+    # Optional long-format morphology table, pushed alongside the morphology table
+    feature_dfs = None
+    if processor_name == 'morphology' and OutputConf.morphology_features_table:
+        feature_dfs = []
+        extract = partial(extract, feature_dfs=feature_dfs)
 
-                # Append results
-                result_dfs.append([entities_df])
+    push_tables = PushTables()
 
-                # Check len of result_dfs and if len(result_dfs) == chunk, push chunk to BigQuery
-                if len(result_dfs) == chunk or count > n_docs - chunk:
+    # With language: 'auto', documents are processed in one group per detected language
+    if Language.detect():
+        groups, push_tables.languages = route_documents(identifiers, documents, logging)
+    else:
+        groups = [(lang, identifiers, documents)]
 
-                    push_tables = PushTables()
+    def push_table(dfs, proc, schema):
+        push_tables.prepare_chunk_for_push(dfs, proc, library)
 
-                    push_tables.prepare_chunk_for_push(result_dfs, processor_name, library)
+        # Push results_dfs_concat to BigQuery
+        push_tables.push_to_gbq(
+            database_import,
+            bq,
+            project,
+            dataset,
+            table,
+            schema,
+            library,
+            logging,
+            proc=proc
+        )
 
-                    # Push results_dfs_concat to BigQuery
-                    push_tables.push_to_gbq(
-                        database_import,
-                        bq,
-                        project,
-                        dataset,
-                        table,
-                        table_schema,
-                        library,
-                        logging,
-                        proc=processor_name
-                    )
+    def push_chunk(result_dfs):
+        push_table(result_dfs, processor_name, table_schema)
 
-                    # Reset result_dfs
-                    result_dfs = []
+        if feature_dfs:
+            push_table(feature_dfs, 'morphology_features', Schema.morphology_features_schema)
+            feature_dfs.clear()
 
-            else:
-                logging.info('No entities found in document.\n')
+    # Number of documents in result_dfs, which holds one dataframe per batch
+    pending_docs = 0
 
-    elif processor_name == 'pos':
+    count = 0
+    for group_lang, group_ids, group_docs in groups:
 
-        # Set table schema
-        table_schema = Schema.pos_schema
+        # Initialize the Stanza model for the group's language
+        nlp = get_language_pipeline(group_lang, processor_class, processor_name, tokenize_options, logging)
 
-        logging.info('Processing documents for part-of-speech extraction...')
+        for batch_ids, batch_docs in batcher.batches(group_ids, group_docs):
 
-        count = 0
-        for id, document in zip(identifiers, documents):
+            # Process the batch of documents with the Stanza model in a single call
+            prepared = [prepare_input(document, input_format) for document in batch_docs]
+            docs = nlp([stanza.Document([], text=doc_input) for doc_input, _ in prepared])
+            batcher.update()
 
             # Count keeps track of the number of documents processed
-            count = count + 1
-
-            # Process the document with the Stanza model
-            doc = nlp(document)
-
-            # Extract the sentences
-            sentences = doc.sentences
-
-            # Process document part-of-speech tagging
-            logging.info(f'Processing document id: {id}')
+            count = count + len(batch_ids)
+            logging.info(f'Processed {count} of {n_docs} documents')
 
-            # Initialize result processor
-            result_processor = ProcessResults()
-
-            data = []
-            for sent_id, sentence in enumerate(doc.sentences, start=1):
-                for word_id, word in enumerate(sentence.words, start=1):
-                    data.append(
-                        [sent_id, word.id, f'{id}_{sent_id}_{word.id}', word.text, word.lemma, word.upos, word.xpos,
-                         word.start_char, word.end_char])
-
-            columns = ['sentence_num', 'word_num', 'word_id', 'word', 'lemma', 'upos', 'xpos', 'start_char', 'end_char']
-            df = pd.DataFrame(data, columns=columns)
-
-            # Run processor
-            pos_df = result_processor.process_pos(id, df)
+            # Run extraction over the whole batch
+            df = extract([(id, doc, fix) for id, doc, (_, fix) in zip(batch_ids, docs, prepared)])
 
             # Append results
-            result_dfs.append([pos_df])
-
-            # Check len of result_dfs and if len(result_dfs) == chunk, push chunk to BigQuery
-            if len(result_dfs) == chunk or count > n_docs - chunk:
-                push_tables = PushTables()
-
-                push_tables.prepare_chunk_for_push(result_dfs, processor_name, library)
-
-                # Push results_dfs_concat to BigQuery
-                push_tables.push_to_gbq(
-                    database_import,
-                    bq,
-                    project,
-                    dataset,
-                    table,
-                    table_schema,
-                    library,
-                    logging,
-                    proc=processor_name
-                )
+            if df is not None:
+                result_dfs.append([df])
+                pending_docs = pending_docs + len(batch_ids)
 
-                # Reset result_dfs
-                result_dfs = []
-
-    elif processor_name == 'depparse':
-
-        # Set table schema
-        table_schema = Schema.depparse_schema
-
-        logging.info('Processing documents for dependency parsing...')
-
-        count = 0
-        for id, document in zip(identifiers, documents):
-
-            # Count keeps track of the number of documents processed
-            count = count + 1
-
-            # Process the document with the Stanza model
-            doc = nlp(document)
-
-            # Process depparse
-            logging.info(f'Processing document id: {id}')
-
-            # Initialize result processor
-            result_processor = ProcessResults()
-
-            dependency_info = []
-
-            for sentence in doc.sentences:
-                for word in sentence.words:
-                    row = {
-                        'sentence_num': sentence.index + 1,
-                        'word_num': word.id,
-                        'word_id': f'{id}_{sentence.index + 1}_{word.id}',
-                        'word_text': word.text,
-                        'word_lemma': word.lemma,
-                        'word_start_char': word.start_char,
-                        'word_end_char': word.end_char
-                    }
-
-                    if word.deprel == 'root':
-                        relation = word.deprel.upper()
-                        row.update({
-                            'relation': relation,
-                            'head_num': word.id,
-                            'head_id': f'{id}_{sentence.index + 1}_{word.id}',
-                            'head_text': word.text,
-                            'head_lemma': word.lemma,
-                            'head_start_char': word.start_char,
-                            'head_end_char': word.end_char
-                        })
-                    else:
-                        head_word = sentence.words[int(word.head) - 1]
-                        head_info = {
-                            'relation': word.deprel,
-                            'head_num': word.head,
-                            'head_id': f'{id}_{sentence.index + 1}_{word.head}',
-                            'head_text': head_word.text,
-                            'head_lemma': head_word.lemma,
-                            'head_start_char': head_word.start_char,
-                            'head_end_char': head_word.end_char
-                        }
-                        row.update(head_info)
-
-                    dependency_info.append(row)
-
-            # Transform in df
-            df = pd.DataFrame(dependency_info)
-
-            # Run processor
-            depparse_df = result_processor.process_depparse(id, df)
-
-            # Append results
-            result_dfs.append([depparse_df])
-
-            # Check len of result_dfs and if len(result_dfs) == chunk, push chunk to BigQuery
-            if len(result_dfs) == chunk or count > n_docs - chunk:
-                push_tables = PushTables()
-
-                push_tables.prepare_chunk_for_push(result_dfs, processor_name, library)
-
-                # Push results_dfs_concat to BigQuery
-                push_tables.push_to_gbq(
-                    database_import,
-                    bq,
-                    project,
-                    dataset,
-                    table,
-                    table_schema,
-                    library,
-                    logging,
-                    proc=processor_name
-                )
+            # Push to BigQuery once at least chunk documents are waiting, or sooner if memory is running short
+            if pending_docs >= chunk or (pending_docs > 0 and under_pressure()):
+                push_chunk(result_dfs)
 
                 # Reset result_dfs
                 result_dfs = []
+                pending_docs = 0
 
-    elif processor_name == 'morphology':
-
-        # Set table schema
-        table_schema = Schema.morphology_schema
-
-        logging.info('Processing documents for morphology extraction...')
+    # Push any remaining results
+    if len(result_dfs) > 0:
+        push_chunk(result_dfs)
 
-        count = 0
-        for id, document in zip(identifiers, documents):
-
-            # Count keeps track of the number of documents processed
-            count = count + 1
-
-            # Process the document with the Stanza model
-            doc = nlp(document)
-
-            # Process morphology
-            logging.info(f'Processing document id: {id}')
-
-            # Initialize result processor
-            result_processor = ProcessResults()
-
-            morphology_info = []
-
-            for sent_num, sentence in enumerate(doc.sentences):
-                for word_num, word in enumerate(sentence.words, start=1):
-
-                    # Splitting concatenated features into a dictionary
-                    feats_dict = {}
-                    if word.feats is not None:
-                        feats_list = word.feats.split('|')  # Splitting by '|'
-                        for feat in feats_list:
-                            key, value = feat.split('=')
-                            feats_dict[key] = value
-
-                    # Extracting word attributes
-                    morphology_row = {
-                        'sentence_num': sentence.index + 1,
-                        'word_num': word.id,
-                        'word_id': f'{id}_{sentence.index + 1}_{word.id}',
-                        'word': word.text,
-                        'lemma': word.lemma,
-                        'features_Number': feats_dict.get('Number') if feats_dict else None,
-                        'features_Mood': feats_dict.get('Mood') if feats_dict else None,
-                        'features_Person': feats_dict.get('Person') if feats_dict else None,
-                        'features_Tense': feats_dict.get('Tense') if feats_dict else None,
-                        'features_VerbForm': feats_dict.get('VerbForm') if feats_dict else None,
-                        'features_Case': feats_dict.get('Case') if feats_dict else None,
-                        'features_Gender': feats_dict.get('Gender') if feats_dict else None,
-                        'features_PronType': feats_dict.get('PronType') if feats_dict else None,
-                        'features_Degree': feats_dict.get('Degree') if feats_dict else None,
-                        'features_Definite': feats_dict.get('Definite') if feats_dict else None,
-                        'features_NumForm': feats_dict.get('NumForm') if feats_dict else None,
-                        'features_NumType': feats_dict.get('NumType') if feats_dict else None,
-                        'features_Voice': feats_dict.get('Voice') if feats_dict else None,
-                        'start_char': word.start_char,
-                        'end_char': word.end_char
-                    }
-                    morphology_info.append(morphology_row)
-
-            # Transform in df
-            df = pd.DataFrame(morphology_info)
-
-            # Run processor
-            morphology_df = result_processor.process_morphology(id, df)
-
-            # Append results
-            result_dfs.append([morphology_df])
-
-            # Check len of result_dfs and if len(result_dfs) == chunk, push chunk to BigQuery
-            if len(result_dfs) == chunk or count > n_docs - chunk:
-                push_tables = PushTables()
-
-                push_tables.prepare_chunk_for_push(result_dfs, processor_name, library)
-
-                # Push results_dfs_concat to BigQuery
-                push_tables.push_to_gbq(
-                    database_import,
-                    bq,
-                    project,
-                    dataset,
-                    table,
-                    table_schema,
-                    library,
-                    logging,
-                    proc=processor_name
-                )
-
-                # Reset result_dfs
-                result_dfs = []
-
-    else:
-        result_dfs = None
+    # Finish any open write streams
+    push_tables.close()
+    batcher.report()
@@ -0,0 +1,28 @@
+'''
+Tagset conversions shared by the libraries that only produce Penn Treebank tags (NLTK and CoreNLP), so that their
+output uses the same Universal Dependencies values as spaCy and Stanza.
+'''
+
+# Penn Treebank tags mapped to Universal Dependencies UPOS, so the upos column matches the other libraries
+PTB_TO_UPOS = {
+    'CC': 'CCONJ', 'CD': 'NUM', 'DT': 'DET', 'EX': 'PRON', 'FW': 'X', 'IN': 'ADP', 'JJ': 'ADJ', 'JJR': 'ADJ',
+    'JJS': 'ADJ', 'LS': 'X', 'MD': 'AUX', 'NN': 'NOUN', 'NNS': 'NOUN', 'NNP': 'PROPN', 'NNPS': 'PROPN', 'PDT': 'DET',
+    'POS': 'PART', 'PRP': 'PRON', 'PRP$': 'PRON', 'RB': 'ADV', 'RBR': 'ADV', 'RBS': 'ADV', 'RP': 'ADP', 'SYM': 'SYM',
+    'TO': 'PART', 'UH': 'INTJ', 'VB': 'VERB', 'VBD': 'VERB', 'VBG': 'VERB', 'VBN': 'VERB', 'VBP': 'VERB',
+    'VBZ': 'VERB', 'WDT': 'PRON', 'WP': 'PRON', 'WP$': 'PRON', 'WRB': 'ADV', '$': 'SYM', '#': 'SYM', '``': 'PUNCT',
+    "''": 'PUNCT', '-LRB-': 'PUNCT', '-RRB-': 'PUNCT', ',': 'PUNCT', '.': 'PUNCT', ':': 'PUNCT'
+}
+
+# Penn Treebank tags mapped to the Universal Dependencies features they imply (English only)
+PTB_TO_FEATS = {
+    'CD': {'NumType': 'Card'},
+    'JJ': {'Degree': 'Pos'}, 'JJR': {'Degree': 'Cmp'}, 'JJS': {'Degree': 'Sup'},
+    'NN': {'Number': 'Sing'}, 'NNS': {'Number': 'Plur'}, 'NNP': {'Number': 'Sing'}, 'NNPS': {'Number': 'Plur'},
+    'PRP': {'PronType': 'Prs'}, 'PRP$': {'PronType': 'Prs'}, 'WDT': {'PronType': 'Int'}, 'WP': {'PronType': 'Int'},
+    'WP$': {'PronType': 'Int'}, 'WRB': {'PronType': 'Int'},
+    'RBR': {'Degree': 'Cmp'}, 'RBS': {'Degree': 'Sup'},
+    'VB': {'VerbForm': 'Inf'}, 'VBD': {'VerbForm': 'Fin', 'Mood': 'Ind', 'Tense': 'Past'},
+    'VBG': {'VerbForm': 'Part', 'Tense': 'Pres'}, 'VBN': {'VerbForm': 'Part', 'Tense': 'Past'},
+    'VBP': {'VerbForm': 'Fin', 'Mood': 'Ind', 'Tense': 'Pres'},
+    'VBZ': {'VerbForm': 'Fin', 'Mood': 'Ind', 'Tense': 'Pres', 'Number': 'Sing', 'Person': '3'}
+}
@@ -0,0 +1,218 @@
+'''
+Runs the load jobs of the load_job sink in the background, so processing continues while chunks upload.
+
+The number of uploads in flight is set by an AIMD limiter: it grows by one after a window of successful uploads and
+halves when BigQuery reports a rate or quota limit, so throughput settles just under the quota ceiling. Transient
+errors (rate limits, 5xx, connection errors) are retried with jittered exponential backoff. A chunk that BigQuery
+rejects outright (e.g. a bad record with max_bad_records=0) is a poison chunk: its file is moved to the dead-letter
+directory with a .error.json describing the failure, and the run carries on.
+
+Load jobs are counted against the daily quota of each destination table. From QUOTA_WARNING_SHARE of the quota a
+warning is logged and the limiter is held at one upload in flight; once the quota is used up, further chunks for the
+table are dead-lettered without trying to load them.
+'''
+
+import os
+import json
+import time
+import random
+import shutil
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from google.api_core import exceptions
+
+from .memory_budget import under_pressure
+
+
+# Daily load job quota per destination table, and the share of it from which uploads are slowed down
+LOAD_JOBS_PER_TABLE_PER_DAY = 1500
+QUOTA_WARNING_SHARE = 0.9
+
+# Errors retried with backoff without reducing concurrency
+TRANSIENT_ERRORS = (
+    exceptions.InternalServerError,
+    exceptions.BadGateway,
+    exceptions.ServiceUnavailable,
+    exceptions.GatewayTimeout,
+    exceptions.DeadlineExceeded,
+    ConnectionError
+)
+
+
+def is_rate_limit(error):
+    '''
+    BigQuery reports rate and quota limits as 429, or as 403 with a rateLimitExceeded or quotaExceeded reason.
+    '''
+    if isinstance(error, exceptions.TooManyRequests):
+        return True
+    if isinstance(error, exceptions.Forbidden):
+        reasons = [e.get('reason') for e in (error.errors or [])]
+        return any(reason in ('rateLimitExceeded', 'quotaExceeded') for reason in reasons) or 'rate limit' in str(error).lower()
+    return False
+
+
+class AIMDLimiter:
+    '''
+    Concurrency limit with additive increase (one more slot after limit consecutive successes) and multiplicative
+    decrease (halved on a rate limit), between minimum and maximum.
+    '''
+
+    def __init__(self, initial, minimum=1, maximum=16):
+        self.limit = max(minimum, min(initial, maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.successes = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_success(self):
+        with self.condition:
+            self.successes += 1
+            if self.successes >= int(self.limit) and self.limit < self.maximum:
+                self.limit = self.limit + 1
+                self.successes = 0
+                self.condition.notify_all()
+
+    def on_rate_limit(self):
+        with self.condition:
+            self.limit = max(self.minimum, self.limit / 2)
+            self.successes = 0
+
+    def set_maximum(self, maximum):
+        with self.condition:
+            self.maximum = max(self.minimum, maximum)
+            self.limit = min(self.limit, self.maximum)
+
+
+class UploadScheduler:
+
+    def __init__(self, logging, max_concurrency=4, max_retries=6, base_delay=1.0, dead_letter_dir='dead_letter'):
+        self.logging = logging
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.dead_letter_dir = dead_letter_dir
+        self.limiter = AIMDLimiter(initial=max(1, max_concurrency // 2), maximum=max_concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self.futures = []
+
+        # Load jobs started per destination table in the last day, to slow down before the daily quota is reached
+        self.jobs_started = {}
+        self.quota_warned = set()
+        self.lock = threading.Lock()
+        self.stats = {'uploaded': 0, 'retries': 0, 'rate_limited': 0, 'dead_lettered': 0}
+
+    def submit(self, path, destination, load):
+        '''
+        Schedules load(path) for the chunk file at path. The file is removed once loaded, or moved to the
+        dead-letter directory if it cannot be loaded. Blocks while the limiter has no free slot, and while memory
+        is close to max_memory_mb, until the uploads in flight have finished.
+        '''
+        if under_pressure():
+            for future in self.futures:
+                future.result()
+
+        self.limiter.acquire()
+        self.futures = [future for future in self.futures if not future.done()]
+        self.futures.append(self.executor.submit(self.run, path, destination, load))
+
+    def record_job(self, destination):
+        '''
+        Counts a load job to destination against its daily quota. Returns False, without counting it, if the quota is
+        used up.
+        '''
+        now = time.time()
+        with self.lock:
+            started = self.jobs_started.setdefault(destination, deque())
+            while started and started[0] < now - 86400:
+                started.popleft()
+            if len(started) >= LOAD_JOBS_PER_TABLE_PER_DAY:
+                return False
+
+            started.append(now)
+            used = len(started)
+            warn = used >= QUOTA_WARNING_SHARE * LOAD_JOBS_PER_TABLE_PER_DAY and destination not in self.quota_warned
+            if warn:
+                self.quota_warned.add(destination)
+
+        if warn:
+            # Fewer jobs in flight leaves room for the remaining chunks' retries within the quota
+            self.limiter.set_maximum(self.limiter.minimum)
+            self.logging.warning(f'{used} load jobs to {destination} in the last 24 hours, close to the daily limit '
+                                 f'of {LOAD_JOBS_PER_TABLE_PER_DAY}. Uploads reduced to one at a time; consider sink: '
+                                 f'spool or a larger chunk size.')
+        return True
+
+    def run(self, path, destination, load):
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    if not self.record_job(destination):
+                        self.dead_letter(path, destination, exceptions.Forbidden(
+                            f'The daily quota of {LOAD_JOBS_PER_TABLE_PER_DAY} load jobs to {destination} is used up'))
+                        return
+
+                    load(path)
+                    self.limiter.on_success()
+                    os.remove(path)
+                    with self.lock:
+                        self.stats['uploaded'] += 1
+                    return
+                except Exception as e:
+                    if is_rate_limit(e):
+                        self.limiter.on_rate_limit()
+                        with self.lock:
+                            self.stats['rate_limited'] += 1
+                    elif not isinstance(e, TRANSIENT_ERRORS):
+                        self.dead_letter(path, destination, e)
+                        return
+
+                    if attempt == self.max_retries:
+                        self.dead_letter(path, destination, e)
+                        return
+
+                    # Full jitter: a random delay up to the exponential backoff for this attempt
+                    delay = random.uniform(0, min(self.base_delay * 2 ** attempt, 60))
+                    with self.lock:
+                        self.stats['retries'] += 1
+                    self.logging.info(f'Upload of {os.path.basename(path)} to {destination} failed ({e}). '
+                                      f'Retrying in {delay:.1f}s (concurrency limit {int(self.limiter.limit)})...')
+                    time.sleep(delay)
+        finally:
+            self.limiter.release()
+
+    def dead_letter(self, path, destination, error):
+        os.makedirs(self.dead_letter_dir, exist_ok=True)
+        target = os.path.join(self.dead_letter_dir, os.path.basename(path))
+        shutil.move(path, target)
+        with open(f'{target}.error.json', 'w', encoding='utf-8') as f:
+            json.dump({'destination': destination, 'error': str(error), 'type': type(error).__name__}, f, indent=1)
+
+        with self.lock:
+            self.stats['dead_lettered'] += 1
+        self.logging.info(f'Could not load {os.path.basename(path)} to {destination} ({error}). Moved to {target}')
+
+    def close(self):
+        '''
+        Waits for every scheduled upload to finish and logs the upload statistics.
+        '''
+        for future in self.futures:
+            future.result()
+        self.executor.shutdown()
+        self.futures = []
+
+        self.logging.info(f'Uploads: {self.stats["uploaded"]} loaded, {self.stats["retries"]} retries, '
+                          f'{self.stats["rate_limited"]} rate limited, {self.stats["dead_lettered"]} dead-lettered '
+                          f'(final concurrency limit {int(self.limiter.limit)})')
@@ -5,10 +5,14 @@ Contains functions for validating user input
 import pandas as pd
 import re
 
-from google.cloud.exceptions import NotFound
+from google.cloud import bigquery
+from google.cloud.exceptions import NotFound, BadRequest
 from google.cloud.bigquery.client import Client
 from google.auth.exceptions import DefaultCredentialsError
 
+from .config import InputConf
+from .bigquery_tools import QueryGBQ
+
 
 pd.options.mode.chained_assignment = None
 import warnings
@@ -111,4 +115,46 @@ class ValidateParams:
             print('No table in config. Please enter a valid table name. Exiting.')
             exit()
 
-        return project, dataset, table
\ No newline at end of file
+        return project, dataset, table
+
+    def validate_query_parameters(self, project, dataset, table, id_column, text_column, bq):
+        '''
+        Validates the options pushed into the input query (where, tablesample_percent, limit, order_by,
+        min_text_length and max_text_length), then checks the query with a dry run. Returns the number of bytes the
+        query will process.
+        '''
+
+        # limit and the text lengths must be whole numbers; 0 turns them off
+        for name in ('limit', 'min_text_length', 'max_text_length'):
+            value = getattr(InputConf, name)
+            if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+                print(f'Invalid {name}: {value}. {name} must be a whole number, or 0 to turn it off. Exiting.')
+                exit()
+
+        if InputConf.min_text_length and InputConf.max_text_length and InputConf.min_text_length > InputConf.max_text_length:
+            print('min_text_length is greater than max_text_length, so no documents would be selected. Exiting.')
+            exit()
+
+        percent = InputConf.tablesample_percent
+        if isinstance(percent, bool) or not isinstance(percent, (int, float)) or not 0 <= percent <= 100:
+            print(f'Invalid tablesample_percent: {percent}. Enter a percentage between 0 and 100 (0 to read the whole table). Exiting.')
+            exit()
+
+        # where is a single condition added to the query; it may not end the statement
+        if ';' in InputConf.where:
+            print('Invalid where: it must be a single SQL condition, without semicolons. Exiting.')
+            exit()
+
+        if InputConf.order_by and QueryGBQ.parse_order_by(InputConf.order_by) is None:
+            print(f"Invalid order_by: {InputConf.order_by}. Enter column names separated by commas, each optionally followed by ASC or DESC. Exiting.")
+            exit()
+
+        # A dry run checks the query (including the columns in where and order_by) without running it
+        query_string = QueryGBQ().build_query(project, dataset, table, id_column, text_column)
+        try:
+            job = bq.query(query_string, job_config=bigquery.QueryJobConfig(dry_run=True, use_query_cache=False))
+        except BadRequest as e:
+            print(f'Invalid input query: {e.message}\n{query_string}\nCheck where and order_by in config.yml. Exiting.')
+            exit()
+
+        return job.total_bytes_processed
\ No newline at end of file
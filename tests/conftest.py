@@ -0,0 +1,8 @@
+import os
+import sys
+
+# config.py reads TextAnalyticsPipeline/config/config.yml from the working directory when it is imported, so the tests
+# run from the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
@@ -0,0 +1,50 @@
+import os
+import logging
+
+import pandas as pd
+
+from TextAnalyticsPipeline.aggregates import SpillingCounter, SummaryAggregates
+
+
+def test_items_merge_spills_and_memory(tmp_path):
+    counter = SpillingCounter(['type', 'text'], str(tmp_path / 'spill'), max_keys=2, logging=logging)
+
+    counter.add([('PER', 'Obama'), ('LOC', 'Paris')], [2, 1], [1, 1])      # spilled
+    counter.add([('LOC', 'Paris'), ('LOC', 'Rome')], [3, 1], [2, 1])       # spilled
+    counter.add([('PER', 'Obama')], [1], [1])                              # in memory
+    assert len(counter.spills) == 2
+
+    assert list(counter.items()) == [
+        (('LOC', 'Paris'), 4, 3),
+        (('LOC', 'Rome'), 1, 1),
+        (('PER', 'Obama'), 3, 2)
+    ]
+
+    # Spill files are removed once merged
+    assert os.listdir(tmp_path) == []
+
+
+def test_items_without_spills(tmp_path):
+    counter = SpillingCounter(['upos', 'lemma'], str(tmp_path / 'spill'), max_keys=100, logging=logging)
+    counter.add([('VERB', 'run'), ('NOUN', 'cat')], [1, 2], [1, 1])
+    assert list(counter.items()) == [(('NOUN', 'cat'), 2, 1), (('VERB', 'run'), 1, 1)]
+
+
+def test_summaries_count_occurrences_and_documents(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('TextAnalyticsPipeline/temp')
+
+    aggregates = SummaryAggregates('test', max_keys=1, logging=logging)
+    aggregates.observe('ner', pd.DataFrame({
+        'identifier': ['1', '1', '2'], 'text': ['Obama', 'Obama', 'Obama'], 'type': ['PER', 'PER', 'PER'],
+        'language': ['en', 'en', 'de']
+    }))
+    aggregates.observe('ner', pd.DataFrame({
+        'identifier': ['3'], 'text': ['Obama'], 'type': ['PER'], 'language': ['en']
+    }))
+    aggregates.observe('sentiment', pd.DataFrame({'identifier': ['1'], 'sentiment': [1]}))
+
+    [(proc, df)] = list(aggregates.summaries())
+    assert proc == 'ner_summary'
+    assert df.values.tolist() == [['PER', 'Obama', 'de', 1, 1], ['PER', 'Obama', 'en', 3, 2]]
+    assert os.listdir('TextAnalyticsPipeline/temp') == []
@@ -0,0 +1,61 @@
+import pytest
+
+from TextAnalyticsPipeline import estimate
+from TextAnalyticsPipeline.bigquery_tools import QueryGBQ
+from TextAnalyticsPipeline.config import InputConf
+from TextAnalyticsPipeline.estimate import (allocate, bucket_label, population_from_database, sample_from_database,
+                                            samples_from_database, sample_percent)
+from TextAnalyticsPipeline.fake_bigquery import FakeBigQueryClient
+
+
+@pytest.fixture
+def bq(monkeypatch):
+    for name, value in [('where', ''), ('tablesample_percent', 0), ('limit', 0), ('order_by', ''),
+                        ('min_text_length', 0), ('max_text_length', 0)]:
+        monkeypatch.setattr(InputConf, name, value)
+
+    client = FakeBigQueryClient(':memory:', 'p')
+    client.execute('CREATE SCHEMA d')
+    # 3000 short documents, 300 of 100 characters and 3 long ones
+    client.execute('''
+        CREATE TABLE d.docs AS
+        SELECT CAST(i AS VARCHAR) AS id,
+            REPEAT('a', CASE WHEN i < 3000 THEN 10 WHEN i < 3300 THEN 100 ELSE 5000 END) AS text
+        FROM range(3303) AS r(i)''')
+    return client
+
+
+def input_query():
+    return QueryGBQ().build_query('p', 'd', 'docs', 'id', 'text')
+
+
+def test_population(bq):
+    population = population_from_database(bq, input_query(), 'text')
+    assert population == {0: (3000, 30000), 1: (300, 30000), 7: (3, 15000)}
+    assert bucket_label(7) == '4096-8191'
+    assert bucket_label(8) == '8192+'
+
+
+def test_all_buckets_sampled_in_one_query(bq):
+    allocation = {0: 20, 1: 5, 7: 1}
+    before = bq.calls.get('query', 0)
+    samples = sample_from_database(bq, input_query(), 'id', 'text', allocation)
+
+    assert bq.calls['query'] == before + 1
+    assert {bucket: len(ids) for bucket, (ids, _) in samples.items()} == allocation
+    assert all(len(document) == 5000 for document in samples[7][1])
+
+
+def test_sample_percent():
+    population = {0: (100000, 0), 1: (1000, 0)}
+    assert sample_percent(population, allocate(population, 200)) == pytest.approx(100 * 10 * 200 / 101000)
+    assert sample_percent(population, allocate(population, 20000)) is None
+
+
+def test_samples_fill_every_bucket(bq, monkeypatch):
+    # Force the table sample path; buckets the table sample leaves short are sampled from the whole input
+    monkeypatch.setattr(estimate, 'OVERSAMPLE', 1)
+    population = population_from_database(bq, input_query(), 'text')
+    samples = samples_from_database(bq, QueryGBQ(), 'p', 'd', 'docs', 'id', 'text', population, 33)
+
+    assert {bucket: len(ids) for bucket, (ids, _) in samples.items()} == allocate(population, 33)
@@ -0,0 +1,38 @@
+import pandas as pd
+
+from TextAnalyticsPipeline import job_runner
+from TextAnalyticsPipeline.config import FakeBigQueryConf, InputConf, SinkConf
+from TextAnalyticsPipeline.job_runner import Job, run_jobs
+
+
+def test_fake_tables_seeded_per_job(tmp_path, monkeypatch):
+    monkeypatch.setattr(FakeBigQueryConf, 'enabled', True)
+    monkeypatch.setattr(FakeBigQueryConf, 'path', str(tmp_path / 'fake.duckdb'))
+    monkeypatch.setattr(FakeBigQueryConf, 'seed_csv', '')
+    monkeypatch.setattr(InputConf, 'from_database', True)
+    monkeypatch.setattr(InputConf, 'id_column', 'id')
+    monkeypatch.setattr(InputConf, 'text_column', 'text')
+    monkeypatch.setattr(SinkConf, 'sink', 'load_job')
+
+    loaded = []
+
+    def load_documents(bq, project, dataset, table, id_column, text_column, *args):
+        df = bq.query(f'SELECT {id_column}, {text_column} FROM `{project}.{dataset}.{table}`').result().to_dataframe()
+        loaded.append((table, len(df)))
+        return len(df), df[id_column], df[text_column]
+
+    monkeypatch.setattr(job_runner, 'load_documents', load_documents)
+    monkeypatch.setattr(job_runner, 'apply_tuned_profile', lambda *args: None)
+    monkeypatch.setattr(job_runner, 'run_library_pipeline', lambda *args: None)
+
+    jobs = []
+    for table, n_rows in (('first', 2), ('second', 3)):
+        path = tmp_path / f'{table}.csv'
+        pd.DataFrame({'id': range(n_rows), 'text': ['Some text.'] * n_rows}).to_csv(path, index=False)
+        jobs.append(Job({'project': 'p', 'dataset': 'd', 'table': table, 'library': 'spacy', 'lang': 'en',
+                         'processors': 'ner', 'seed_csv': str(path)}))
+
+    results = run_jobs(jobs)
+
+    assert loaded == [('first', 2), ('second', 3)]
+    assert [(job.table, processor_name) for job, processor_name, _, _ in results] == [('first', 'ner'), ('second', 'ner')]
@@ -0,0 +1,46 @@
+from TextAnalyticsPipeline.morphology import FeatureDecoder, MORPHOLOGY_FEATURES
+
+
+def test_feature_strings_are_interned():
+    decoder = FeatureDecoder()
+    first = decoder.code('Case=Nom|Number=Sing')
+    assert decoder.code('Number=Plur') != first
+    assert decoder.code('Case=Nom|Number=Sing') == first
+    assert len(decoder.pairs) == 2
+
+
+def test_columns_use_missing_value_and_no_features():
+    decoder = FeatureDecoder(missing=None)
+    codes = [decoder.code('Case=Nom|Number=Sing'), decoder.code('_'), decoder.code(None)]
+    columns = decoder.columns(codes)
+
+    assert set(columns) == {f'features_{feature}' for feature in MORPHOLOGY_FEATURES}
+    assert list(columns['features_Case']) == ['Nom', None, None]
+    assert list(columns['features_Number']) == ['Sing', None, None]
+
+
+def test_first_value_only():
+    spacy_decoder = FeatureDecoder(missing='', first_value_only=True)
+    stanza_decoder = FeatureDecoder(missing=None, first_value_only=False)
+    for decoder, expected in [(spacy_decoder, ['Dem', '']), (stanza_decoder, ['Dem,Ind', None])]:
+        codes = [decoder.code('PronType=Dem,Ind'), decoder.code('Number=Sing')]
+        assert list(decoder.columns(codes)['features_PronType']) == expected
+
+
+def test_codes_added_after_columns_are_read():
+    decoder = FeatureDecoder()
+    decoder.columns([decoder.code('Tense=Past')])
+    code = decoder.code('Tense=Pres')
+    assert list(decoder.columns([code])['features_Tense']) == ['Pres']
+
+
+def test_long_format_keeps_every_feature():
+    decoder = FeatureDecoder(first_value_only=True)
+    codes = [decoder.code('Foreign=Yes|PronType=Dem,Ind'), decoder.code('_')]
+    df = decoder.long_format(['doc', 'doc'], [1, 1], [1, 2], ['doc_1_1', 'doc_1_2'], codes)
+
+    assert df.values.tolist() == [
+        ['doc', 1, 1, 'doc_1_1', 'Foreign', 'Yes'],
+        ['doc', 1, 1, 'doc_1_1', 'PronType', 'Dem,Ind']
+    ]
+    assert decoder.long_format(['doc'], [1], [2], ['doc_1_2'], [codes[1]]) is None
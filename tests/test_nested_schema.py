@@ -0,0 +1,49 @@
+import pandas as pd
+
+from TextAnalyticsPipeline.bigquery_tools import Schema, nest_rows
+
+
+def compact_pos_rows(**extra):
+    df = pd.DataFrame({
+        'identifier': ['a', 'a', 'a', 'b'],
+        'sentence_num': [1, 1, 2, 1],
+        'word_num': [1, 2, 1, 1],
+        'word': ['Cats', 'run', 'Yes', 'Hi'],
+        'lemma': ['cat', 'run', 'yes', 'hi'],
+        'upos': ['NOUN', 'VERB', 'INTJ', 'INTJ'],
+        'xpos': ['NNS', 'VBP', 'UH', None],
+        'start_char': [0, 5, 9, 0],
+        'end_char': [4, 8, 12, 2],
+        **extra
+    })
+    return df[Schema.get_column_order('pos', compact=True) + list(extra)]
+
+
+def test_one_record_per_document():
+    records = list(nest_rows(compact_pos_rows()))
+
+    assert [record['identifier'] for record in records] == ['a', 'b']
+    assert [sentence['sentence_num'] for sentence in records[0]['sentences']] == [1, 2]
+    assert records[0]['sentences'][0]['tokens'] == [
+        {'word_num': 1, 'word': 'Cats', 'lemma': 'cat', 'upos': 'NOUN', 'xpos': 'NNS', 'start_char': 0, 'end_char': 4},
+        {'word_num': 2, 'word': 'run', 'lemma': 'run', 'upos': 'VERB', 'xpos': 'VBP', 'start_char': 5, 'end_char': 8}
+    ]
+    # Missing values become None, as JSON null
+    assert records[1]['sentences'][0]['tokens'][0]['xpos'] is None
+
+
+def test_record_fields_follow_nested_schema():
+    record = next(nest_rows(compact_pos_rows()))
+    schema = Schema.nested_schemas['pos']
+    token_fields = [field.name for field in schema[1].fields[1].fields]
+
+    assert list(record) == [field.name for field in schema]
+    assert list(record['sentences'][0]['tokens'][0]) == token_fields
+
+
+def test_language_kept_at_document_level():
+    records = list(nest_rows(compact_pos_rows(language=['en', 'en', 'en', 'de'])))
+
+    assert [record['language'] for record in records] == ['en', 'de']
+    assert list(records[0]) == ['identifier', 'language', 'sentences']
+    assert 'language' not in records[0]['sentences'][0]['tokens'][0]
@@ -0,0 +1,49 @@
+import re
+
+import pytest
+
+from TextAnalyticsPipeline.bigquery_tools import QueryGBQ
+from TextAnalyticsPipeline.config import InputConf
+
+
+@pytest.fixture
+def input_conf(monkeypatch):
+    for name, value in [('where', ''), ('tablesample_percent', 0), ('limit', 0), ('order_by', ''),
+                        ('min_text_length', 0), ('max_text_length', 0)]:
+        monkeypatch.setattr(InputConf, name, value)
+    return InputConf
+
+
+def build(**settings):
+    for name, value in settings.items():
+        setattr(InputConf, name, value)
+    return ' '.join(QueryGBQ().build_query('p', 'd', 't', 'id', 'text').split())
+
+
+def test_default_query(input_conf):
+    assert build() == 'SELECT id, text FROM `p.d.t` WHERE text IS NOT NULL GROUP BY id, text'
+
+
+def test_filters_sample_order_and_limit(input_conf):
+    query = build(where="platform = 'twitter'", tablesample_percent=5, limit=100, order_by='created_at DESC, id',
+                  min_text_length=10, max_text_length=500)
+    assert query == (
+        "SELECT id, text FROM `p.d.t` TABLESAMPLE SYSTEM (5.0 PERCENT) "
+        "WHERE text IS NOT NULL AND (platform = 'twitter') AND LENGTH(text) >= 10 AND LENGTH(text) <= 500 "
+        "GROUP BY id, text ORDER BY MIN(created_at) DESC, id ASC LIMIT 100"
+    )
+
+
+def test_selected_columns_are_ordered_directly(input_conf):
+    assert re.search(r'ORDER BY text DESC$', build(order_by='text desc'))
+
+
+@pytest.mark.parametrize('order_by, expected', [
+    ('created_at', [('created_at', 'ASC')]),
+    (' a desc , b ASC', [('a', 'DESC'), ('b', 'ASC')]),
+    ('a; DROP TABLE t', None),
+    ('LENGTH(text)', None),
+    ('a DESC NULLS LAST', None),
+])
+def test_parse_order_by(order_by, expected):
+    assert QueryGBQ.parse_order_by(order_by) == expected
@@ -0,0 +1,64 @@
+from TextAnalyticsPipeline.stanza_pipe import get_tokenize_options, prepare_input
+
+
+def stanza_offsets(sentences):
+    '''
+    Start and end of each token as Stanza computes them for pretokenized input: tokens joined by one character.
+    '''
+    offsets = []
+    char = 0
+    for sentence in sentences:
+        for token in sentence:
+            offsets.append((char, char + len(token)))
+            char = char + len(token) + 1
+    return offsets
+
+
+def test_tokens_offsets_map_back_to_document():
+    document = '  The  cat\n\nsat   down . '
+    sentences, fix = prepare_input(document, 'tokens')
+
+    assert sentences == [['The', 'cat'], ['sat', 'down', '.']]
+    for token, (start, end) in zip([t for s in sentences for t in s], stanza_offsets(sentences)):
+        assert document[fix(start):fix(end)] == token
+
+
+def test_tokens_starting_with_bracket_are_not_json():
+    sentences, fix = prepare_input('[ quote ] said he', 'tokens')
+    assert sentences == [['[', 'quote', ']', 'said', 'he']]
+
+
+def test_token_lists():
+    sentences, fix = prepare_input('[["New", "York"], ["Hi"]]', 'token_lists')
+    assert sentences == [['New', 'York'], ['Hi']]
+    assert fix(4) == 4
+
+
+def test_token_lists_fall_back_to_whitespace_tokens():
+    document = '[ not json ]'
+    sentences, fix = prepare_input(document, 'token_lists')
+    assert sentences == [['[', 'not', 'json', ']']]
+    assert document[fix(2):fix(5)] == 'not'
+
+
+def test_sentences_offsets_after_doubled_newlines():
+    document = 'One two.\nThree four.\nFive.'
+    text, fix = prepare_input(document, 'sentences')
+    assert text == 'One two.\n\nThree four.\n\nFive.'
+
+    for word in ['Three', 'four', 'Five']:
+        start = text.index(word)
+        assert document[fix(start):fix(start + len(word))] == word
+    assert fix(None) is None
+
+
+def test_raw_is_unchanged():
+    text, fix = prepare_input('Raw text.', 'raw')
+    assert text == 'Raw text.' and fix(3) == 3
+
+
+def test_tokenize_options():
+    assert get_tokenize_options('tokens') == {'tokenize_pretokenized': True}
+    assert get_tokenize_options('token_lists') == {'tokenize_pretokenized': True}
+    assert get_tokenize_options('sentences') == {'tokenize_no_ssplit': True}
+    assert get_tokenize_options('raw') == {}
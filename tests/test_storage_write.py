@@ -0,0 +1,87 @@
+import logging
+
+import pytest
+
+from TextAnalyticsPipeline.bigquery_tools import Schema
+from TextAnalyticsPipeline.storage_write import LocalWriteClient, StorageWriteSink, serialize_rows, table_path
+
+
+TABLE_ID = 'project.dataset.table_stanza_part_of_speech'
+
+
+class CountingClient(LocalWriteClient):
+    '''
+    LocalWriteClient that counts the appends rejected with AlreadyExists.
+    '''
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.already_exists = 0
+
+    def append(self, stream, offset, descriptor, serialized_rows):
+        from google.api_core import exceptions
+
+        try:
+            super().append(stream, offset, descriptor, serialized_rows)
+        except exceptions.AlreadyExists:
+            self.already_exists += 1
+            raise
+
+
+def records(start, n):
+    return [
+        {'identifier': str(i), 'sentence_num': 1, 'word_num': 1, 'word_id': f'{i}_1_1', 'word': f'word{i}',
+         'lemma': f'word{i}', 'upos': 'NOUN', 'xpos': 'NN', 'start_char': 0, 'end_char': 4}
+        for i in range(start, start + n)
+    ]
+
+
+@pytest.mark.parametrize('stream_type', ['committed', 'pending'])
+def test_every_row_written_once_after_lost_responses(stream_type):
+    client = CountingClient(failure_rate=0.5, seed=1)
+    sink = StorageWriteSink(client, TABLE_ID, Schema.pos_schema, stream_type, logging, max_retries=20, backoff=0)
+
+    chunks = [records(start, 7) for start in range(0, 70, 7)]
+    for chunk in chunks:
+        assert sink.append_records(chunk) == len(chunk)
+    assert sink.close() == 70
+
+    expected = serialize_rows(sink.message_class, Schema.pos_schema, [row for chunk in chunks for row in chunk])
+    assert client.rows(table_path(TABLE_ID)) == expected
+
+    # Some appends were applied but reported as failed; their retries hit AlreadyExists and wrote nothing
+    assert client.already_exists > 0
+    assert client.appends == len(chunks)
+
+
+def test_pending_rows_visible_only_after_commit():
+    client = LocalWriteClient()
+    sink = StorageWriteSink(client, TABLE_ID, Schema.pos_schema, 'pending', logging, backoff=0)
+
+    sink.append_records(records(0, 5))
+    assert client.rows(table_path(TABLE_ID)) == []
+
+    sink.close()
+    assert len(client.rows(table_path(TABLE_ID))) == 5
+
+
+def test_committed_rows_visible_on_append():
+    client = LocalWriteClient()
+    sink = StorageWriteSink(client, TABLE_ID, Schema.pos_schema, 'committed', logging, backoff=0)
+
+    sink.append_records(records(0, 5))
+    assert len(client.rows(table_path(TABLE_ID))) == 5
+
+
+def test_append_at_written_offset_raises_already_exists():
+    from google.api_core import exceptions
+
+    client = LocalWriteClient()
+    stream = client.create_stream('table', pending=False)
+    client.append(stream, 0, None, [b'a', b'b'])
+
+    with pytest.raises(exceptions.AlreadyExists):
+        client.append(stream, 0, None, [b'a', b'b'])
+    with pytest.raises(exceptions.OutOfRange):
+        client.append(stream, 5, None, [b'c'])
+    assert client.rows('table') == [b'a', b'b']
@@ -0,0 +1,83 @@
+import logging
+import threading
+
+from TextAnalyticsPipeline import upload_scheduler
+from TextAnalyticsPipeline.upload_scheduler import AIMDLimiter, UploadScheduler
+
+
+def test_initial_limit_is_clamped():
+    assert AIMDLimiter(initial=0, minimum=1, maximum=4).limit == 1
+    assert AIMDLimiter(initial=10, minimum=1, maximum=4).limit == 4
+
+
+def test_additive_increase_after_limit_successes():
+    limiter = AIMDLimiter(initial=2, maximum=4)
+    limiter.on_success()
+    assert limiter.limit == 2
+    limiter.on_success()
+    assert limiter.limit == 3
+
+    for _ in range(10):
+        limiter.on_success()
+    assert limiter.limit == 4
+
+
+def test_multiplicative_decrease_on_rate_limit():
+    limiter = AIMDLimiter(initial=8, minimum=1, maximum=8)
+    limiter.on_rate_limit()
+    assert limiter.limit == 4
+    for _ in range(5):
+        limiter.on_rate_limit()
+    assert limiter.limit == 1
+
+    # The success count restarts after a rate limit
+    limiter.on_success()
+    assert limiter.limit == 2
+
+
+def test_acquire_waits_for_a_free_slot():
+    limiter = AIMDLimiter(initial=1, maximum=1)
+    limiter.acquire()
+
+    acquired = threading.Event()
+    thread = threading.Thread(target=lambda: (limiter.acquire(), acquired.set()))
+    thread.start()
+    assert not acquired.wait(0.1)
+
+    limiter.release()
+    assert acquired.wait(1)
+    thread.join()
+    assert limiter.in_flight == 1
+
+
+def test_quota_slows_uploads_and_dead_letters_beyond_it(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(upload_scheduler, 'LOAD_JOBS_PER_TABLE_PER_DAY', 10)
+    scheduler = UploadScheduler(logging, max_concurrency=4, dead_letter_dir=str(tmp_path / 'dead_letter'))
+
+    loaded = []
+    for i in range(12):
+        path = tmp_path / f'chunk_{i}.csv'
+        path.write_text('identifier\n1\n')
+        scheduler.submit(str(path), 'd.table', loaded.append)
+
+    with caplog.at_level(logging.INFO):
+        scheduler.close()
+
+    assert len(loaded) == 10
+    assert scheduler.stats['dead_lettered'] == 2
+    assert len(list((tmp_path / 'dead_letter').glob('*.error.json'))) == 2
+    assert scheduler.limiter.maximum == 1
+
+
+def test_quota_warning_is_logged_once(monkeypatch, caplog):
+    monkeypatch.setattr(upload_scheduler, 'LOAD_JOBS_PER_TABLE_PER_DAY', 10)
+    scheduler = UploadScheduler(logging, max_concurrency=4)
+
+    with caplog.at_level(logging.WARNING):
+        results = [scheduler.record_job('d.table') for _ in range(11)]
+    scheduler.close()
+
+    assert results == [True] * 10 + [False]
+    warnings = [record for record in caplog.records if record.levelno == logging.WARNING]
+    assert len(warnings) == 1 and 'd.table' in warnings[0].getMessage()
+    assert scheduler.limiter.limit == 1
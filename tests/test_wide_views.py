@@ -0,0 +1,50 @@
+import os
+import logging
+
+import pandas as pd
+import pytest
+
+from TextAnalyticsPipeline.bigquery_tools import PushTables, Schema
+from TextAnalyticsPipeline.config import OutputConf, SinkConf
+from TextAnalyticsPipeline.fake_bigquery import FakeBigQueryClient
+
+
+def compact_rows(proc):
+    rows = {}
+    for field in Schema.get_schema(proc, compact=True):
+        if field.name == 'identifier':
+            rows[field.name] = ['1', '2']
+        elif field.field_type == 'INTEGER':
+            rows[field.name] = [1, 1]
+        else:
+            rows[field.name] = ['x', 'y']
+    return pd.DataFrame(rows)
+
+
+@pytest.mark.parametrize('proc', ['pos', 'depparse', 'morphology'])
+@pytest.mark.parametrize('languages', [None, {'1': 'en', '2': 'de'}])
+def test_wide_view_columns(proc, languages, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('TextAnalyticsPipeline/temp')
+    monkeypatch.setattr(OutputConf, 'compact_schema', True)
+    monkeypatch.setattr(OutputConf, 'nested_schema', False)
+    monkeypatch.setattr(SinkConf, 'sink', 'load_job')
+    monkeypatch.setattr(SinkConf, 'dead_letter_dir', str(tmp_path / 'dead_letter'))
+
+    bq = FakeBigQueryClient(':memory:', 'p')
+    push_tables = PushTables()
+    push_tables.languages = languages
+    table = f'views_{proc}_{"auto" if languages else "en"}'
+
+    push_tables.prepare_chunk_for_push([[compact_rows(proc)]], proc, 'stanza')
+    push_tables.push_to_gbq(True, bq, 'p', 'd', table, Schema.get_schema(proc), 'stanza', logging, proc=proc)
+    push_tables.close()
+
+    view = f'p.d.{table}_stanza_{Schema.suffixes[proc]}'
+    df = bq.query(f'SELECT * FROM `{view}` ORDER BY identifier').result().to_dataframe()
+
+    assert list(df.columns)[:len(Schema.get_schema(proc))] == [field.name for field in Schema.get_schema(proc)]
+    if languages is None:
+        assert 'language' not in df.columns
+    else:
+        assert df['language'].tolist() == ['en', 'de']